@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.PerformanceMiddleware',
+    'api.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,13 +56,86 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
 
+    # Basic first: the first class supplies the WWW-Authenticate challenge of every 401
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.BasicAuthentication',
+        'api.authentication.DeviceAuthentication',
     ),
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
 }
 
+# In-process LRU cache of guest permission tokens used on the gate-open path. TTL (seconds) bounds
+# how long another worker process may serve a permission after it was changed or revoked.
+GUEST_TOKEN_CACHE = {
+    'MAX_SIZE': 4096,
+    'TTL': 60,
+}
+
+# Rows validated and inserted per batch by the bulk guest import (api/guests/import/); a ?batch_size= of
+# the request is clamped to GUEST_IMPORT_MAX_BATCH_SIZE, which bounds the memory an import takes
+GUEST_IMPORT_BATCH_SIZE = 500
+GUEST_IMPORT_MAX_BATCH_SIZE = 5000
+
+# Default number of guests returned by the typeahead search (api/guests/search/)
+GUEST_SEARCH_LIMIT = 10
+
+# Rows fetched per keyset query when streaming the gate log export (api/interactions/export/)
+ACTIVITY_EXPORT_CHUNK_SIZE = 2000
+
+# Serve the activity listings (api/interactions/...) from values_list rows instead of per-row serializers
+# (api.lean.LeanListMixin). The JSON is identical; off by default.
+LEAN_ACTIVITY_LISTS = False
+
+# How the activity rollups behind api/interactions/stats/ are maintained: 'save' folds each interaction
+# in as it is logged (two extra UPDATEs per gate open), 'batch' leaves it to a periodic
+# `manage.py rollup_activity`.
+ACTIVITY_ROLLUP_MODE = 'save'
+
+# Write-behind logging of gate interactions: when enabled, gate opens are acknowledged once journaled to
+# DIR and a background thread bulk inserts them every FLUSH_SIZE rows or FLUSH_INTERVAL seconds.
+# Journals of crashed processes are replayed on startup (or by `manage.py replay_activity_journal`).
+ACTIVITY_WRITE_BEHIND = {
+    'ENABLED': False,
+    'DIR': os.path.join(BASE_DIR, 'journal'),
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'FSYNC': True,
+}
+
+# Per-view request timings (api.metrics.PerformanceMiddleware), exposed for Prometheus at api/metrics/.
+# SERVER_TIMING also returns each request's timings to the client in a Server-Timing header.
+PERFORMANCE_METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+}
+
+# Live activity stream (api/interactions/stream/): new rows are picked up by one tailing query per process
+# every POLL_INTERVAL seconds (at once for rows logged by the same process); idle streams get a keepalive
+# every HEARTBEAT seconds and a stream falling QUEUE_SIZE rows behind is closed (the client resumes).
+ACTIVITY_STREAM = {
+    'POLL_INTERVAL': 1.0,
+    'HEARTBEAT': 15,
+    'QUEUE_SIZE': 1000,
+}
+
+# Background deletion (api.purge) of deleted guests' history and of expired permissions: CHUNK_SIZE rows per
+# transaction, PAUSE seconds between chunks. Jobs run in a thread of the process that queued them
+# (IN_PROCESS) and are otherwise, or once abandoned for STALE_AFTER seconds, run by `manage.py purge`.
+PURGE = {
+    'CHUNK_SIZE': 1000,
+    'PAUSE': 0.0,
+    'IN_PROCESS': True,
+    'STALE_AFTER': 300,
+}
+
+# Gate controllers authenticate with HMAC-signed request tokens (api.authentication.DeviceAuthentication).
+# MAX_TOKEN_AGE caps how far ahead a token may expire; CACHE_TTL is how long a device's principal is cached.
+DEVICE_AUTH = {
+    'MAX_TOKEN_AGE': 300,
+    'CACHE_TTL': 60,
+}
+
 ROOT_URLCONF = 'GateApp.urls'
 
 TEMPLATES = [
@@ -96,6 +171,35 @@ DATABASES = {
     }
 }
 
+# Read replicas of 'default' (aliases in DATABASES, each with 'TEST': {'MIRROR': 'default'}). Safe requests
+# to the listing, detail and reporting views read from one of them; a client that wrote stays on the
+# primary for REPLICA_STICKY_SECONDS. See api.routers.
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['api.routers.SiteRouter', 'api.routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = 5
+
+# Databases (aliases in DATABASES, migrated like 'default') holding the gate activity of the sites whose
+# Site.database names them. Activity of other sites, and activity without a site, stays in 'default'.
+# Listings filtered by ?site= read that site's database only, everything else reads all of them and
+# merges. Gates and sites are cached per process for SITE_REGISTRY['TTL'] seconds. See api.sites.
+SITE_DATABASES = []
+SITE_REGISTRY = {
+    'TTL': 60,
+}
+
+# Cold storage of old gate activity (api.archive): `manage.py archive_activity` moves the rows older than
+# HORIZON_DAYS out of every activity database into gzip NDJSON files under DIR, one directory per (UTC) day,
+# BATCH_SIZE rows per delete. Files are append-only, each with a small index of its date range and ids. The
+# activity listings and the export read them back for the requests that reach past the newest archived day,
+# leaving out the rows of users and guests deleted since - which other processes notice within PEOPLE_TTL
+# seconds.
+ACTIVITY_ARCHIVE = {
+    'DIR': os.path.join(BASE_DIR, 'archive'),
+    'HORIZON_DAYS': 365,
+    'BATCH_SIZE': 5000,
+    'PEOPLE_TTL': 60,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
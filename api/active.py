@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytz
+from django.utils import timezone
+from .models import AccessSchedule, GuestPermission, PermissionSpan
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+LEVELS = 24  # runs of up to 2**23 days
+
+
+def day_number(instant):
+    return (instant - EPOCH) // timedelta(days=1)
+
+
+def bucket_key(level, day):
+    """Key of the run of 2**level days (aligned to a multiple of 2**level) holding day."""
+    return level << 24 | day >> level
+
+
+def spans(starts_on, expires_on):
+    """Keys of the fewest aligned runs of days that together cover the days of [starts_on, expires_on),
+    as in a segment tree: at most two per level."""
+    if expires_on <= starts_on:
+        return []
+    first, last = day_number(starts_on), day_number(expires_on - timedelta(microseconds=1)) + 1
+    keys, level = [], 0
+    while first < last:
+        if first & 1:
+            keys.append(level << 24 | first)
+            first += 1
+        if last & 1:
+            last -= 1
+            keys.append(level << 24 | last)
+        first, last, level = first >> 1, last >> 1, level + 1
+    return keys
+
+
+def index(rows, model=PermissionSpan, using=None):
+    """Add the spans of new permissions given as (id, guest id, starts_on, expires_on) rows (one INSERT).
+    Migrations pass their historical PermissionSpan model and their database."""
+    model.objects.using(using).bulk_create([
+        model(key=key, permission_id=pk, guest_id=guest_id, starts_on=starts_on, expires_on=expires_on)
+        for pk, guest_id, starts_on, expires_on in rows for key in spans(starts_on, expires_on)])
+
+
+def reindex(permission_ids):
+    """Recompute the spans of permission_ids from their current windows (deleted ones just lose theirs).
+    For writes that skip the post_save signal, such as QuerySet.update()."""
+    permission_ids = list(permission_ids)
+    PermissionSpan.objects.filter(permission_id__in=permission_ids).delete()
+    index(GuestPermission.objects.filter(id__in=permission_ids).values_list('id', 'guest_id', 'starts_on', 'expires_on'))
+
+
+def rebuild(batch_size=10000):
+    """Recompute the whole index, batch_size permissions (by id) at a time. Returns the permissions indexed."""
+    PermissionSpan.objects.all().delete()
+    indexed = last = 0
+    while True:
+        ids = list(GuestPermission.objects.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return indexed
+        reindex(ids)
+        indexed, last = indexed + len(ids), ids[-1]
+
+
+def active_at(instant=None):
+    """{guest id: [permission ids]} of the permissions that admit their guest at instant (default now):
+    instant within the window and the schedule, if any, and not a used once-off. Reads only the spans
+    in the buckets holding instant, so the cost grows with the permissions valid around instant, not
+    with the expired history."""
+    instant = instant or timezone.now()
+    day = day_number(instant)
+    rows = list(PermissionSpan.objects.filter(key__in=[bucket_key(level, day) for level in range(LEVELS)],
+                                              starts_on__lte=instant, expires_on__gt=instant,
+                                              permission__once_off_used=False)
+                .values_list('guest_id', 'permission_id', 'permission__schedule_id'))
+    schedule_ids = {schedule_id for _, _, schedule_id in rows if schedule_id is not None}
+    allowed = {schedule.pk: schedule.compiled().allows(instant)
+               for schedule in AccessSchedule.objects.filter(id__in=schedule_ids)} if schedule_ids else {}
+    active = {}
+    for guest_id, permission_id, schedule_id in rows:
+        if schedule_id is None or allowed[schedule_id]:
+            active.setdefault(guest_id, []).append(permission_id)
+    return active
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        """Connect signal receivers (cache invalidation etc.) once the app registry is loaded."""
+        from . import signals  # noqa: F401
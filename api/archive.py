@@ -0,0 +1,375 @@
+import fcntl
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+from uuid import uuid4
+
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+from .filters import parse_instant
+from .models import ACTIVITY_DELETIONS, GateActivity, Guest, Watermark
+from .sites import activity_databases, local_column, merge, resolve_related
+
+# columns of each archived row, in file order; rows are stored as JSON arrays
+FIELDS = ('id', 'date', 'gate_status', 'responsible_user_id', 'responsible_guest_id', 'gate_id', 'site_id')
+SUFFIX = '.ndjson.gz'
+INDEX_SUFFIX = '.index.json'
+DAY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+# the per-file index lists the distinct values of these columns, so filtered reads can skip whole files
+INDEXED = ('responsible_user_id', 'responsible_guest_id', 'gate_id', 'site_id')
+NOT_NULL = object()  # filter value: the column must be set
+
+
+def archive_options():
+    return getattr(settings, 'ACTIVITY_ARCHIVE', {})
+
+
+def archive_dir():
+    return archive_options().get('DIR')
+
+
+def _day(date):
+    return date.astimezone(pytz.utc).strftime('%Y-%m-%d')
+
+
+def _day_start(day):
+    return pytz.utc.localize(datetime.strptime(day, '%Y-%m-%d'))
+
+
+def _days(directory):
+    """The archived days (YYYY-MM-DD, UTC), oldest first."""
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if DAY.match(name))
+
+
+def oldest(directory=None):
+    """Start of the oldest archived day, None if nothing is archived."""
+    days = _days(directory or archive_dir())
+    return _day_start(days[0]) if days else None
+
+
+def horizon(directory=None):
+    """End of the newest archived day: every archived row is older (None if nothing is archived). Rows
+    still in the database can be older too, until the next archive run."""
+    days = _days(directory or archive_dir())
+    return _day_start(days[-1]) + timedelta(days=1) if days else None
+
+
+def _write_data(directory, day, alias, rows):
+    """Write rows (FIELDS tuples of one day, in (date, id) order) to a new file of day and fsync it. It
+    only counts as archived once its index exists (see _write_index)."""
+    folder = os.path.join(directory, day)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, '{0}-{1}{2}'.format(alias, uuid4().hex[:16], SUFFIX))
+    temp = path + '.new'
+    with open(temp, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as data:
+            for row in rows:
+                data.write((json.dumps([row[0], row[1].isoformat()] + list(row[2:])) + '\n').encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.rename(temp, path)
+    return path
+
+
+def _write_index(path, alias, rows):
+    index = {
+        'database': alias,
+        'rows': len(rows),
+        'first': [rows[0][1].isoformat(), rows[0][0]],
+        'last': [rows[-1][1].isoformat(), rows[-1][0]],
+    }
+    for column in INDEXED:
+        position = FIELDS.index(column)
+        index[column] = sorted({row[position] for row in rows if row[position] is not None})
+    temp = path[:-len(SUFFIX)] + INDEX_SUFFIX + '.new'
+    with open(temp, 'w') as handle:
+        json.dump(index, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.rename(temp, path[:-len(SUFFIX)] + INDEX_SUFFIX)
+
+
+def _read_data(path):
+    """The rows of an archive file as FIELDS tuples, dates parsed."""
+    with gzip.open(path, 'rt', encoding='utf-8') as data:
+        return [tuple([values[0], parse_datetime(values[1])] + values[2:]) for values in map(json.loads, data)]
+
+
+def recover(directory):
+    """Settle the files an interrupted run left without an index: the rows of such a file were either
+    still in their database (the delete did not commit, so the file goes) or already deleted (the
+    index is written)."""
+    for day in _days(directory):
+        folder = os.path.join(directory, day)
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.endswith('.new'):
+                os.remove(path)
+            elif name.endswith(SUFFIX) and not os.path.exists(path[:-len(SUFFIX)] + INDEX_SUFFIX):
+                alias = name[:-len(SUFFIX)].rsplit('-', 1)[0]
+                rows = _read_data(path)
+                ids = [row[0] for row in rows]
+                if any(GateActivity.objects.using(alias).filter(id__in=ids[start:start + 500]).exists()
+                       for start in range(0, len(ids), 500)):
+                    os.remove(path)
+                else:
+                    _write_index(path, alias, rows)
+
+
+def archive(before, batch_size=None, directory=None):
+    """Move the GateActivity rows dated before `before` out of every activity database into the archive,
+    batch_size rows at a time: each batch is written to new gzip NDJSON files, one per day, then deleted
+    from its database, then the files are indexed. Files are never changed once written; a run that is
+    interrupted is settled by the next one (see recover). Only one run per archive directory at a time.
+    Returns the number of rows moved."""
+    directory = directory or archive_dir()
+    batch_size = batch_size or archive_options().get('BATCH_SIZE', 5000)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    moved = 0
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        recover(directory)
+        for alias in activity_databases():
+            activity = GateActivity.objects.using(alias)
+            while True:
+                rows = list(activity.filter(date__lt=before).order_by('date', 'id').values_list(*FIELDS)[:batch_size])
+                if not rows:
+                    break
+                days = OrderedDict()
+                for row in rows:
+                    days.setdefault(_day(row[1]), []).append(row)
+                paths = [(_write_data(directory, day, alias, day_rows), day_rows) for day, day_rows in days.items()]
+                ids = [row[0] for row in rows]
+                with transaction.atomic(using=alias):
+                    for start in range(0, len(ids), 500):
+                        activity.filter(id__in=ids[start:start + 500])._raw_delete(alias)
+                Watermark.advance(ACTIVITY_DELETIONS)
+                for path, day_rows in paths:
+                    _write_index(path, alias, day_rows)
+                moved += len(rows)
+    return moved
+
+
+def _matches(values, filters):
+    for column, value in filters.items():
+        if value is NOT_NULL:
+            if values[column] is None:
+                return False
+        elif values[column] != value:
+            return False
+    return True
+
+
+def _overlaps(index, since, until, position, descending):
+    """Whether a file with index may hold rows in [since, until) past position."""
+    first = (parse_datetime(index['first'][0]), index['first'][1])
+    last = (parse_datetime(index['last'][0]), index['last'][1])
+    if since and last[0] < since or until and first[0] >= until:
+        return False
+    if position is not None and (first >= position if descending else last <= position):
+        return False
+    return True
+
+
+def _indexed_files(folder, filters, since, until, position, descending):
+    """Paths of the complete (indexed) files in folder that may hold rows matching filters in [since, until)
+    past position."""
+    files = []
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(INDEX_SUFFIX):
+            continue
+        with open(os.path.join(folder, name)) as handle:
+            index = json.load(handle)
+        if not _overlaps(index, since, until, position, descending):
+            continue
+        if any(value is not NOT_NULL and value is not None and value not in index[column]
+               for column, value in filters.items() if column in INDEXED):
+            continue
+        files.append(os.path.join(folder, name[:-len(INDEX_SUFFIX)] + SUFFIX))
+    return files
+
+
+def _iter_file(path, descending):
+    """The rows of an archive file as FIELDS dicts in (date, id) order, streamed from the file - newest
+    first reads the file (at most ACTIVITY_ARCHIVE['BATCH_SIZE'] rows) whole, as gzip only reads forwards."""
+    if descending:
+        for values in reversed(_read_data(path)):
+            yield dict(zip(FIELDS, values))
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as data:
+        for line in data:
+            values = json.loads(line)
+            yield dict(zip(FIELDS, [values[0], parse_datetime(values[1])] + values[2:]))
+
+
+def _key(record):
+    return record['date'], record['id']
+
+
+def iter_records(filters=None, since=None, until=None, position=None, descending=False, directory=None):
+    """Yield the archived rows as dicts of FIELDS in (date, id) order (newest first if descending),
+    limited to since <= date < until, to rows past position ((date, id), in the direction of travel)
+    and to rows whose columns equal filters (a value of NOT_NULL only requires the column to be set).
+    Reads a day at a time, skipping the days outside the window and the files whose index rules them
+    out; the files of a day are streamed and merged, so a page costs the files it reaches, not the day."""
+    filters = filters or {}
+    directory = directory or archive_dir()
+    days = _days(directory)
+    for day in (reversed(days) if descending else days):
+        start, end = _day_start(day), _day_start(day) + timedelta(days=1)
+        if since and end <= since or until and start >= until:
+            continue
+        if position is not None and (start > position[0] if descending else end <= position[0]):
+            continue
+        paths = _indexed_files(os.path.join(directory, day), filters, since, until, position, descending)
+        for record in merge([_iter_file(path, descending) for path in paths], key=_key, reverse=descending):
+            if since and record['date'] < since or until and record['date'] >= until:
+                continue
+            if position is not None and (_key(record) >= position if descending else _key(record) <= position):
+                continue
+            if _matches(record, filters):
+                yield record
+
+
+class PeopleCache(object):
+    """Process-local sets of the user and guest ids known to still exist, so that reading the archive only
+    queries for the people it has not seen lately. A deleted person is dropped at once by post_delete
+    (signals) in this process and, like everything else, after `ttl` seconds in every other one."""
+
+    def __init__(self, ttl=60, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._living = {}  # model -> set of ids
+        self._loaded_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def living(self, model, ids):
+        """The ids among ids of rows of model (User or Guest) that exist."""
+        with self._lock:
+            if time.monotonic() - self._loaded_at >= self.ttl:
+                self._living, self._loaded_at = {}, time.monotonic()
+            known = self._living.setdefault(model, set())
+            unknown = set(ids) - known
+        if unknown:
+            found = set(model.objects.filter(pk__in=unknown).values_list('pk', flat=True))
+            with self._lock:
+                known = self._living.setdefault(model, set())
+                if len(known) + len(found) > self.max_size:
+                    known.clear()
+                known.update(found)
+            return (set(ids) - unknown) | found
+        return set(ids)
+
+    def forget(self, model, pk):
+        with self._lock:
+            self._living.get(model, set()).discard(pk)
+
+    def clear(self):
+        with self._lock:
+            self._living = {}
+
+
+people = PeopleCache(ttl=archive_options().get('PEOPLE_TTL', 60))
+
+
+def _living(records):
+    """records less those of users and guests deleted since they were archived."""
+    users = people.living(User, {record['responsible_user_id'] for record in records} - {None})
+    guests = people.living(Guest, {record['responsible_guest_id'] for record in records} - {None})
+    return [record for record in records
+            if (record['responsible_user_id'] is None or record['responsible_user_id'] in users) and
+            (record['responsible_guest_id'] is None or record['responsible_guest_id'] in guests)]
+
+
+def iter_living(chunk_size=2000, **kwargs):
+    """iter_records(**kwargs) less the rows of users and guests deleted since they were archived (the
+    files are never rewritten, so a purge cannot reach them), read chunk_size rows at a time."""
+    records = iter_records(**kwargs)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        for record in _living(chunk):
+            yield record
+
+
+def shape(queryset, records):
+    """records as the rows queryset would yield: values_list tuples (related lookups read from the
+    default database) or unsaved GateActivity instances with queryset's select_related relations
+    prefetched."""
+    fields = queryset._fields
+    if fields:
+        columns = [queryset.model._meta.get_field(column).attname if column != 'pk' else 'id'
+                   for column in (local_column(queryset.model, name) for name in fields)]
+        return resolve_related(queryset.model, fields, [[record[column] for column in columns] for record in records])
+    activities = [GateActivity(**record) for record in records]
+    related = queryset.query.select_related
+    if activities and isinstance(related, dict) and related:
+        prefetch_related_objects(activities, *related)
+    return activities
+
+
+class ArchiveReadMixin(object):
+    """For the activity views: rows moved to the archive by `manage.py archive_activity` are read back
+    and merged with those of the database whenever a request reaches back past the archive horizon,
+    filtered by the same filter_fields, since/until window and archive_required columns (the ones the
+    view's queryset requires to be set)."""
+    archive_required = ()
+
+    def get_archive_filters(self):
+        """{column: value} for the filter_fields in the query, None if a value cannot match anything."""
+        filters = {column: NOT_NULL for column in self.archive_required}
+        params = self.request.query_params
+        for name in self.filter_fields:
+            value = params.get(name)
+            if value in (None, ''):
+                continue
+            try:
+                filters[GateActivity._meta.get_field(name).attname] = int(value)
+            except ValueError:
+                return None
+        return filters
+
+    def get_archive_window(self):
+        params = self.request.query_params
+        return (parse_instant(params['since'], 'since') if params.get('since') else None,
+                parse_instant(params['until'], 'until') if params.get('until') else None)
+
+    def iter_archive(self, queryset, position=None, descending=False, chunk_size=500):
+        """The archived rows the request covers, shaped like queryset's rows, chunk_size records at a time."""
+        filters = self.get_archive_filters()
+        if filters is None or horizon() is None:
+            return
+        since, until = self.get_archive_window()
+        records = iter_living(chunk_size, filters=filters, since=since, until=until, position=position,
+                              descending=descending)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return
+            for row in shape(queryset, chunk):
+                yield row
+
+    def read_archive(self, queryset, position, reverse, limit, results, key):
+        """Up to limit archived rows to merge with the page results read from the database (see
+        GateActivityCursorPagination), or [] when the page cannot reach the archive."""
+        end = horizon()
+        if end is None or position is not None and reverse and position[0] >= end:
+            return []
+        if not reverse and len(results) >= limit and key(results[-1])[0] >= end:
+            return []
+        return list(islice(self.iter_archive(queryset, position, descending=not reverse, chunk_size=limit), limit))
@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from .models import Device
+
+
+def sign(secret, key_id, expires, method, path, body=b''):
+    """HMAC-SHA256 signature binding a device key to an expiry time, a single method and path and the
+    SHA-256 of the request body (bytes)."""
+    message = '{0}:{1}:{2}:{3}:{4}'.format(key_id, expires, method.upper(), path,
+                                          hashlib.sha256(body).hexdigest()).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def device_token(key_id, secret, method, path, body=b'', lifetime=60):
+    """Authorization header value a device sends for one request to path (including any query string)
+    with body (bytes, or a str sent as UTF-8)."""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    expires = int(time.time()) + lifetime
+    return 'Device {0}:{1}:{2}'.format(key_id, expires, sign(secret, key_id, expires, method, path, body))
+
+
+class DevicePrincipalCache(object):
+    """Caches the (user, secret) and gate of active devices per key id for `ttl` seconds, so verifying a
+    request usually needs no query at all. Invalidated by signals when a Device or its User changes."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}  # key_id -> (user, secret, stored_at, gate_id)
+        self._lock = threading.Lock()
+
+    def _entry(self, key_id):
+        entry = self._entries.get(key_id)
+        if entry is not None and time.monotonic() - entry[2] < self.ttl:
+            return entry
+        try:
+            device = Device.objects.select_related('user').get(key_id=key_id, is_active=True)
+        except Device.DoesNotExist:
+            return None
+        entry = (device.user, device.secret, time.monotonic(), device.gate_id)
+        with self._lock:
+            self._entries[key_id] = entry
+        return entry
+
+    def get(self, key_id):
+        entry = self._entry(key_id)
+        return None if entry is None else (entry[0], entry[1])
+
+    def gate(self, key_id):
+        """Id of the gate the device controls, None if it has none (or is unknown)."""
+        entry = self._entry(key_id)
+        return None if entry is None else entry[3]
+
+    def invalidate(self, key_id):
+        with self._lock:
+            self._entries.pop(key_id, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key_id in [k for k, entry in self._entries.items() if entry[0].pk == user_id]:
+                del self._entries[key_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = DevicePrincipalCache(ttl=getattr(settings, 'DEVICE_AUTH', {}).get('CACHE_TTL', 60))
+
+
+class DeviceAuthentication(BaseAuthentication):
+    """Authenticates `Authorization: Device <key_id>:<expires>:<signature>` where signature is
+    sign(secret, key_id, expires, method, full path, body) and expires a unix time at most MAX_TOKEN_AGE
+    seconds ahead. Verification is one HMAC and a constant-time comparison - no password hashing - against
+    the cached device principal. A token can be replayed for the same method, path and body until it
+    expires, so devices should use short lifetimes; signing the body keeps a captured token from being
+    reused for a different request to the same path."""
+    keyword = 'Device'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode('ascii'):
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid device token header.')
+        try:
+            key_id, expires, signature = auth[1].decode('ascii').split(':')
+            expires = int(expires)
+        except (UnicodeError, ValueError):
+            raise exceptions.AuthenticationFailed('Invalid device token header.')
+
+        now = time.time()
+        if expires < now:
+            raise exceptions.AuthenticationFailed('Device token expired.')
+        if expires > now + getattr(settings, 'DEVICE_AUTH', {}).get('MAX_TOKEN_AGE', 300):
+            raise exceptions.AuthenticationFailed('Device token lifetime too long.')
+
+        principal = principal_cache.get(key_id)
+        if principal is None:
+            raise exceptions.AuthenticationFailed('Unknown or inactive device.')
+        user, secret = principal
+        expected = sign(secret, key_id, expires, request.method, request.get_full_path(), request.body)
+        if not hmac.compare_digest(expected, signature) or not user.is_active:
+            raise exceptions.AuthenticationFailed('Invalid device token.')
+        return user, key_id
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,41 @@
+"""Micro-benchmarks for the api hot paths, run with `python manage.py benchmark <name>`. Every benchmark
+runs against a throwaway test database, never the configured one."""
+import time
+from contextlib import contextmanager
+
+from django.test.utils import (setup_databases, setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+
+
+@contextmanager
+def test_database():
+    """Set up the test environment and database(s) for the duration of the block, like the test runner
+    does (including DEBUG = False, so queries are not logged), so benchmarks can use the test client."""
+    setup_test_environment(debug=False)
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (seconds taken, result)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def report(stdout, title, rows):
+    """Write a small table of (label, value) rows."""
+    stdout.write(title)
+    width = max(len(label) for label, _ in rows)
+    for label, value in rows:
+        stdout.write('  {0:<{1}}  {2}'.format(label, width, value))
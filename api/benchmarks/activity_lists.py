@@ -0,0 +1,35 @@
+import time
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from ..models import GateActivity, Guest
+from . import report
+
+
+def run(stdout, count=20):
+    """Rows per second served by `count` requests for 1000-row pages of interactions/, through the
+    serializers and through the lean values_list path (LEAN_ACTIVITY_LISTS)."""
+    user = User.objects.create(username='bench')
+    guest = Guest.objects.create(first_name='Bench', surname='Guest', mobile='0820000000', created_by=user)
+    GateActivity.objects.bulk_create([GateActivity(responsible_guest=guest, gate_status=1) if index % 3 else
+                                      GateActivity(responsible_user=user, gate_status=0) for index in range(5000)])
+    client = APIClient()
+    url = '/api/interactions/?page_size=1000'
+
+    def rows_per_second(lean):
+        with override_settings(LEAN_ACTIVITY_LISTS=lean):
+            body = client.get(url).content  # warm up
+            start = time.process_time()
+            for _ in range(count):
+                assert client.get(url).content == body
+            return count * 1000 / (time.process_time() - start), body
+
+    serializer_rate, serializer_body = rows_per_second(False)
+    lean_rate, lean_body = rows_per_second(True)
+    assert lean_body == serializer_body
+    report(stdout, 'Activity listing (interactions/), {0} requests of 1000 rows, CPU time of this process'.format(count), [
+        ('serializer path', '{0:10.0f} rows/s'.format(serializer_rate)),
+        ('lean path', '{0:10.0f} rows/s'.format(lean_rate)),
+        ('speed-up', '{0:10.1f}x'.format(lean_rate / serializer_rate)),
+    ])
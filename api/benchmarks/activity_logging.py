@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from ..journal import ActivityJournal
+from ..models import GateActivity
+from . import percentile, report, timed
+
+
+def run(stdout, count=2000):
+    """Time `count` staff gate opens (interactions/user/) with synchronous INSERTs and with write-behind
+    journaling (with and without fsync), reporting throughput and per-open latency."""
+    user = User.objects.create(username='bench')
+    client = APIClient()
+    client.force_authenticate(user)
+
+    def opens():
+        latencies = []
+        for _ in range(count):
+            latency, response = timed(client.post, '/api/interactions/user/', {'gate_status': 1})
+            assert response.status_code == 201
+            latencies.append(latency)
+        return latencies
+
+    rows = []
+    with override_settings(ACTIVITY_ROLLUP_MODE='batch'):
+        total, latencies = timed(opens)
+        rows.append(('synchronous INSERT', total, latencies, total))
+        for fsync in (True, False):
+            directory = tempfile.mkdtemp()
+            journal = ActivityJournal(directory, flush_size=500, flush_interval=0.2, fsync=fsync, start_flusher=False)
+            options = {'ENABLED': True, 'DIR': directory}
+            try:
+                with override_settings(ACTIVITY_WRITE_BEHIND=options), mock.patch('api.journal._journal', journal):
+                    total, latencies = timed(opens)
+                drained, _ = timed(journal.close)  # what the background flusher would do, off the request path
+            finally:
+                shutil.rmtree(directory)
+            rows.append(('write-behind, fsync={0}'.format(fsync), total, latencies, total + drained))
+    assert GateActivity.objects.count() == 3 * count
+
+    report(stdout, 'Gate opens (interactions/user/), {0} sequential requests'.format(count), [
+        (label, '{0:8.0f} opens/s   p50 {1:6.2f} ms   p99 {2:6.2f} ms   incl. flush {3:8.0f} rows/s'.format(
+            count / total, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, count / end_to_end))
+        for label, total, latencies, end_to_end in rows])
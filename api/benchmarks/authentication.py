@@ -0,0 +1,41 @@
+import base64
+import time
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from ..authentication import device_token
+from ..models import Device
+from . import report
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.PBKDF2PasswordHasher']  # Django's default
+
+
+def run(stdout, count=200):
+    """Compare the CPU cost of `count` staff gate opens authenticated with BasicAuthentication (a PBKDF2
+    hash per request) and with signed device tokens, as requests per second per core."""
+    with override_settings(PASSWORD_HASHERS=PASSWORD_HASHERS, ACTIVITY_ROLLUP_MODE='batch'):
+        user = User.objects.create(username='bench')
+        user.set_password('bench-password')
+        user.save()
+        Device.objects.create(name='bench', key_id='bench-key', secret='bench-secret', user=user)
+        basic = 'Basic ' + base64.b64encode(b'bench:bench-password').decode('ascii')
+        client = APIClient()
+        url = '/api/interactions/user/'
+
+        def cpu_seconds(header):
+            start = time.process_time()
+            for _ in range(count):
+                response = client.post(url, {'gate_status': 1}, HTTP_AUTHORIZATION=header())
+                assert response.status_code == 201, response.status_code
+            return time.process_time() - start
+
+        basic_cpu = cpu_seconds(lambda: basic)
+        device_cpu = cpu_seconds(lambda: device_token('bench-key', 'bench-secret', 'POST', url))
+    report(stdout, 'Gate opens (interactions/user/), {0} requests, CPU time of this process'.format(count), [
+        ('BasicAuthentication (PBKDF2)', '{0:7.2f} ms/request  {1:8.0f} requests/s/core'.format(
+            basic_cpu / count * 1000, count / basic_cpu)),
+        ('DeviceAuthentication (HMAC)', '{0:7.2f} ms/request  {1:8.0f} requests/s/core'.format(
+            device_cpu / count * 1000, count / device_cpu)),
+        ('speed-up', '{0:7.1f}x'.format(basic_cpu / device_cpu)),
+    ])
@@ -0,0 +1,93 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+from .. import active, presence, rollups
+from ..models import GateActivity, Guest, GuestPermission
+
+# row counts at scale 1
+GUESTS = 100000
+PERMISSIONS = 1000000
+ACTIVITY = 50000000
+STAFF = 50
+HISTORY = timedelta(days=365)
+BATCH_SIZE = 5000
+
+FIRST_NAMES = ('Thabo', 'Lerato', 'Sipho', 'Anna', 'Pieter', 'Naledi', 'Johan', 'Ayanda', 'Fatima', 'David')
+SURNAMES = ('Nkosi', 'van der Merwe', 'Dlamini', 'Botha', 'Mokoena', 'Naidoo', 'Smith', 'Khumalo', 'Pillay', 'Jacobs')
+
+
+def _batched(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+
+
+def seed(scale=0.001, seed=0, stdout=None):
+    """Fill the database with scale times the production-like volumes above: guests created by a few staff
+    users, permissions mostly expired (a tenth currently valid, a fifth once-off), and a year of gate
+    activity, 70% by guests, inserted in date order like the live log. Rows are generated lazily and
+    bulk inserted BATCH_SIZE at a time, so memory does not grow with the scale. Deterministic for a given
+    seed on a fresh database. Returns what the replay driver needs to build requests."""
+    rng = random.Random(seed)
+    now = timezone.now()
+    counts = {'guests': max(10, int(GUESTS * scale)), 'permissions': max(10, int(PERMISSIONS * scale)),
+              'activity': max(100, int(ACTIVITY * scale))}
+
+    def progress(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    staff = [User.objects.create(username='staff{0}'.format(index)) for index in range(STAFF)]
+    staff_ids = [user.pk for user in staff]
+    progress("Seeding {guests} guests, {permissions} permissions, {activity} activity rows".format(**counts))
+
+    _batched(Guest, (Guest(first_name=rng.choice(FIRST_NAMES), surname=rng.choice(SURNAMES),
+                           email='guest{0}@example.com'.format(index), mobile='08{0:08d}'.format(index),
+                           created_by_id=rng.choice(staff_ids))
+                     for index in range(counts['guests'])))
+    guest_ids = list(Guest.objects.order_by('id').values_list('id', flat=True))
+
+    valid_tokens = []
+
+    def permissions():
+        for index in range(counts['permissions']):
+            token = '{0:016x}'.format(rng.getrandbits(64))
+            if rng.random() < 0.1:
+                starts_on = now - timedelta(hours=rng.uniform(1, 240))
+                expires_on = now + timedelta(hours=rng.uniform(1, 240))
+            else:
+                starts_on = now - HISTORY * rng.random() - timedelta(days=2)
+                expires_on = starts_on + timedelta(hours=rng.uniform(1, 48))
+            once_off = rng.random() < 0.2
+            if expires_on > now and not once_off:
+                valid_tokens.append(token)
+            yield GuestPermission(token=token, guest_id=rng.choice(guest_ids), granted_by_id=rng.choice(staff_ids),
+                                  starts_on=starts_on, expires_on=expires_on, once_off=once_off)
+    _batched(GuestPermission, permissions())
+    progress("Indexing permission windows")
+    active.rebuild()
+
+    def activity():
+        step = HISTORY.total_seconds() / counts['activity']
+        date = now - HISTORY
+        for _ in range(counts['activity']):
+            date += timedelta(seconds=rng.expovariate(1 / step))
+            if rng.random() < 0.7:
+                yield GateActivity(date=min(date, now), responsible_guest_id=rng.choice(guest_ids), gate_status=1)
+            else:
+                yield GateActivity(date=min(date, now), responsible_user_id=rng.choice(staff_ids),
+                                   gate_status=rng.choice((0, 1)))
+    _batched(GateActivity, activity())
+
+    progress("Rebuilding activity rollups")
+    rollups.rebuild()
+    progress("Rebuilding presence")
+    presence.rebuild()
+    return {'staff': staff_ids, 'guests': guest_ids, 'tokens': valid_tokens, 'counts': counts}
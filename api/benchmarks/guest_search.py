@@ -0,0 +1,31 @@
+import random
+
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from ..models import Guest
+from ..search import search_guests
+from . import percentile, report, timed
+from .fixtures import FIRST_NAMES, SURNAMES
+
+
+def run(stdout, count=100000):
+    """Latency of typeahead searches (1 to 4 typed characters of a name or mobile) over `count` guests,
+    of search_guests itself and of the whole guests/search/ request through the test client."""
+    rng = random.Random(0)
+    user = User.objects.create(username='bench')
+    suffixes = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(3)) for _ in range(500)]
+    Guest.objects.bulk_create([Guest(first_name=rng.choice(FIRST_NAMES) + rng.choice(suffixes),
+                                     surname=rng.choice(SURNAMES), mobile='08{0:08d}'.format(index), created_by=user)
+                               for index in range(count)])
+    words = [name.lower() for name in FIRST_NAMES + SURNAMES] + ['08{0:08d}'.format(rng.randrange(count)) for _ in range(20)]
+    queries = [word[:rng.randint(1, 4)] for word in words for _ in range(25)]
+    rng.shuffle(queries)
+
+    direct = [timed(search_guests, query, 10)[0] for query in queries]
+    client = APIClient()
+    client.force_authenticate(user)
+    endpoint = [timed(client.get, '/api/guests/search/', {'q': query})[0] for query in queries]
+    report(stdout, 'Guest typeahead search over {0} guests, {1} queries'.format(count, len(queries)), [
+        ('search_guests', 'p50 {0:6.2f} ms   p99 {1:6.2f} ms'.format(percentile(direct, 50) * 1000, percentile(direct, 99) * 1000)),
+        ('guests/search/', 'p50 {0:6.2f} ms   p99 {1:6.2f} ms'.format(percentile(endpoint, 50) * 1000, percentile(endpoint, 99) * 1000)),
+    ])
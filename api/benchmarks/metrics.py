@@ -0,0 +1,52 @@
+import time
+
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import resolve
+from rest_framework.test import APIClient
+from ..metrics import PerformanceMiddleware, registry
+from ..models import Guest
+from . import report
+
+
+def run(stdout, count=2000):
+    """Overhead of PerformanceMiddleware: the middleware wrapped around a stub response (its own cost,
+    isolated), and CPU time of `count` guest detail requests with the middleware enabled and disabled."""
+    user = User.objects.create(username='bench')
+    guest = Guest.objects.create(first_name='Bench', surname='Guest', mobile='0820000000', created_by=user)
+    url = '/api/guests/{0}/'.format(guest.pk)
+
+    request = RequestFactory().get(url)
+    request.resolver_match = resolve(url)
+    stub = lambda request: HttpResponse()
+    middleware = PerformanceMiddleware(stub)
+    start = time.perf_counter()
+    for _ in range(count * 10):
+        middleware(request)
+    isolated = (time.perf_counter() - start) / count / 10
+    registry.clear()
+
+    client = APIClient()
+
+    def cpu_seconds(enabled):
+        with override_settings(PERFORMANCE_METRICS={'ENABLED': enabled, 'SERVER_TIMING': True}):
+            client.get(url)  # warm up
+            start = time.process_time()
+            for _ in range(count):
+                client.get(url)
+            return time.process_time() - start
+
+    off = on = 0.0
+    for _ in range(2):  # interleaved to even out drift
+        off += cpu_seconds(False)
+        on += cpu_seconds(True)
+    histogram = registry.histogram('request_duration_seconds', 'guest_details')
+    report(stdout, 'Guest detail (guests/<pk>/), 2 x {0} requests'.format(count), [
+        ('middleware alone', '{0:7.3f} ms/request'.format(isolated * 1000)),
+        ('CPU, metrics disabled', '{0:7.3f} ms/request'.format(off / count / 2 * 1000)),
+        ('CPU, metrics enabled', '{0:7.3f} ms/request'.format(on / count / 2 * 1000)),
+        ('recorded p50 / p99', '{0:.3f} / {1:.3f} ms'.format(histogram.percentile(50) / 1000.0,
+                                                            histogram.percentile(99) / 1000.0)),
+    ])
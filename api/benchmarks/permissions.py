@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+from ..models import Guest, GuestPermission
+from . import report, timed
+
+
+def run(stdout, count=500):
+    """Issue a window to `count` guests through one POST per guest (guests/permissions/) and through a
+    single batch POST (guests/permissions/batch/)."""
+    user = User.objects.create(username='bench')
+    Guest.objects.bulk_create([Guest(first_name='Guest', surname=str(i), mobile=str(i), created_by=user)
+                               for i in range(count)])
+    guest_ids = list(Guest.objects.values_list('pk', flat=True))
+    expires_on = (timezone.now() + timedelta(days=1)).isoformat()
+    client = APIClient()
+    client.force_authenticate(user)
+
+    def per_request():
+        for guest_id in guest_ids:
+            client.post('/api/guests/permissions/', {'guest': guest_id, 'expires_on': expires_on}, format='json')
+
+    def batch():
+        client.post('/api/guests/permissions/batch/', {'guests': guest_ids, 'expires_on': expires_on}, format='json')
+
+    single, _ = timed(per_request)
+    GuestPermission.objects.all().delete()
+    bulk, _ = timed(batch)
+    assert GuestPermission.objects.count() == count
+    report(stdout, 'Permission issuance for {0} guests'.format(count), [
+        ('per-request path', '{0:8.3f} s  {1:10.0f} permissions/s'.format(single, count / single)),
+        ('batch path', '{0:8.3f} s  {1:10.0f} permissions/s'.format(bulk, count / bulk)),
+        ('speed-up', '{0:8.1f}x'.format(single / bulk)),
+    ])
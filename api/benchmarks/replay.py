@@ -0,0 +1,139 @@
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from . import fixtures, percentile, report, timed
+
+# share of each kind of request in generated traffic
+MIX = (
+    ('gate open (guest)', 30),
+    ('gate open (staff)', 20),
+    ('guest lookup', 15),
+    ('guest search', 10),
+    ('history', 15),
+    ('guest history', 7),
+    ('stats', 3),
+)
+
+
+def generate(count, context, seed=0):
+    """Yield count requests ({'endpoint', 'method', 'path', 'data'}) drawn from MIX against the rows seeded
+    by fixtures.seed."""
+    rng = random.Random(seed)
+    labels, weights = zip(*MIX)
+    for label in rng.choices(labels, weights, k=count):
+        guest_index = rng.randrange(len(context['guests']))
+        guest_id = context['guests'][guest_index]
+        if label == 'gate open (guest)':
+            request = ('post', '/api/interactions/guest/', {'token': rng.choice(context['tokens']), 'gate_status': 1})
+        elif label == 'gate open (staff)':
+            request = ('post', '/api/interactions/user/', {'gate_status': 1})
+        elif label == 'guest lookup':
+            request = ('get', '/api/guests/{0}/'.format(guest_id), None)
+        elif label == 'guest search':
+            request = ('get', '/api/guests/search/', {'q': '08{0:08d}'.format(guest_index)})
+        elif label == 'history':
+            request = ('get', '/api/interactions/', {'page_size': 50})
+        elif label == 'guest history':
+            request = ('get', '/api/interactions/guest/', {'responsible_guest': guest_id})
+        else:
+            request = ('get', '/api/interactions/stats/', {'period': 'day'})
+        yield dict(zip(('endpoint', 'method', 'path', 'data'), (label,) + request))
+
+
+def load_traffic(path, scale, seed):
+    """Requests recorded in path (NDJSON, after a header line with the fixture scale and seed)."""
+    with open(path) as recorded:
+        header = json.loads(next(recorded))
+        if (header['scale'], header['seed']) != (scale, seed):
+            raise ValueError("{0} was recorded against scale {1} and seed {2}".format(path, header['scale'], header['seed']))
+        return [json.loads(line) for line in recorded]
+
+
+def save_traffic(path, requests, scale, seed):
+    with open(path, 'w') as recorded:
+        recorded.write(json.dumps({'scale': scale, 'seed': seed}) + '\n')
+        for request in requests:
+            recorded.write(json.dumps(request) + '\n')
+
+
+def replay(client, requests):
+    """Send requests through client in order. Returns {endpoint: [(seconds, queries, status), ...]}."""
+    samples = OrderedDict((label, []) for label, _ in MIX)
+    for request in requests:
+        connection.queries_log.clear()  # the client's request_started resets it mid-capture otherwise
+        with CaptureQueriesContext(connection) as context:
+            latency, response = timed(getattr(client, request['method']), request['path'], request['data'])
+        samples.setdefault(request['endpoint'], []).append((latency, len(context.captured_queries), response.status_code))
+    return samples
+
+
+def summarize(samples):
+    endpoints = OrderedDict()
+    for label, rows in samples.items():
+        if not rows:
+            continue
+        latencies = [latency for latency, _, _ in rows]
+        queries = [count for _, count, _ in rows]
+        endpoints[label] = OrderedDict([
+            ('requests', len(rows)),
+            ('errors', sum(1 for _, _, status in rows if status >= 400)),
+            ('throughput', len(rows) / sum(latencies)),
+            ('p50_ms', percentile(latencies, 50) * 1000),
+            ('p95_ms', percentile(latencies, 95) * 1000),
+            ('p99_ms', percentile(latencies, 99) * 1000),
+            ('queries_mean', sum(queries) / float(len(queries))),
+            ('queries_max', max(queries)),
+        ])
+    return endpoints
+
+
+def run(stdout, count=2000, scale=0.001, seed=0, traffic=None, output=None):
+    """Seed fixtures at scale, then replay count requests of the MIX of gate opens, guest lookups and
+    history reads through the test client, one after another, and report throughput, latency
+    percentiles and query counts per endpoint. With traffic, the requests are read from that file if it
+    exists (or generated and recorded there), so runs replay the same requests. With output, the report
+    is also saved there as JSON, for diffing runs."""
+    seeding, context = timed(fixtures.seed, scale, seed, stdout)
+    if traffic and os.path.exists(traffic):
+        requests = load_traffic(traffic, scale, seed)
+    else:
+        requests = list(generate(count, context, seed))
+        if traffic:
+            save_traffic(traffic, requests, scale, seed)
+
+    client = APIClient()
+    client.force_authenticate(User.objects.get(pk=context['staff'][0]))
+    duration, samples = timed(replay, client, requests)
+    endpoints = summarize(samples)
+
+    results = OrderedDict([
+        ('benchmark', 'replay'),
+        ('recorded_on', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+        ('database', connection.vendor),
+        ('django', django.get_version()),
+        ('scale', scale),
+        ('seed', seed),
+        ('rows', context['counts']),
+        ('seeding_seconds', seeding),
+        ('requests', len(requests)),
+        ('duration_seconds', duration),
+        ('throughput', len(requests) / duration),
+        ('endpoints', endpoints),
+    ])
+    if output:
+        with open(output, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+    report(stdout, 'Replay of {0} requests at scale {1}: {2:.0f} requests/s'.format(
+        len(requests), scale, results['throughput']), [
+        (label, '{requests:6d} req  {errors:4d} err  {throughput:7.0f} req/s  p50 {p50_ms:7.2f}  '
+                'p95 {p95_ms:7.2f}  p99 {p99_ms:7.2f} ms  queries {queries_mean:5.1f} (max {queries_max})'.format(**row))
+        for label, row in endpoints.items()])
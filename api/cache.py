@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+
+TokenEntry = namedtuple('TokenEntry', ('guest_id', 'starts_on', 'expires_on', 'once_off', 'schedule', 'site_id',
+                                       'permission_id'))
+# schedule: a CompiledSchedule, for permissions that have one; site_id: for permissions limited to one site
+TokenEntry.__new__.__defaults__ = (None, None, None)
+
+
+class GuestTokenCache(object):
+    """Bounded LRU cache mapping GuestPermission tokens to the guest id and validity window of the
+    permission. Entries expire after `ttl` seconds so that processes which did not receive the
+    invalidating signal (other workers) only ever serve stale data for a bounded time."""
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # token -> (TokenEntry, stored_at)
+        self._tokens_by_guest = {}  # guest_id -> set of cached tokens
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Return the cached TokenEntry for token or None on a miss (absent or expired)."""
+        with self._lock:
+            item = self._entries.get(token)
+            if item is not None and time.monotonic() - item[1] < self.ttl:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                self._discard(token)
+            self.misses += 1
+            return None
+
+    def set(self, token, entry):
+        with self._lock:
+            self._discard(token)
+            self._entries[token] = (entry, time.monotonic())
+            self._tokens_by_guest.setdefault(entry.guest_id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, token):
+        with self._lock:
+            self._discard(token)
+
+    def invalidate_guest(self, guest_id):
+        """Drop every cached token belonging to guest_id."""
+        with self._lock:
+            for token in list(self._tokens_by_guest.get(guest_id, ())):
+                self._discard(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_guest.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _discard(self, token):
+        """Remove token from both indexes. Caller must hold the lock."""
+        item = self._entries.pop(token, None)
+        if item is None:
+            return
+        tokens = self._tokens_by_guest.get(item[0].guest_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_guest[item[0].guest_id]
+
+
+def _build_token_cache():
+    options = getattr(settings, 'GUEST_TOKEN_CACHE', {})
+    return GuestTokenCache(max_size=options.get('MAX_SIZE', 1024), ttl=options.get('TTL', 60))
+
+
+token_cache = _build_token_cache()
+
+
+def lookup_token(token):
+    """Return the TokenEntry for token, hitting the database (a single query, joined to the permission's
+    schedule by primary key) only on a cache miss. Returns None if no permission exists for the token."""
+    from .models import GuestPermission
+    from .schedules import CompiledSchedule
+
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry
+    try:
+        row = GuestPermission.objects.values_list('guest_id', 'starts_on', 'expires_on', 'once_off', 'site_id', 'id',
+                                                  'schedule__week', 'schedule__timezone',
+                                                  'schedule__excluded_dates').get(token=token)
+    except GuestPermission.DoesNotExist:
+        return None
+    week, timezone, excluded_dates = row[6:]
+    entry = TokenEntry(*row[:4], schedule=CompiledSchedule(week, timezone, excluded_dates) if timezone else None,
+                       site_id=row[4], permission_id=row[5])
+    token_cache.set(token, entry)
+    return entry
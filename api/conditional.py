@@ -0,0 +1,50 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+from .models import ACTIVITY_DELETIONS, Watermark
+
+
+class ConditionalGetMixin(object):
+    """Answers GET with 304 Not Modified when If-None-Match carries the current ETag, before any list or
+    serializer work. The ETag hashes the request path and query string, the negotiated media type and
+    get_fingerprint() - a few cheap aggregates that change whenever the response would. The fingerprint
+    is taken before the response is built, so a concurrent write can at worst cause a needless re-fetch,
+    never a stale 304."""
+
+    def get_fingerprint(self):
+        """Aggregates that change with the data behind this response. Defaults to max(updated_at) and count
+        of the filtered queryset for lists and to the object's updated_at for details."""
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.lookup_url_kwarg in self.kwargs or self.lookup_field in self.kwargs:
+            lookup = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+            return list(queryset.filter(**{self.lookup_field: lookup}).values_list('updated_at', flat=True))
+        return queryset.order_by().aggregate(changed=Max('updated_at'), count=Count('pk'))
+
+    def get_etag(self, request):
+        parts = (type(self).__name__, request.get_full_path(), request.accepted_media_type, repr(self.get_fingerprint()))
+        return quote_etag(hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+
+class ConditionalActivityMixin(ConditionalGetMixin):
+    """Conditional GET for the append-only activity listings: rows are never updated, so the filtered
+    max(id) (of every database the view reads) changes with every insert, and the ACTIVITY_DELETIONS
+    watermark with every purge, archive run or cascade that removes rows. Avoids COUNT(*) over the
+    activity table."""
+
+    def get_fingerprint(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        partitions = self.get_partitions(queryset) if hasattr(self, 'get_partitions') else [queryset]
+        return ([partition.order_by().aggregate(last=Max('id'))['last'] for partition in partitions],
+                Watermark.objects.filter(name=ACTIVITY_DELETIONS).values_list('position', flat=True).first())
@@ -0,0 +1,94 @@
+import csv
+import json
+
+from django.conf import settings
+from rest_framework import renderers, serializers
+from .pagination import seek
+from .sites import fetch, merge
+
+EXPORT_FIELDS = ('id', 'date', 'gate_status', 'responsible_user_id', 'responsible_user',
+                 'responsible_guest_id', 'responsible_guest', 'gate_id', 'site_id')
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """Only used for content negotiation (Accept header, ?format=ndjson or .ndjson suffix) - export
+    responses are streamed by the view itself."""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode(self.charset)
+
+
+class CSVRenderer(NDJSONRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+# columns read for each exported (or streamed) row, in the order activity_row unpacks them
+ACTIVITY_COLUMNS = ('id', 'date', 'gate_status', 'responsible_user_id', 'responsible_user__username',
+                    'responsible_guest_id', 'responsible_guest__first_name', 'responsible_guest__surname',
+                    'gate_id', 'site_id')
+
+
+def activity_row(values, date_field=serializers.DateTimeField()):
+    """Dict with EXPORT_FIELDS from a tuple of ACTIVITY_COLUMNS values."""
+    pk, date, status, user_id, username, guest_id, first_name, surname, gate_id, site_id = values
+    return {
+        'id': pk,
+        'date': date_field.to_representation(date),
+        'gate_status': status,
+        'responsible_user_id': user_id,
+        'responsible_user': username,
+        'responsible_guest_id': guest_id,
+        'responsible_guest': "{0} {1}".format(first_name, surname) if guest_id else None,
+        'gate_id': gate_id,
+        'site_id': site_id,
+    }
+
+
+def _iter_values(queryset, chunk_size):
+    queryset = queryset.order_by('date', 'id').values_list(*ACTIVITY_COLUMNS)
+    position = None
+    while True:
+        chunk = fetch(seek(queryset, position, newer=True) if position else queryset, chunk_size)
+        for values in chunk:
+            yield values
+        if len(chunk) < chunk_size:
+            return
+        position = (chunk[-1][1], chunk[-1][0])
+
+
+def iter_activity(queryset, chunk_size=None, archived=()):
+    """Yield GateActivity rows of queryset oldest first as dicts with EXPORT_FIELDS, joined with the
+    responsible user's username and guest's name. queryset may also be a list of querysets, one per
+    activity database (see api.sites.partitions), whose rows are merged, as are those of archived: tuples
+    of ACTIVITY_COLUMNS values read back from the archive, oldest first (see api.archive). Rows are read in keyset chunks
+    of chunk_size (each a short index range scan), so memory stays flat however large the table is and
+    no cursor or transaction is held open between chunks."""
+    chunk_size = chunk_size or getattr(settings, 'ACTIVITY_EXPORT_CHUNK_SIZE', 2000)
+    querysets = queryset if isinstance(queryset, list) else [queryset]
+    rows = merge(([archived] if archived else []) + [_iter_values(partition, chunk_size) for partition in querysets],
+                 key=lambda values: (values[1], values[0]))
+    for values in rows:
+        yield activity_row(values)
+
+
+class _Echo(object):
+    """File-like object whose write returns the written line, letting csv.writer feed a generator."""
+
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([row[field] for field in EXPORT_FIELDS])
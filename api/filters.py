@@ -0,0 +1,27 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import exceptions
+from rest_framework.filters import BaseFilterBackend
+
+
+def parse_instant(value, param):
+    """Parse an ISO 8601 query param into an aware datetime, raising a 400 on bad input."""
+    instant = parse_datetime(value)
+    if instant is None:
+        raise exceptions.ValidationError(detail={param: "Expected an ISO 8601 date/time."})
+    if timezone.is_naive(instant):
+        instant = timezone.make_aware(instant)
+    return instant
+
+
+class DateWindowFilter(BaseFilterBackend):
+    """Restrict a GateActivity queryset to the half-open window [since, until) given as query params."""
+
+    def filter_queryset(self, request, queryset, view):
+        since = request.query_params.get('since')
+        until = request.query_params.get('until')
+        if since:
+            queryset = queryset.filter(date__gte=parse_instant(since, 'since'))
+        if until:
+            queryset = queryset.filter(date__lt=parse_instant(until, 'until'))
+        return queryset
@@ -0,0 +1,99 @@
+import codecs
+import csv
+import json
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
+from .models import Guest
+from .serializers import GuestSerializer
+
+
+class GuestImportSerializer(GuestSerializer):
+    """Validates a single imported guest row. Uniqueness of mobile is checked per chunk by the importer
+    (one IN query) rather than by a UniqueValidator query per row."""
+    mobile = serializers.CharField(max_length=30)
+
+
+def detect_format(upload):
+    """Return 'csv' or 'ndjson' from the upload's file name or content type, or None if unknown."""
+    name = (upload.name or '').lower()
+    content_type = (upload.content_type or '').lower()
+    if name.endswith('.csv') or content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')) or content_type in ('application/x-ndjson', 'application/jsonl'):
+        return 'ndjson'
+    return None
+
+
+def iter_rows(upload, fmt):
+    """Lazily yield (row_number, dict) for each record of the uploaded file. The upload is read line by
+    line, so memory use does not depend on the file size. Undecodable NDJSON lines are yielded as
+    (row_number, None)."""
+    lines = codecs.iterdecode(upload, 'utf-8-sig')
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(lines), 1):
+            yield number, row
+        return
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def import_guests(rows, created_by, batch_size):
+    """Validate and insert guests from the (row_number, dict) iterable rows, batch_size rows at a time:
+    one IN query to find mobiles already taken plus one bulk INSERT per batch. Returns a report dict
+    with the number of guests created and a list of per-row errors."""
+    report = {'created': 0, 'errors': []}
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return report
+        valid = []
+        for number, row in chunk:
+            if row is None:
+                report['errors'].append({'row': number, 'errors': {'non_field_errors': ["Malformed record."]}})
+                continue
+            serializer = GuestImportSerializer(data=row)
+            if serializer.is_valid():
+                valid.append((number, serializer.validated_data))
+            else:
+                report['errors'].append({'row': number, 'errors': serializer.errors})
+
+        taken = set(Guest.objects.filter(mobile__in=[data['mobile'] for _, data in valid])
+                    .values_list('mobile', flat=True))
+        guests = []
+        for number, data in valid:
+            if data['mobile'] in taken:
+                report['errors'].append({'row': number, 'errors': {'mobile': ["guest with this mobile already exists."]}})
+                continue
+            taken.add(data['mobile'])  # also rejects repeats within the chunk
+            guests.append((number, Guest(created_by=created_by, **data)))
+        report['created'] += _insert(guests, report['errors'])
+
+
+def _insert(guests, errors):
+    """bulk_create the (row_number, Guest) pairs. If a concurrent writer claimed one of the mobiles after
+    our IN check, fall back to inserting the batch row by row so only the conflicting rows fail."""
+    try:
+        with transaction.atomic():
+            Guest.objects.bulk_create([guest for _, guest in guests])
+        return len(guests)
+    except IntegrityError:
+        created = 0
+        for number, guest in guests:
+            try:
+                with transaction.atomic():
+                    guest.save()
+                created += 1
+            except IntegrityError:
+                errors.append({'row': number, 'errors': {'mobile': ["guest with this mobile already exists."]}})
+        return created
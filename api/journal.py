@@ -0,0 +1,222 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, router, transaction
+from django.utils.dateparse import parse_datetime
+from . import presence, rollups, sites
+from .models import GateActivity, IngestedBatch
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.journal'
+
+
+class ActivityJournal(object):
+    """Write-behind log for GateActivity rows. Each row is appended (and by default fsync'ed) to a segment
+    file in `directory` and buffered in memory; a background thread bulk_creates the buffer once it holds
+    `flush_size` rows or every `flush_interval` seconds.
+
+    Every process writes its own segment and holds an exclusive flock on it until the rows in it are
+    committed. Segments left behind by a crashed process are therefore unlocked and are replayed by the
+    next journal opened on the same directory (or by `manage.py replay_activity_journal`). A segment is
+    committed together with a marker row, so a crash between the commit and the removal of the file
+    cannot ingest it twice."""
+
+    def __init__(self, directory, flush_size=500, flush_interval=1.0, fsync=True, start_flusher=True):
+        self.directory = directory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._buffer = []
+        self._pending = []  # rotated segments whose commit failed: (path, fd, rows)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._fd, self._path = self._open_segment()
+        if start_flusher:
+            thread = threading.Thread(target=self._run, name='activity-journal-flusher')
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.flush)
+
+    def record(self, activity):
+        """Durably journal the unsaved GateActivity activity and queue it for insertion."""
+        row = {
+            'date': activity.date.isoformat(),
+            'responsible_user_id': activity.responsible_user_id,
+            'responsible_guest_id': activity.responsible_guest_id,
+            'gate_id': activity.gate_id,
+            'site_id': activity.site_id,
+            'gate_status': activity.gate_status,
+        }
+        line = (json.dumps(row) + '\n').encode('utf-8')
+        with self._lock:
+            os.write(self._fd, line)
+            if self.fsync:
+                os.fsync(self._fd)
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.flush_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Rotate the current segment and insert its rows. Returns the number of rows inserted."""
+        with self._lock:
+            if self._buffer:
+                self._pending.append((self._path, self._fd, self._buffer))
+                self._buffer = []
+                self._fd, self._path = self._open_segment()
+            pending, self._pending = self._pending, []
+        flushed = 0
+        for index, (path, fd, rows) in enumerate(pending):
+            try:
+                flushed += commit_segment(path, rows)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = pending[index:]  # retried on the next flush
+                raise
+            os.close(fd)
+        return flushed
+
+    def replay(self):
+        """Ingest every segment in the directory that no live process holds. Returns the number of rows."""
+        replayed = 0
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(SUFFIX) or path == self._path:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # committed by its owner in the meantime
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue  # a live process is still writing to it
+            try:
+                if os.path.exists(path):
+                    replayed += commit_segment(path, read_segment(path))
+            finally:
+                os.close(fd)
+        return replayed
+
+    def close(self):
+        """Flush, then remove the (now empty) current segment. The journal cannot record afterwards."""
+        self.flush()
+        with self._lock:
+            os.remove(self._path)
+            os.close(self._fd)
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer) + sum(len(rows) for _, _, rows in self._pending)
+
+    def _open_segment(self):
+        """Create and lock a fresh segment. It only gets its final name once locked, so replay can never
+        pick up a segment that its owner has not locked yet."""
+        stem = '{0}-{1}'.format(os.getpid(), uuid4().hex[:16])
+        temp = os.path.join(self.directory, stem + '.new')
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        path = os.path.join(self.directory, stem + SUFFIX)
+        os.rename(temp, path)
+        return fd, path
+
+    def _run(self):
+        close_old_connections()
+        try:
+            self.replay()
+        except Exception:
+            logger.exception("Replaying the activity journal failed")
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing the activity journal failed, will retry")
+
+
+def read_segment(path):
+    """Parse a segment's rows, ignoring a torn last line from a crash mid-write."""
+    rows = []
+    with open(path, 'rb') as segment:
+        for line in segment:
+            try:
+                rows.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                break
+    return rows
+
+
+def commit_segment(path, rows):
+    """Insert rows (and count them into the rollups and presence) in one transaction together with a marker
+    for the segment - rows for site databases with a marker of their own there, see api.sites.bulk_create -
+    then delete the segment file and the markers. Returns the number of rows inserted."""
+    marker = 'journal:' + os.path.basename(path)[:-len(SUFFIX)]
+    inserted = 0
+    with transaction.atomic():
+        if not IngestedBatch.objects.filter(key=marker).exists():
+            # segments written before gates and sites existed have no gate_id/site_id
+            activities = [GateActivity(date=parse_datetime(row['date']), responsible_user_id=row['responsible_user_id'],
+                                       responsible_guest_id=row['responsible_guest_id'], gate_id=row.get('gate_id'),
+                                       site_id=row.get('site_id'), gate_status=row['gate_status'])
+                          for row in rows]
+            sites.bulk_create(activities, marker)
+            if rollups.rollup_mode() == 'save':
+                rollups.apply(activities)
+            presence.apply(activities)
+            IngestedBatch.objects.create(key=marker, rows=len(rows))
+            inserted = len(rows)
+    os.remove(path)
+    sites.forget_batch(marker)
+    return inserted
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def write_behind_options():
+    return getattr(settings, 'ACTIVITY_WRITE_BEHIND', {})
+
+
+def get_journal():
+    """The process-wide journal, created (and its flusher started) on first use."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            options = write_behind_options()
+            _journal = ActivityJournal(options['DIR'], flush_size=options.get('FLUSH_SIZE', 500),
+                                       flush_interval=options.get('FLUSH_INTERVAL', 1.0),
+                                       fsync=options.get('FSYNC', True))
+        return _journal
+
+
+def log_activity(**fields):
+    """Log a gate interaction. With ACTIVITY_WRITE_BEHIND enabled the row is journaled and inserted later,
+    so the returned GateActivity has no id yet; otherwise it is inserted right away, in one transaction with
+    the rollup and presence updates of its post_save handlers (which run on the default database, so a row
+    for a site database is inserted in a transaction there as well). Inside a caller's transaction no
+    savepoint is taken: a failure rolls back the caller's transaction."""
+    activity = GateActivity(**fields)
+    if write_behind_options().get('ENABLED'):
+        get_journal().record(activity)
+        return activity
+    alias = router.db_for_write(GateActivity, instance=activity)
+    with transaction.atomic(savepoint=False):
+        if alias == DEFAULT_DB_ALIAS:
+            activity.save(force_insert=True)
+        else:
+            with transaction.atomic(using=alias, savepoint=False):
+                activity.save(force_insert=True)
+    return activity
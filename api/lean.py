@@ -0,0 +1,38 @@
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+
+def lean_enabled():
+    return getattr(settings, 'LEAN_ACTIVITY_LISTS', False)
+
+
+class LeanListMixin(object):
+    """Opt-in (LEAN_ACTIVITY_LISTS) read path for the activity listings: each page is read as values_list
+    tuples, with related usernames joined in the same query, and turned into plain dicts in the
+    serializer's field order, skipping the per-row serializer machinery (field lookups, attribute
+    traversal, OrderedDicts). The JSON sent is byte-for-byte that of the serializer path. Only taken
+    for JSON responses - the browsable API still goes through the serializer - and only for serializers
+    whose fields are model columns, related lookups, primary keys or datetimes. Relies on the cursor
+    pagination accepting tuples that start with (id, date)."""
+
+    def get_lean_layout(self):
+        """[(field name, values_list column, to_representation or None)] for the serializer's fields."""
+        layout = []
+        for name, field in self.get_serializer().fields.items():
+            if field.write_only:
+                continue
+            convert = field.to_representation if isinstance(field, serializers.DateTimeField) else None
+            layout.append((name, field.source.replace('.', '__'), convert))
+        return layout
+
+    def list(self, request, *args, **kwargs):
+        if not lean_enabled() or not isinstance(request.accepted_renderer, JSONRenderer):
+            return super(LeanListMixin, self).list(request, *args, **kwargs)
+        layout = self.get_lean_layout()
+        columns = ['id', 'date'] + [column for _, column, _ in layout]
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()).values_list(*columns))
+        fields = [(name, index, convert) for index, (name, _, convert) in enumerate(layout, 2)]
+        rows = [{name: convert(row[index]) if convert else row[index] for name, index, convert in fields}
+                for row in page]
+        return self.get_paginated_response(rows)
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import archive
+
+
+class Command(BaseCommand):
+    help = ("Move the gate activity older than --days (default ACTIVITY_ARCHIVE['HORIZON_DAYS']) out of every "
+            "activity database into compressed day files under ACTIVITY_ARCHIVE['DIR'], which the activity "
+            "listings and the export read back. Safe to interrupt and run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Archive activity older than this many days.")
+        parser.add_argument('--batch-size', type=int, help="Rows per delete (default ACTIVITY_ARCHIVE['BATCH_SIZE']).")
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = archive.archive_options().get('HORIZON_DAYS', 365)
+        moved = archive.archive(timezone.now() - timedelta(days=days), batch_size=options['batch_size'])
+        self.stdout.write("Archived {0} activity rows.".format(moved))
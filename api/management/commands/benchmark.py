@@ -0,0 +1,27 @@
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+from api.benchmarks import test_database
+
+BENCHMARKS = ('activity_lists', 'activity_logging', 'authentication', 'guest_search', 'metrics', 'permissions', 'replay')
+
+
+class Command(BaseCommand):
+    help = "Run an api benchmark against a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=BENCHMARKS)
+        parser.add_argument('--count', type=int, default=None, help="Problem size, benchmark specific.")
+        parser.add_argument('--scale', type=float, default=None,
+                            help="replay: fixture volume relative to 100k guests / 1M permissions / 50M activity rows.")
+        parser.add_argument('--seed', type=int, default=None, help="replay: seed of fixtures and generated traffic.")
+        parser.add_argument('--traffic', default=None,
+                            help="replay: NDJSON file of requests to replay; recorded there if it does not exist.")
+        parser.add_argument('--output', default=None, help="replay: also save the report to this JSON file.")
+
+    def handle(self, *args, **options):
+        module = import_module('api.benchmarks.{0}'.format(options['name']))
+        kwargs = {key: options[key] for key in ('count', 'scale', 'seed', 'traffic', 'output')
+                  if options[key] is not None}
+        with test_database():
+            module.run(self.stdout, **kwargs)
@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+from api.models import Device
+
+
+class Command(BaseCommand):
+    help = "Register a gate controller acting on behalf of a user and print its key id and secret."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('name')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError("No user named {0}".format(options['username']))
+        device = Device.objects.create(name=options['name'], user=user, key_id=get_random_string(length=20),
+                                       secret=get_random_string(length=48))
+        self.stdout.write("key id: {0}\nsecret: {1}".format(device.key_id, device.secret))
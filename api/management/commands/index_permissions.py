@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api import active
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the active-permission index (api.active) from the permission windows, e.g. after rows "
+            "were loaded or changed without the model signals.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help="Permissions indexed per query.")
+
+    def handle(self, *args, **options):
+        indexed = active.rebuild(batch_size=options['batch_size'])
+        self.stdout.write("Indexed the windows of {0} guest permissions.".format(indexed))
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import sync
+
+
+class Command(BaseCommand):
+    help = ("Drop permission change log entries older than --days. Gate controllers synced to an older version "
+            "are told to re-fetch the full permission bundle. Also forgets the offline uploads received more "
+            "than --batch-days ago.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--batch-days', type=int, default=7,
+                            help="Keep the markers of offline uploads (which stop retries being ingested twice) this long.")
+
+    def handle(self, *args, **options):
+        version = sync.prune_changes(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write("Change log now starts after version {0}.".format(version))
+        pruned = sync.prune_batches(timezone.now() - timedelta(days=options['batch_days']))
+        self.stdout.write("Forgot {0} offline uploads.".format(pruned))
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api import purge
+from api.models import PurgeJob
+
+
+class Command(BaseCommand):
+    help = ("Run the pending purge jobs (deleted guests' history, expired permissions) and those abandoned by a "
+            "worker that died, in this process. With --expired-days, first queue a purge of the permissions "
+            "that expired more than that many days ago.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expired-days', type=int, help="Queue a purge of permissions expired this many days ago.")
+        parser.add_argument('--retry-failed', action='store_true', help="Run failed jobs again, from where they stopped.")
+        parser.add_argument('--chunk-size', type=int, help="Rows deleted per transaction (default PURGE['CHUNK_SIZE']).")
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            retried = PurgeJob.objects.filter(state=PurgeJob.FAILED).update(state=PurgeJob.PENDING, error='')
+            self.stdout.write("Retrying {0} failed purge jobs.".format(retried))
+        if options['expired_days'] is not None:
+            job = purge.purge_expired_permissions(timezone.now() - timedelta(days=options['expired_days']), start=False)
+            self.stdout.write("Queued purge job {0}.".format(job.pk))
+        ran = purge.run_pending(chunk_size=options['chunk_size'])
+        self.stdout.write("Ran {0} purge jobs.".format(ran))
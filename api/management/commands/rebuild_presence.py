@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api import presence
+
+
+class Command(BaseCommand):
+    help = ("Recompute who is on site from the whole gate activity log in one streaming pass and replace the "
+            "presence table with the result.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Presence rows inserted per query.")
+
+    def handle(self, *args, **options):
+        read = presence.rebuild(chunk_size=options['chunk_size'])
+        counts = presence.headcount()
+        self.stdout.write("Read {0} gate interactions: {1} users and {2} guests on site.".format(
+            read, counts['users'], counts['guests']))
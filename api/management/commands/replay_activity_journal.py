@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from api.journal import ActivityJournal, write_behind_options
+
+
+class Command(BaseCommand):
+    help = "Insert the gate interactions of write-behind journal segments left behind by dead processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help="Journal directory (default: ACTIVITY_WRITE_BEHIND['DIR']).")
+
+    def handle(self, *args, **options):
+        journal = ActivityJournal(options['dir'] or write_behind_options()['DIR'], start_flusher=False)
+        try:
+            replayed = journal.replay()
+        finally:
+            journal.close()
+        self.stdout.write("Replayed {0} gate interactions.".format(replayed))
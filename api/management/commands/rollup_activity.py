@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import rollups
+
+
+class Command(BaseCommand):
+    help = ("Fold GateActivity rows past the rollup watermark into the activity rollups (ACTIVITY_ROLLUP_MODE "
+            "= 'batch'), or recompute the rollups from the whole log with --rebuild.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="Recompute all rollups from scratch.")
+        parser.add_argument('--batch-size', type=int, default=50000, help="Activity ids folded per query.")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            folded = rollups.rebuild()
+        elif rollups.rollup_mode() != 'batch':
+            raise CommandError("Rollups are maintained on save (ACTIVITY_ROLLUP_MODE = 'save'); "
+                               "catching up would count rows twice. Use --rebuild to recompute them.")
+        else:
+            folded = rollups.catch_up(batch_size=options['batch_size'])
+        self.stdout.write("Folded {0} gate interactions into the rollups.".format(folded))
@@ -0,0 +1,226 @@
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+# (name, help, unit) of the per-view histograms; durations are recorded in microseconds
+METRICS = (
+    ('request_duration_seconds', "Total time spent in Django per request.", 1e-6),
+    ('db_duration_seconds', "Time spent executing database queries per request.", 1e-6),
+    ('serialize_duration_seconds', "Time spent in the view outside the database (mostly serializers) per request.", 1e-6),
+    ('render_duration_seconds', "Time spent rendering the response per request.", 1e-6),
+    ('db_queries', "Database queries issued per request.", 1),
+)
+# `le` bounds of the exported buckets, in each metric's exported unit
+DURATION_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BOUNDS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def metrics_options():
+    return getattr(settings, 'PERFORMANCE_METRICS', {})
+
+
+class Histogram(object):
+    """HDR-style histogram of non-negative integers. Values below 2**sub_bits are counted exactly, larger
+    ones in 2**(sub_bits - 1) linear buckets per power of two, so any percentile is reported within a
+    relative error of 2**(1 - sub_bits) (~6%) in a few hundred buckets at most, at O(1) per value."""
+
+    def __init__(self, sub_bits=5):
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+
+    def index(self, value):
+        if value < 1 << self.sub_bits:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        half = 1 << (self.sub_bits - 1)
+        return (1 << self.sub_bits) + (shift - 1) * half + (value >> shift) - half
+
+    def highest(self, index):
+        """Largest value counted in bucket index."""
+        if index < 1 << self.sub_bits:
+            return index
+        half = 1 << (self.sub_bits - 1)
+        shift, sub = divmod(index - (1 << self.sub_bits), half)
+        return ((sub + half + 1) << (shift + 1)) - 1
+
+    def record(self, value):
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile (nearest rank), or 0 when empty."""
+        rank = max(1, -(-self.count * pct // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.highest(index)
+        return 0
+
+    def cumulative(self, bounds):
+        """Number of values at or below each of bounds, a bucket counting as its largest value."""
+        result = [0] * len(bounds)
+        for index, count in self.counts.items():
+            value = self.highest(index)
+            for position, bound in enumerate(bounds):
+                if value <= bound:
+                    result[position] += count
+        return result
+
+
+class MetricsRegistry(object):
+    """Per-view histograms of the METRICS, kept in process memory. Every worker process keeps (and
+    exposes) its own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, view, values):
+        """Record a request to view; values maps metric names to integers in recorded units."""
+        with self._lock:
+            for name, value in values.items():
+                histogram = self._histograms.get((name, view))
+                if histogram is None:
+                    histogram = self._histograms[(name, view)] = Histogram()
+                histogram.record(value)
+
+    def histogram(self, name, view):
+        return self._histograms.get((name, view))
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def prometheus(self, prefix='api_'):
+        """The histograms in Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            for name, help_text, unit in METRICS:
+                views = sorted(view for metric, view in self._histograms if metric == name)
+                if not views:
+                    continue
+                lines.append('# HELP {0}{1} {2}'.format(prefix, name, help_text))
+                lines.append('# TYPE {0}{1} histogram'.format(prefix, name))
+                bounds = QUERY_BOUNDS if unit == 1 else DURATION_BOUNDS
+                for view in views:
+                    histogram = self._histograms[(name, view)]
+                    counts = histogram.cumulative([int(round(bound / unit)) for bound in bounds])
+                    for bound, count in zip(bounds, counts):
+                        lines.append('{0}{1}_bucket{{view="{2}",le="{3}"}} {4}'.format(prefix, name, view, bound, count))
+                    lines.append('{0}{1}_bucket{{view="{2}",le="+Inf"}} {3}'.format(prefix, name, view, histogram.count))
+                    lines.append('{0}{1}_sum{{view="{2}"}} {3}'.format(prefix, name, view, histogram.total * unit))
+                    lines.append('{0}{1}_count{{view="{2}"}} {3}'.format(prefix, name, view, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+_local = threading.local()
+
+
+class RequestTimer(object):
+    __slots__ = ('started', 'queries', 'db', 'view_started', 'view_db', 'render_started')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.view_started = self.view_db = self.render_started = None
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """Wraps the cursor a connection would hand out and adds the time of every query to the timer of the
+    request being served by this thread, if any."""
+
+    def execute(self, sql, params=None):
+        start = perf_counter()
+        try:
+            return super(TimedCursorWrapper, self).execute(sql, params)
+        finally:
+            _count_query(start)
+
+    def executemany(self, sql, param_list):
+        start = perf_counter()
+        try:
+            return super(TimedCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            _count_query(start)
+
+
+def _count_query(start):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.queries += 1
+        timer.db += perf_counter() - start
+
+
+def _install_cursor_timing():
+    """Have every connection of this thread hand out TimedCursorWrapper cursors (once per connection)."""
+    for connection in connections.all():
+        if getattr(connection, 'timed_cursors', False):
+            continue
+        make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+        connection.make_cursor = lambda cursor, db=connection: TimedCursorWrapper(make_cursor(cursor), db)
+        connection.make_debug_cursor = lambda cursor, db=connection: TimedCursorWrapper(make_debug_cursor(cursor), db)
+        connection.timed_cursors = True
+
+
+class PerformanceMiddleware(object):
+    """Times every request per URL name: total latency, query count and time, time in the view outside the
+    database and response rendering. The timings are added to the `registry` histograms (exposed at
+    api/metrics/) and, with SERVER_TIMING on, sent back in a Server-Timing header. Disabled by
+    PERFORMANCE_METRICS['ENABLED']. Should come first in MIDDLEWARE so that the total covers the rest.
+    For streaming responses only the time until the stream starts is covered."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        options = metrics_options()
+        if not options.get('ENABLED', True):
+            return self.get_response(request)
+        _install_cursor_timing()
+        timer = _local.timer = RequestTimer()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.timer = None
+        ended = perf_counter()
+
+        view_ended = timer.render_started or ended
+        view_db = timer.db - (timer.view_db or 0.0)
+        serialize = view_ended - timer.view_started - view_db if timer.view_started is not None else 0.0
+        render = ended - timer.render_started if timer.render_started is not None else 0.0
+        total = ended - timer.started
+        match = request.resolver_match
+        registry.observe(match.url_name if match and match.url_name else 'unmatched', {
+            'request_duration_seconds': int(total * 1e6),
+            'db_duration_seconds': int(timer.db * 1e6),
+            'serialize_duration_seconds': int(max(serialize, 0.0) * 1e6),
+            'render_duration_seconds': int(render * 1e6),
+            'db_queries': timer.queries,
+        })
+        if options.get('SERVER_TIMING', True):
+            response['Server-Timing'] = (
+                'db;dur={0:.3f};desc="{1} queries", serialize;dur={2:.3f}, render;dur={3:.3f}, total;dur={4:.3f}'
+                .format(timer.db * 1000, timer.queries, max(serialize, 0.0) * 1000, render * 1000, total * 1000))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = getattr(_local, 'timer', None)
+        if timer is not None:
+            timer.view_started = perf_counter()
+            timer.view_db = timer.db  # queries before the view (sessions etc.) are not the view's
+
+    def process_template_response(self, request, response):
+        timer = getattr(_local, 'timer', None)
+        if timer is not None:
+            timer.render_started = perf_counter()
+        return response
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_auto_20170802_1355'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gateactivity',
+            index=models.Index(fields=['date', 'id'], name='activity_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+PARTIAL_INDEXES = (
+    ('activity_user_only_date_idx', 'responsible_user_id'),
+    ('activity_guest_only_date_idx', 'responsible_guest_id'),
+)
+
+
+def create_partial_indexes(apps, schema_editor):
+    """Index only user (resp. guest) rows by date for the per-kind activity listings. MySQL has no
+    partial indexes, so there those listings walk activity_date_id_idx instead."""
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, column in PARTIAL_INDEXES:
+        schema_editor.execute('CREATE INDEX {0} ON api_gateactivity (date, id) WHERE {1} IS NOT NULL'.format(name, column))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, column in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {0}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_gateactivity_date_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gateactivity',
+            index=models.Index(fields=['responsible_user', 'date', 'id'], name='activity_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gateactivity',
+            index=models.Index(fields=['responsible_guest', 'date', 'id'], name='activity_guest_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='guestpermission',
+            index=models.Index(fields=['guest', 'expires_on'], name='permission_guest_expiry_idx'),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:12
+from __future__ import unicode_literals
+
+import api.models
+from django.db import migrations
+
+KEYS = ['name_key', 'surname_key', 'mobile_key']
+
+
+def fill_search_keys(apps, schema_editor):
+    """Compute the keys of existing guests; SearchKeyField.pre_save derives them on save."""
+    Guest = apps.get_model('api', 'Guest')
+    guests = Guest.objects.using(schema_editor.connection.alias).order_by('id')
+    last = 0
+    while True:
+        chunk = list(guests.filter(id__gt=last)[:1000])
+        for guest in chunk:
+            guest.save(update_fields=KEYS)
+        if len(chunk) < 1000:
+            return
+        last = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guest',
+            name='mobile_key',
+            field=api.models.SearchKeyField(db_index=True, default='', editable=False, max_length=30, normalizer='mobile', sources=('mobile',)),
+        ),
+        migrations.AddField(
+            model_name='guest',
+            name='name_key',
+            field=api.models.SearchKeyField(db_index=True, default='', editable=False, max_length=255, normalizer='name', sources=('first_name', 'surname')),
+        ),
+        migrations.AddField(
+            model_name='guest',
+            name='surname_key',
+            field=api.models.SearchKeyField(db_index=True, default='', editable=False, max_length=255, normalizer='name', sources=('surname',)),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+    ]
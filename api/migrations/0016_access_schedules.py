@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:19
+from __future__ import unicode_literals
+
+import api.models
+import api.schedules
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0015_purge_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('rules', models.CharField(max_length=500, validators=[api.schedules.validate_rules])),
+                ('timezone', models.CharField(default=api.schedules.default_timezone, max_length=64, validators=[api.schedules.validate_timezone])),
+                ('excluded_dates', models.TextField(blank=True, validators=[api.schedules.validate_dates])),
+                ('week', api.models.WeekBitmapField(default=b'', source='rules')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access_schedules', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='guestpermission',
+            name='schedule',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='permissions', to='api.AccessSchedule'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:22
+from __future__ import unicode_literals
+
+from api import active
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_permissions(apps, schema_editor):
+    """Index the windows of existing permissions; later writes are indexed by a post_save signal."""
+    alias = schema_editor.connection.alias
+    PermissionSpan = apps.get_model('api', 'PermissionSpan')
+    permissions = (apps.get_model('api', 'GuestPermission').objects.using(alias).order_by('id')
+                   .values_list('id', 'guest_id', 'starts_on', 'expires_on'))
+    last = 0
+    while True:
+        chunk = list(permissions.filter(id__gt=last)[:1000])
+        active.index(chunk, PermissionSpan, alias)
+        if len(chunk) < 1000:
+            return
+        last = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_access_schedules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PermissionSpan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField(db_index=True)),
+                ('starts_on', models.DateTimeField()),
+                ('expires_on', models.DateTimeField()),
+                ('guest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.Guest')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.GuestPermission')),
+            ],
+        ),
+        migrations.RunPython(index_permissions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:33
+from __future__ import unicode_literals
+
+import api.sites
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0018_presence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Gate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Site',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('code', models.SlugField(unique=True)),
+                ('database', models.CharField(blank=True, max_length=100, validators=[api.sites.validate_database])),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='gateactivity',
+            name='responsible_guest',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='gate_interactions', to='api.Guest'),
+        ),
+        migrations.AlterField(
+            model_name='gateactivity',
+            name='responsible_user',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='gate_interactions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='gate',
+            name='site',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='gates', to='api.Site'),
+        ),
+        migrations.AddField(
+            model_name='activityrollup',
+            name='site',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.Site'),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='gate',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='devices', to='api.Gate'),
+        ),
+        migrations.AddField(
+            model_name='gateactivity',
+            name='gate',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.Gate'),
+        ),
+        migrations.AddField(
+            model_name='gateactivity',
+            name='site',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.Site'),
+        ),
+        migrations.AddField(
+            model_name='guestpermission',
+            name='site',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='permissions', to='api.Site'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activityrollup',
+            unique_together=set([('period', 'bucket', 'site', 'responsible_user', 'responsible_guest', 'gate_status')]),
+        ),
+        migrations.AddIndex(
+            model_name='gateactivity',
+            index=models.Index(fields=['site', 'date', 'id'], name='activity_site_date_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 13:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def move_offline_markers(apps, schema_editor):
+    """The offline batch markers used to be Watermark rows named offline:<sha1>."""
+    alias = schema_editor.connection.alias
+    Watermark = apps.get_model('api', 'Watermark')
+    IngestedBatch = apps.get_model('api', 'IngestedBatch')
+    markers = Watermark.objects.using(alias).filter(name__startswith='offline:')
+    IngestedBatch.objects.using(alias).bulk_create(
+        IngestedBatch(key=name, rows=position, received_on=updated_on)
+        for name, position, updated_on in markers.values_list('name', 'position', 'updated_on'))
+    markers.delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_sites_and_gates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=60, unique=True)),
+                ('rows', models.IntegerField(default=0)),
+                ('received_on', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.RunPython(move_offline_markers, migrations.RunPython.noop),
+    ]
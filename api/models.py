@@ -1,6 +1,69 @@
-from django.db import models
+import re
+import unicodedata
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.utils.crypto import get_random_string
+from . import schedules, sites
+
+TOKEN_LENGTH = 16
+
+
+def normalize_name(value):
+    """Search form of a name: accents stripped, lower case, single spaces ('Zoë  van der Merwe' ->
+    'zoe van der merwe')."""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.lower().split())
+
+
+def normalize_mobile(value):
+    """Search form of a phone number: digits only, with the South African country code (+27, 0027, or
+    27 in front of nine digits) written as the local 0. Also applies to typed prefixes ('+27 82' -> '082')."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    international = value.startswith('+') or digits.startswith('00')
+    if digits.startswith('00'):
+        digits = digits[2:]
+    if digits.startswith('27') and (international or len(digits) == 11):
+        digits = '0' + digits[2:]
+    return digits
+
+
+class SearchKeyField(models.CharField):
+    """Indexed, normalized copy of other fields of the row for prefix search, recomputed from them
+    whenever the row is saved or bulk created (but not by QuerySet.update())."""
+    normalizers = {'name': normalize_name, 'mobile': normalize_mobile}
+
+    def __init__(self, sources=(), normalizer='name', *args, **kwargs):
+        self.sources = tuple(sources)
+        self.normalizer = normalizer
+        kwargs.setdefault('max_length', 255)
+        kwargs.setdefault('db_index', True)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('default', '')
+        super(SearchKeyField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(SearchKeyField, self).deconstruct()
+        kwargs['sources'] = self.sources
+        kwargs['normalizer'] = self.normalizer
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = self.normalizers[self.normalizer](' '.join(getattr(model_instance, source) or '' for source in self.sources))
+        value = value[:self.max_length]
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class GuestQuerySet(models.QuerySet):
+
+    def alive(self):
+        """Guests that have not been (soft) deleted."""
+        return self.filter(deleted_on__isnull=True)
 
 
 class Guest(models.Model):
@@ -13,20 +76,80 @@ class Guest(models.Model):
     mobile = models.CharField(max_length=30, unique=True)
     created_by = models.ForeignKey('auth.User', related_name='created_guests', on_delete=models.CASCADE)
     created_on = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # prefix search (api.search): "first_name surname", surname and mobile in normalized form
+    name_key = SearchKeyField(sources=('first_name', 'surname'))
+    surname_key = SearchKeyField(sources=('surname',))
+    mobile_key = SearchKeyField(sources=('mobile',), normalizer='mobile', max_length=30)
+    # set when the guest is deleted; the row and its history are then removed in chunks by api.purge
+    deleted_on = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = GuestQuerySet.as_manager()
 
     def __str__(self):
         """Return string representation of model instance"""
         return "{0} {1}".format(self.first_name, self.surname)
 
 
+class Site(models.Model):
+    """A premises with gates of its own. Its gate activity is stored in `database` (one of the
+    SITE_DATABASES, or blank for the default database) - see api.sites and api.routers.SiteRouter."""
+    name = models.CharField(max_length=255)
+    code = models.SlugField(max_length=50, unique=True)
+    database = models.CharField(max_length=100, blank=True, validators=[sites.validate_database])
+
+    def __str__(self):
+        return self.name
+
+
+class Gate(models.Model):
+    """A gate at a site, opened by users, guests and the devices (controllers) attached to it."""
+    site = models.ForeignKey('Site', related_name='gates', on_delete=models.PROTECT)
+    name = models.CharField(max_length=255)
+
+    def __str__(self):
+        return "{0} ({1})".format(self.name, self.site)
+
+
+class GateActivityQuerySet(models.QuerySet):
+
+    def create(self, **kwargs):
+        """Insert the row into the database of its site (see api.routers.SiteRouter): QuerySet.create()
+        would route by model alone. A queryset pinned with using() still inserts there."""
+        if self._db is not None:
+            return super(GateActivityQuerySet, self).create(**kwargs)
+        activity = self.model(**kwargs)
+        activity.save(force_insert=True)
+        return activity
+
+
 class GateActivity(models.Model):
     """This model is used to log all interactions with the gate, especially the entity responsible
     for operating the gate at a certain date/time"""
-    date = models.DateTimeField(auto_now_add=True)
-    responsible_user = models.ForeignKey('auth.User', related_name='gate_interactions', on_delete=models.CASCADE, null=True, blank=True)
-    responsible_guest = models.ForeignKey('Guest', related_name='gate_interactions', on_delete=models.CASCADE, null=True, blank=True)
+    # not auto_now_add: rows replayed from the write-behind journal keep the time of the actual gate open
+    date = models.DateTimeField(default=timezone.now, editable=False)
+    # rows of sites with a database of their own live there, away from the rows they refer to, hence no
+    # foreign key constraints (see api.sites)
+    responsible_user = models.ForeignKey('auth.User', related_name='gate_interactions', on_delete=models.CASCADE, null=True, blank=True,
+                                         db_constraint=False)
+    responsible_guest = models.ForeignKey('Guest', related_name='gate_interactions', on_delete=models.CASCADE, null=True, blank=True,
+                                          db_constraint=False)
+    gate = models.ForeignKey('Gate', related_name='+', on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False)
+    site = models.ForeignKey('Site', related_name='+', on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False)
     gate_status = models.PositiveSmallIntegerField(choices=((1, 'HIGH'), (0, 'LOW')))
 
+    objects = GateActivityQuerySet.as_manager()
+
+    class Meta:
+        # (date, id) backs the keyset pagination of activity listings (see pagination.py), the others
+        # serve the same listings filtered by the responsible user/guest or the site
+        indexes = [
+            models.Index(fields=['date', 'id'], name='activity_date_id_idx'),
+            models.Index(fields=['responsible_user', 'date', 'id'], name='activity_user_date_idx'),
+            models.Index(fields=['responsible_guest', 'date', 'id'], name='activity_guest_date_idx'),
+            models.Index(fields=['site', 'date', 'id'], name='activity_site_date_idx'),
+        ]
+
     def __str__(self):
         if self.responsible_user:
             return "Interaction by {0} @ {1}".format(self.responsible_user.username, self.date)
@@ -34,6 +157,92 @@ class GateActivity(models.Model):
             return "Interaction by {0} {1} @ {2}".format(self.responsible_guest.first_name, self.responsible_guest.surname, self.date)
 
 
+class WeekBitmapField(models.BinaryField):
+    """The week bitmap (see api.schedules.compile_week) of the rules held in another field of the row,
+    recompiled from them whenever the row is saved or bulk created (but not by QuerySet.update())."""
+
+    def __init__(self, source='rules', *args, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('default', b'')
+        super(WeekBitmapField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(WeekBitmapField, self).deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = schedules.compile_week(schedules.parse_rules(getattr(model_instance, self.source)))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class AccessSchedule(models.Model):
+    """Recurring access times for guest permissions, e.g. 'mon-fri 07:00-17:00; sat 08:00-12:00' in the
+    given time zone, minus whole excluded dates (public holidays). A permission with a schedule only
+    admits its guest at the scheduled times within its starts_on/expires_on window."""
+    name = models.CharField(max_length=255)
+    rules = models.CharField(max_length=500, validators=[schedules.validate_rules])
+    timezone = models.CharField(max_length=64, default=schedules.default_timezone,
+                                validators=[schedules.validate_timezone])
+    excluded_dates = models.TextField(blank=True, validators=[schedules.validate_dates])
+    week = WeekBitmapField(source='rules')
+    created_by = models.ForeignKey('auth.User', related_name='access_schedules', on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def compiled(self):
+        return schedules.CompiledSchedule(self.week, self.timezone, self.excluded_dates)
+
+    def __str__(self):
+        return "{0} ({1})".format(self.name, self.rules)
+
+
+class GuestPermissionQuerySet(models.QuerySet):
+
+    def consume_once_off(self, permission_id, now):
+        """Mark the once-off permission permission_id as used in a single conditional UPDATE. Returns
+        True only for the caller whose UPDATE flipped the flag, so concurrent redemptions of the
+        same permission cannot both succeed."""
+        consumed = self.filter(id=permission_id, once_off=True, once_off_used=False, starts_on__lte=now,
+                               expires_on__gt=now).update(once_off_used=True, updated_at=now) == 1
+        if consumed:
+            PermissionChange.objects.record([permission_id])
+        return consumed
+
+    def unused_tokens(self, count):
+        """Return count fresh random tokens, distinct from each other and from every stored token, using
+        one IN query per round (a second round is only needed on a collision)."""
+        tokens = set()
+        while len(tokens) < count:
+            candidates = {get_random_string(length=TOKEN_LENGTH) for _ in range(count - len(tokens))} - tokens
+            tokens |= candidates - set(self.filter(token__in=candidates).values_list('token', flat=True))
+        return list(tokens)
+
+    def issue(self, guest_ids, granted_by, expires_on, starts_on=None, once_off=False, schedule=None, site=None, retries=3):
+        """Grant the same window to every guest in guest_ids with a single bulk INSERT in one transaction.
+        Returns the created permissions. A token claimed by a concurrent writer between the collision
+        check and the INSERT rolls the batch back and it is retried with new tokens."""
+        from . import active
+
+        starts_on = starts_on or timezone.now()
+        for attempt in range(retries):
+            permissions = [self.model(token=token, guest_id=guest_id, granted_by=granted_by, starts_on=starts_on,
+                                      expires_on=expires_on, once_off=once_off, schedule=schedule, site=site)
+                           for guest_id, token in zip(guest_ids, self.unused_tokens(len(guest_ids)))]
+            try:
+                with transaction.atomic():
+                    self.bulk_create(permissions)
+                    # bulk_create skips post_save and (except on PostgreSQL) does not set ids
+                    ids = dict(self.filter(token__in=[p.token for p in permissions]).values_list('token', 'id'))
+                    PermissionChange.objects.record(ids.values())
+                    active.index((ids[p.token], p.guest_id, p.starts_on, p.expires_on) for p in permissions)
+                    return permissions
+            except IntegrityError:
+                if attempt == retries - 1:
+                    raise
+
+
 class GuestPermission(models.Model):
     """This model is used to log all guest permissions in order perform authentication based on creation and
     expiry dates."""
@@ -45,10 +254,158 @@ class GuestPermission(models.Model):
     expires_on = models.DateTimeField()
     once_off = models.BooleanField(default=False)
     once_off_used = models.BooleanField(default=False)
+    schedule = models.ForeignKey('AccessSchedule', related_name='permissions', on_delete=models.PROTECT, null=True, blank=True)
+    # the site whose gates the permission opens, None for every site
+    site = models.ForeignKey('Site', related_name='permissions', on_delete=models.PROTECT, null=True, blank=True)
+    # auto_now is skipped by QuerySet.update(), so bulk updates must set it themselves
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = GuestPermissionQuerySet.as_manager()
+
+    class Meta:
+        # a guest's current permissions: guest = X AND expires_on > now
+        indexes = [models.Index(fields=['guest', 'expires_on'], name='permission_guest_expiry_idx')]
 
     def __str__(self):
         return "Permission for {0} granted by {1}. Expires on {2}".format(self.guest.first_name, self.granted_by.username, self.expires_on)
 
 
+class PermissionSpan(models.Model):
+    """One bucket of the time-bucketed index of GuestPermission windows kept by api.active: a window is
+    stored under the O(log length) aligned power-of-two runs of days that exactly cover the days it
+    touches, so the permissions covering an instant are found in the ~20 buckets containing it rather
+    than by scanning the history of expired permissions."""
+    key = models.BigIntegerField(db_index=True)  # level << 24 | day >> level, see api.active.bucket_key
+    permission = models.ForeignKey('GuestPermission', related_name='+', on_delete=models.CASCADE)
+    guest = models.ForeignKey('Guest', related_name='+', on_delete=models.CASCADE)
+    starts_on = models.DateTimeField()
+    expires_on = models.DateTimeField()
+
+
+class ActivityRollup(models.Model):
+    """Pre-aggregated GateActivity counts per hour/day bucket (in TIME_ZONE), site, responsible user or
+    guest and gate status, over every activity database, maintained incrementally by api.rollups. Readers
+    must SUM(count) per key: a race between two first inserts of the same key can leave two rows (the
+    unique constraint does not apply to rows whose site/user/guest is NULL), which is harmless for sums."""
+    HOUR, DAY = 'hour', 'day'
+    period = models.CharField(max_length=4, choices=((HOUR, 'Hour'), (DAY, 'Day')))
+    bucket = models.DateTimeField()
+    site = models.ForeignKey('Site', related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    responsible_user = models.ForeignKey('auth.User', related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    responsible_guest = models.ForeignKey('Guest', related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    gate_status = models.PositiveSmallIntegerField(choices=((1, 'HIGH'), (0, 'LOW')))
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('period', 'bucket', 'site', 'responsible_user', 'responsible_guest', 'gate_status')
+
+
+class Presence(models.Model):
+    """Whether a user or guest (exactly one of the two is set) is currently on site, as of their latest
+    gate interaction, and since when. Maintained incrementally by api.presence."""
+    responsible_user = models.OneToOneField('auth.User', related_name='presence', on_delete=models.CASCADE, null=True, blank=True)
+    responsible_guest = models.OneToOneField('Guest', related_name='presence', on_delete=models.CASCADE, null=True, blank=True)
+    inside = models.BooleanField(db_index=True)
+    changed_on = models.DateTimeField()  # the interaction that last changed inside
+    seen_on = models.DateTimeField()  # the latest interaction
+
+    def __str__(self):
+        return "{0} {1} since {2}".format(self.responsible_user_id and 'user {0}'.format(self.responsible_user_id)
+                                          or 'guest {0}'.format(self.responsible_guest_id),
+                                          'inside' if self.inside else 'outside', self.changed_on)
+
+
+class Watermark(models.Model):
+    """Named high-water mark (e.g. the last GateActivity id folded into the rollups) used by catch-up jobs."""
+    name = models.CharField(max_length=50, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get(cls, name):
+        return cls.objects.get_or_create(name=name)[0]
+
+    @classmethod
+    def advance(cls, name):
+        """Add one to the position of name, for marks that count events rather than track an id."""
+        if not cls.objects.filter(name=name).update(position=F('position') + 1):
+            if not cls.objects.get_or_create(name=name, defaults={'position': 1})[1]:
+                cls.objects.filter(name=name).update(position=F('position') + 1)
+
+    def __str__(self):
+        return "{0} @ {1}".format(self.name, self.position)
+
+
+# counts the deletions of GateActivity rows (purges, archive runs and cascades from users and guests), which
+# the max(id) the activity listings are fingerprinted on does not see
+ACTIVITY_DELETIONS = 'activity_deletions'
 
 
+class IngestedBatch(models.Model):
+    """Marker of an upload (such as an offline batch of a gate controller) that has been ingested, written in
+    the same transaction as its rows so a retried upload is recognised. Kept for a while, then pruned (see
+    api.sync.prune_batches)."""
+    key = models.CharField(max_length=60, unique=True)
+    rows = models.IntegerField(default=0)
+    received_on = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return "{0} ({1} rows)".format(self.key, self.rows)
+
+
+class Device(models.Model):
+    """A gate controller (or other machine client) authenticating with HMAC-signed request tokens instead of
+    a password - see api.authentication.DeviceAuthentication. Requests are made on behalf of `user`."""
+    name = models.CharField(max_length=255)
+    key_id = models.CharField(max_length=32, unique=True)
+    secret = models.CharField(max_length=64)
+    user = models.ForeignKey('auth.User', related_name='devices', on_delete=models.CASCADE)
+    # the gate the device controls; its gate opens and offline uploads are logged against it
+    gate = models.ForeignKey('Gate', related_name='devices', on_delete=models.SET_NULL, null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{0} ({1})".format(self.name, self.key_id)
+
+
+class PermissionChangeQuerySet(models.QuerySet):
+
+    def record(self, permission_ids):
+        """Append a change for each of permission_ids (one INSERT)."""
+        self.bulk_create([self.model(permission_id=pk) for pk in permission_ids])
+
+
+class PermissionChange(models.Model):
+    """Append-only log of writes to GuestPermission (create, update, once-off use, delete). Its id is the
+    version that offline gate controllers sync permission deltas from (see api.sync)."""
+    id = models.BigAutoField(primary_key=True)
+    permission_id = models.IntegerField()
+    changed_on = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = PermissionChangeQuerySet.as_manager()
+
+    def __str__(self):
+        return "Change #{0} of permission {1}".format(self.id, self.permission_id)
+
+
+class PurgeJob(models.Model):
+    """A bulk deletion run off the request path by api.purge, in chunks of bounded size with its progress
+    recorded after each: a soft-deleted guest with all its history, or the permissions that expired
+    before cutoff."""
+    GUEST, EXPIRED_PERMISSIONS = 'guest', 'expired_permissions'
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    kind = models.CharField(max_length=20, choices=((GUEST, 'Guest'), (EXPIRED_PERMISSIONS, 'Expired permissions')))
+    guest_id = models.IntegerField(null=True, blank=True)  # no FK: the guest row is deleted by the job
+    cutoff = models.DateTimeField(null=True, blank=True)
+    state = models.CharField(max_length=10, default=PENDING, db_index=True,
+                             choices=((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')))
+    position = models.BigIntegerField(default=0)  # last id processed, for keyset scans
+    deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "Purge #{0} ({1}): {2}, {3} rows deleted".format(self.pk, self.kind, self.state, self.deleted)
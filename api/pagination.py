@@ -0,0 +1,119 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from itertools import islice
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from .sites import fetch, merge
+
+
+def seek(queryset, position, newer=False):
+    """Restrict queryset to the rows strictly older (or, if newer, strictly newer) than position in
+    (date, id) order. Together with an ORDER BY on (date, id) this is a range scan on
+    activity_date_id_idx."""
+    date, pk = position
+    if newer:
+        return queryset.filter(Q(date__gt=date) | Q(date=date, id__gt=pk))
+    return queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+
+
+class GateActivityCursorPagination(BasePagination):
+    """Keyset pagination over GateActivity ordered newest first by (date, id). The cursor is an opaque
+    token encoding the (date, id) of the row at the page boundary, so every page is a single index
+    range scan on (date, id) regardless of depth - one per activity database for views that fan out
+    over the sites. No total count is computed."""
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 10
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        size = self.get_page_size(request)
+        reverse, position = self.decode_cursor(request)
+
+        if position is not None:
+            queryset = seek(queryset, position, newer=reverse)
+        ordering = ('date', 'id') if reverse else ('-date', '-id')
+
+        # fetch one extra row to find out whether there is another page in this direction, from every
+        # database the view reads (see api.sites.partitions) and merged
+        partitions = view.get_partitions(queryset) if hasattr(view, 'get_partitions') else [queryset]
+        results = list(islice(merge([fetch(partition.order_by(*ordering), size + 1) for partition in partitions],
+                                    key=self.position, reverse=not reverse), size + 1))
+        if hasattr(view, 'read_archive'):
+            # rows moved to the archive (see api.archive), only read when the page reaches back that far
+            archived = view.read_archive(queryset, position, reverse, size + 1, results, self.position)
+            if archived:
+                results = list(islice(merge([results, archived], key=self.position, reverse=not reverse), size + 1))
+        more = len(results) > size
+        results = results[:size]
+        if reverse:
+            results.reverse()
+
+        self.next_position = self.previous_position = None
+        if results:
+            first, last = self.position(results[0]), self.position(results[-1])
+            if reverse:
+                # we came backwards from a later page, so there is always a next page
+                self.next_position = last
+                self.previous_position = first if more else None
+            else:
+                self.next_position = last if more else None
+                self.previous_position = first if position is not None else None
+        return results
+
+    def position(self, row):
+        """(date, id) of a result row: a GateActivity, or a values_list tuple starting with id, date."""
+        if isinstance(row, tuple):
+            return row[1], row[0]
+        return row.date, row.pk
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(False, self.next_position)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(True, self.previous_position)
+
+    def decode_cursor(self, request):
+        """Return (reverse, (date, id)) from the cursor query param, or (False, None) if absent."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            direction, date, pk = b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            date = parse_datetime(date)
+            if direction not in ('n', 'p') or date is None:
+                raise ValueError
+            return direction == 'p', (date, int(pk))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, reverse, position):
+        date, pk = position
+        raw = '|'.join(('p' if reverse else 'n', date.isoformat(), str(pk)))
+        return replace_query_param(self.base_url, self.cursor_query_param, b64encode(raw.encode('ascii')).decode('ascii'))
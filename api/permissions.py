@@ -1,4 +1,5 @@
-from rest_framework.permissions import BasePermission
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+from .authentication import DeviceAuthentication
 
 
 class IsSuperUser(BasePermission):
@@ -11,4 +12,15 @@ class IsSuperUser(BasePermission):
         return False
 
 
+class IsDevice(BasePermission):
+    """Only allow requests authenticated as a gate controller (DeviceAuthentication)"""
 
+    def has_permission(self, request, view):
+        return isinstance(request.successful_authenticator, DeviceAuthentication)
+
+
+class IsSuperUserOrReadOnly(BasePermission):
+    """Let any authenticated user read, but only superusers write"""
+
+    def has_permission(self, request, view):
+        return request.method in SAFE_METHODS or request.user.is_superuser
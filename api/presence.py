@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, When
+from . import archive
+from .models import GateActivity, Presence
+from .sites import merge, partitions
+
+# the gate_status of an interaction that brings its user or guest on site; any other status takes them off
+INSIDE_STATUS = 1
+
+
+def _person(user, guest):
+    return {'responsible_user_id': user} if user is not None else {'responsible_guest_id': guest}
+
+
+def _runs(activities):
+    """{(user id, guest id): (latest date, inside, date the final run of equal states started, whether that
+    run spans all of the person's activities)} for an iterable of GateActivity or dicts of its fields."""
+    events = {}
+    for activity in activities:
+        if isinstance(activity, dict):
+            date, user, guest, status = (activity['date'], activity['responsible_user_id'],
+                                         activity['responsible_guest_id'], activity['gate_status'])
+        else:
+            date, user, guest, status = (activity.date, activity.responsible_user_id,
+                                         activity.responsible_guest_id, activity.gate_status)
+        if user is not None or guest is not None:
+            events.setdefault((user, guest), []).append((date, status == INSIDE_STATUS))
+    runs = {}
+    for person, states in events.items():
+        states.sort(key=lambda state: state[0])
+        latest, inside = states[-1]
+        start = len(states) - 1
+        while start and states[start - 1][1] == inside:
+            start -= 1
+        runs[person] = (latest, inside, states[start][0], start == 0)
+    return runs
+
+
+def apply(activities):
+    """Move the users and guests of activities (GateActivity or dicts with the same keys) to the state of
+    their latest interaction: one conditional UPDATE per person, plus an INSERT for people seen for the
+    first time. Interactions older than a person's stored state (late offline uploads) do not override
+    it. Paths that bypass post_save (bulk_create) must call this themselves."""
+    for (user, guest), (latest, inside, run_start, whole) in _runs(activities).items():
+        person = _person(user, guest)
+        # a run spanning the whole batch only changes changed_on if it flips the stored state
+        changed_on = Case(When(inside=inside, then=F('changed_on')), default=run_start) if whole else run_start
+        if Presence.objects.filter(seen_on__lte=latest, **person).update(inside=inside, seen_on=latest, changed_on=changed_on):
+            continue
+        if Presence.objects.filter(**person).exists():
+            continue  # already holds a later interaction
+        try:
+            with transaction.atomic():
+                Presence.objects.create(inside=inside, seen_on=latest, changed_on=run_start, **person)
+        except IntegrityError:  # another writer inserted the person first
+            Presence.objects.filter(seen_on__lte=latest, **person).update(inside=inside, seen_on=latest, changed_on=changed_on)
+
+
+def rebuild(chunk_size=2000):
+    """Recompute every presence from the whole log in one pass over it in date order (streamed from every
+    activity database and the archive and merged, so memory grows with the number of people, not of interactions), then
+    replace the table, chunk_size rows per INSERT. Returns the number of interactions read."""
+    state = OrderedDict()  # (user id, guest id) -> [inside, changed_on, seen_on]
+    read = 0
+    rows = [activity.order_by('date', 'id').values_list('date', 'responsible_user_id', 'responsible_guest_id', 'gate_status')
+            .iterator() for activity in partitions(GateActivity.objects.all())]
+    rows.append((record['date'], record['responsible_user_id'], record['responsible_guest_id'], record['gate_status'])
+                for record in archive.iter_living(chunk_size))
+    for date, user, guest, status in merge(rows, key=lambda row: row[0]):
+        read += 1
+        if user is None and guest is None:
+            continue
+        inside = status == INSIDE_STATUS
+        current = state.get((user, guest))
+        if current is None:
+            state[(user, guest)] = [inside, date, date]
+        else:
+            if current[0] != inside:
+                current[0], current[1] = inside, date
+            current[2] = date
+    people = list(state.items())
+    with transaction.atomic():
+        Presence.objects.all().delete()
+        for start in range(0, len(people), chunk_size):
+            Presence.objects.bulk_create([Presence(inside=inside, changed_on=changed_on, seen_on=seen_on, **_person(user, guest))
+                                          for (user, guest), (inside, changed_on, seen_on) in people[start:start + chunk_size]])
+    return read
+
+
+def headcount():
+    """Users, guests and people in total currently on site (one aggregate query)."""
+    counts = Presence.objects.filter(inside=True).aggregate(users=Count('responsible_user'), guests=Count('responsible_guest'))
+    counts['total'] = counts['users'] + counts['guests']
+    return counts
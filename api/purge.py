@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from . import active
+from .cache import token_cache
+from .sites import partitions
+from .models import (ACTIVITY_DELETIONS, ActivityRollup, GateActivity, Guest, GuestPermission, PermissionChange, PermissionSpan,
+                     Presence, PurgeJob, Watermark)
+
+logger = logging.getLogger(__name__)
+
+
+def purge_options():
+    return getattr(settings, 'PURGE', {})
+
+
+def soft_delete_guest(guest):
+    """Delete guest as far as the API is concerned, in a few short statements: mark it deleted, revoke
+    its permissions (expired now, logged for gate controllers) and queue a PurgeJob for the guest row and
+    its history. Returns the job."""
+    now = timezone.now()
+    with transaction.atomic():
+        guest.deleted_on = now
+        guest.save(update_fields=['deleted_on', 'updated_at'])  # post_save evicts its cached tokens
+        permissions = GuestPermission.objects.filter(guest=guest, expires_on__gt=now)
+        revoked = list(permissions.values_list('id', flat=True))
+        if revoked:
+            permissions.update(expires_on=now, updated_at=now)
+            PermissionChange.objects.record(revoked)
+            active.reindex(revoked)
+        job = PurgeJob.objects.create(kind=PurgeJob.GUEST, guest_id=guest.pk)
+        transaction.on_commit(kick)
+    return job
+
+
+def purge_expired_permissions(before, start=True):
+    """Queue a PurgeJob for the permissions that expired before before, started in the background unless
+    start is False (the caller runs it). Returns the job."""
+    job = PurgeJob.objects.create(kind=PurgeJob.EXPIRED_PERMISSIONS, cutoff=before)
+    if start:
+        transaction.on_commit(kick)
+    return job
+
+
+def _delete_permissions(rows):
+    """Delete the (id, token) rows without the per-row signals of QuerySet.delete(): their change is
+    either logged already (revoked guests) or irrelevant to controllers (long expired)."""
+    PermissionSpan.objects.filter(permission_id__in=[pk for pk, _ in rows]).delete()
+    GuestPermission.objects.filter(id__in=[pk for pk, _ in rows])._raw_delete(GuestPermission.objects.db)
+    for _, token in rows:
+        token_cache.invalidate(token)
+
+
+def _guest_chunk(job, size):
+    """Delete up to size rows of the guest's history (in every activity database), dependants first and
+    the guest row last. Returns the number of rows deleted, 0 once the guest is gone."""
+    for queryset in partitions(GateActivity.objects.all()) + [ActivityRollup.objects.all(), Presence.objects.all()]:
+        ids = list(queryset.filter(responsible_guest_id=job.guest_id).values_list('id', flat=True)[:size])
+        if ids:
+            if queryset.model is GateActivity:
+                Watermark.advance(ACTIVITY_DELETIONS)
+            return queryset.filter(id__in=ids).delete()[0]
+    rows = list(GuestPermission.objects.filter(guest_id=job.guest_id).values_list('id', 'token')[:size])
+    if rows:
+        _delete_permissions(rows)
+        return len(rows)
+    return Guest.objects.filter(pk=job.guest_id, deleted_on__isnull=False).delete()[0]
+
+
+def _expired_chunk(job, size):
+    """Delete the next permissions (by id) that expired before the job's cutoff, scanning at most size
+    ids past the job's position (gaps in the ids are skipped)."""
+    upper = job.position + size
+    rows = list(GuestPermission.objects.filter(id__gt=job.position, id__lte=upper, expires_on__lt=job.cutoff)
+                .values_list('id', 'token'))
+    if rows:
+        _delete_permissions(rows)
+    following = GuestPermission.objects.filter(id__gt=upper).order_by('id').values_list('id', flat=True).first()
+    if not rows and following is None:
+        return 0
+    job.position = upper if following is None else following - 1
+    return len(rows) or -1  # nothing in this id range, but there are more ids
+
+
+CHUNKS = {PurgeJob.GUEST: _guest_chunk, PurgeJob.EXPIRED_PERMISSIONS: _expired_chunk}
+
+
+def claim(job_id, stale_after):
+    """Take job_id for this worker with a conditional UPDATE (pending, or running but not updated for
+    stale_after, i.e. its worker died). Returns True if this worker got it."""
+    return PurgeJob.objects.filter(
+        Q(state=PurgeJob.PENDING) | Q(state=PurgeJob.RUNNING, updated_on__lt=timezone.now() - stale_after),
+        pk=job_id).update(state=PurgeJob.RUNNING, updated_on=timezone.now()) == 1
+
+
+def run_job(job, chunk_size=None, pause=None):
+    """Run a claimed job to completion, one short transaction per chunk that also records the progress,
+    so a job interrupted at any point resumes where it stopped. Returns the job."""
+    options = purge_options()
+    chunk_size = chunk_size or options.get('CHUNK_SIZE', 1000)
+    pause = options.get('PAUSE', 0.0) if pause is None else pause
+    chunk = CHUNKS[job.kind]
+    try:
+        while True:
+            with transaction.atomic():
+                deleted = chunk(job, chunk_size)
+                if deleted:
+                    PurgeJob.objects.filter(pk=job.pk).update(position=job.position, deleted=F('deleted') + max(deleted, 0),
+                                                              updated_on=timezone.now())
+            if not deleted:
+                break
+            if pause:
+                time.sleep(pause)
+    except Exception:
+        PurgeJob.objects.filter(pk=job.pk).update(state=PurgeJob.FAILED, error=traceback.format_exc(),
+                                                  updated_on=timezone.now())
+        raise
+    PurgeJob.objects.filter(pk=job.pk).update(state=PurgeJob.DONE, finished_on=timezone.now(), updated_on=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+def run_pending(stale_after=None, **kwargs):
+    """Run every pending job, and running jobs abandoned for stale_after, oldest first. Returns the
+    number of jobs run."""
+    stale_after = stale_after or timedelta(seconds=purge_options().get('STALE_AFTER', 300))
+    ran = 0
+    while True:
+        candidates = (PurgeJob.objects.filter(Q(state=PurgeJob.PENDING) |
+                                              Q(state=PurgeJob.RUNNING, updated_on__lt=timezone.now() - stale_after))
+                      .order_by('id').values_list('id', flat=True))
+        job_id = next((pk for pk in candidates[:10] if claim(pk, stale_after)), None)
+        if job_id is None:
+            return ran
+        run_job(PurgeJob.objects.get(pk=job_id), **kwargs)
+        ran += 1
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def kick():
+    """Run the pending jobs in a background thread of this process (PURGE['IN_PROCESS']), unless one is
+    already at it. Jobs of a process that dies are picked up by `manage.py purge`."""
+    global _worker
+    if not purge_options().get('IN_PROCESS', True):
+        return
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_work, name='purge-worker')
+        _worker.daemon = True
+        _worker.start()
+
+
+def _work():
+    close_old_connections()
+    try:
+        run_pending()
+    except Exception:
+        logger.exception("Purge job failed")
+    finally:
+        connection.close()
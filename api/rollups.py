@@ -0,0 +1,155 @@
+from collections import Counter, OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Count, F, Max, Min
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+from . import archive
+from .models import ActivityRollup, GateActivity, Watermark
+from .sites import activity_databases
+
+WATERMARK = 'activity_rollup'
+PERIODS = ((ActivityRollup.HOUR, TruncHour), (ActivityRollup.DAY, TruncDay))
+
+
+def rollup_mode():
+    """'save' folds every GateActivity into the rollups as it is inserted; 'batch' leaves that to the
+    rollup_activity management command."""
+    return getattr(settings, 'ACTIVITY_ROLLUP_MODE', 'save')
+
+
+def truncate(date, period):
+    """Start of the hour/day bucket containing date, in the current time zone."""
+    local = timezone.localtime(date).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+    if period == ActivityRollup.DAY:
+        local = local.replace(hour=0)
+    return timezone.make_aware(local)
+
+
+def apply(activities):
+    """Fold an iterable of GateActivity (or dicts with the same keys) into the rollups: one UPDATE per
+    distinct key, plus an INSERT for keys seen for the first time. Paths that bypass post_save
+    (bulk_create) must call this themselves."""
+    counts = Counter()
+    for activity in activities:
+        if isinstance(activity, dict):
+            date, site, user, guest, status = (activity['date'], activity.get('site_id'), activity['responsible_user_id'],
+                                               activity['responsible_guest_id'], activity['gate_status'])
+        else:
+            date, site, user, guest, status = (activity.date, activity.site_id, activity.responsible_user_id,
+                                               activity.responsible_guest_id, activity.gate_status)
+        for period, _ in PERIODS:
+            counts[(period, truncate(date, period), site, user, guest, status)] += 1
+    _add(counts)
+
+
+def _add(counts):
+    for (period, bucket, site, user, guest, status), count in counts.items():
+        key = dict(period=period, bucket=bucket, site_id=site, responsible_user_id=user, responsible_guest_id=guest,
+                   gate_status=status)
+        if ActivityRollup.objects.filter(**key).update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                ActivityRollup.objects.create(count=count, **key)
+        except IntegrityError:  # another writer inserted the key first
+            ActivityRollup.objects.filter(**key).update(count=F('count') + count)
+
+
+def _count(queryset, counts):
+    """Aggregate queryset in its database into per-key counts, added to the Counter counts. Returns the
+    number of activity rows counted."""
+    folded = 0
+    for period, trunc in PERIODS:
+        rows = (queryset.annotate(bucket=trunc('date')).order_by()
+                .values_list('bucket', 'site_id', 'responsible_user_id', 'responsible_guest_id', 'gate_status')
+                .annotate(n=Count('id')))
+        for bucket, site, user, guest, status, n in rows:
+            counts[(period, bucket, site, user, guest, status)] += n
+            if period == ActivityRollup.DAY:
+                folded += n
+    return folded
+
+
+def _store(counts, empty=False, batch_size=1000):
+    """Add counts to the rollups - bulk inserted, batch_size rows per INSERT, if the rollups are known to
+    be empty."""
+    if not empty:
+        _add(counts)
+        return
+    rows = [ActivityRollup(period=period, bucket=bucket, site_id=site, responsible_user_id=user,
+                           responsible_guest_id=guest, gate_status=status, count=count)
+            for (period, bucket, site, user, guest, status), count in counts.items()]
+    for start in range(0, len(rows), batch_size):
+        ActivityRollup.objects.bulk_create(rows[start:start + batch_size])
+
+
+def watermark_name(alias):
+    """Name of the watermark of the rollup catch-up over the activity in database alias."""
+    return WATERMARK if alias == DEFAULT_DB_ALIAS else '{0}:{1}'.format(WATERMARK, alias)
+
+
+def catch_up(batch_size=50000, settle=timedelta(seconds=30)):
+    """Fold GateActivity rows past the watermark into the rollups, batch_size ids at a time, and advance
+    the watermark - separately for every activity database, as ids are per database. Rows younger than
+    settle are left for the next run, so that a row whose transaction commits after one with a higher id
+    is not skipped. Returns the number of rows folded."""
+    folded = 0
+    with transaction.atomic():
+        for alias in activity_databases():
+            activity = GateActivity.objects.using(alias)
+            watermark = Watermark.objects.select_for_update().get_or_create(name=watermark_name(alias))[0]
+            unsettled = (activity.filter(id__gt=watermark.position, date__gte=timezone.now() - settle)
+                         .aggregate(first=Min('id'))['first'])
+            last = unsettled - 1 if unsettled else activity.aggregate(last=Max('id'))['last'] or 0
+            while watermark.position < last:
+                upper = min(watermark.position + batch_size, last)
+                counts = Counter()
+                folded += _count(activity.filter(id__gt=watermark.position, id__lte=upper), counts)
+                _store(counts)
+                watermark.position = upper
+            watermark.save()
+    return folded
+
+
+def _windows(first, last, days):
+    """[start, end) windows of `days` whole local days covering first..last."""
+    start = truncate(first, ActivityRollup.DAY)
+    while start <= last:
+        end = truncate(start + timedelta(days=days, hours=12), ActivityRollup.DAY)  # whole days across DST
+        yield start, end
+        start = end
+
+
+def rebuild(days=1, batch_size=1000):
+    """Recompute the rollups from the whole log and move the watermarks to the end. The log is read a
+    window of `days` days at a time - one aggregate query per period and activity database, plus the
+    archive - and every window's rollups are inserted before the next is read, batch_size rows per
+    INSERT, so memory is bounded by the rollups of one window. Returns the number of rows folded."""
+    folded = 0
+    with transaction.atomic():
+        ActivityRollup.objects.all().delete()
+        lasts, dates = OrderedDict(), [archive.oldest(), archive.horizon()]
+        for alias in activity_databases():
+            span = GateActivity.objects.using(alias).aggregate(last=Max('id'), first=Min('date'), newest=Max('date'))
+            watermark = Watermark.objects.select_for_update().get_or_create(name=watermark_name(alias))[0]
+            watermark.position = lasts[alias] = span['last'] or 0
+            watermark.save()
+            dates.extend((span['first'], span['newest']))
+        dates = [date for date in dates if date is not None]
+        if not dates:
+            return 0
+        for start, end in _windows(min(dates), max(dates), days):
+            counts = Counter()
+            for alias, last in lasts.items():
+                folded += _count(GateActivity.objects.using(alias).filter(id__lte=last, date__gte=start, date__lt=end),
+                                 counts)
+            for record in archive.iter_living(since=start, until=end):
+                for period, _ in PERIODS:
+                    counts[(period, truncate(record['date'], period), record['site_id'], record['responsible_user_id'],
+                            record['responsible_guest_id'], record['gate_status'])] += 1
+                folded += 1
+            _store(counts, empty=True, batch_size=batch_size)
+    return folded
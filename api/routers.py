@@ -0,0 +1,107 @@
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+from .sites import registry, site_databases
+
+_state = threading.local()
+
+
+def replicas():
+    """Aliases of the read replicas of the default database (DATABASE_REPLICAS)."""
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def begin_request(pinned=False):
+    """Reset the routing state of this thread for a new request; pinned keeps all of it on the primary."""
+    _state.eligible = False
+    _state.pinned = pinned
+    _state.wrote = False
+
+
+def end_request():
+    begin_request()
+
+
+def use_replicas():
+    """Let the reads of the current request go to a replica, unless it is pinned or has written."""
+    _state.eligible = True
+
+
+def wrote():
+    return getattr(_state, 'wrote', False)
+
+
+class ReplicaRouter(object):
+    """Sends the reads of requests to views using ReplicaReadMixin to a random replica and everything
+    else - writes, reads outside requests and inside transactions, and the reads of any other view (such
+    as the token lookup of gate opens) - to the default database. After a write the request stays on
+    the primary and ReplicaRoutingMiddleware pins the client to it for REPLICA_STICKY_SECONDS, so it
+    reads its own writes despite replication lag."""
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'eligible', False) or _state.pinned or _state.wrote:
+            return DEFAULT_DB_ALIAS
+        aliases = replicas()
+        if not aliases or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # replicas hold the same rows
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replicas()  # replicas get their schema by replication
+
+
+class SiteRouter(object):
+    """Sends the GateActivity rows of a site with a database of its own (Site.database) to that database,
+    so the gate opens of a site only ever write to its partition of the log. Reads are routed by the
+    views (see api.sites.partitions); rows loaded from a site database stay there. Anything else is left
+    to the routers after this one."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if model._meta.label == 'api.GateActivity' and isinstance(instance, model) and instance._state.db in site_databases():
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if model._meta.label != 'api.GateActivity' or not isinstance(instance, model) or instance.site_id is None:
+            return None
+        alias = registry.database(instance.site_id)
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+
+class ReplicaRoutingMiddleware(object):
+    """Resets the routing state for every request, keeps a client that carries the pin cookie on the
+    primary and sets that cookie (for REPLICA_STICKY_SECONDS) on responses to requests that wrote."""
+    cookie_name = 'db_primary_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        begin_request(pinned=self.cookie_name in request.COOKIES)
+        response = self.get_response(request)
+        if wrote():
+            response.set_cookie(self.cookie_name, '1', max_age=getattr(settings, 'REPLICA_STICKY_SECONDS', 5),
+                                httponly=True)
+        return response
+
+
+class ReplicaReadMixin(object):
+    """Lets the safe (GET, HEAD, OPTIONS) requests of an APIView read from a replica once authentication
+    and permission checks - which stay on the primary - have passed."""
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadMixin, self).initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            use_replicas()
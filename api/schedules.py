@@ -0,0 +1,117 @@
+import re
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+BITMAP_BYTES = WEEK_MINUTES // 8
+
+RULE = re.compile(r'^(?P<days>[a-z,\-]+)\s+(?P<start>\d{1,2}:\d{2})\s*-\s*(?P<end>\d{1,2}:\d{2})$')
+
+
+def default_timezone():
+    return settings.TIME_ZONE
+
+
+def _minute(text, allow_end=False):
+    hours, minutes = (int(part) for part in text.split(':'))
+    if minutes > 59 or hours > 24 or (hours == 24 and (minutes or not allow_end)):
+        raise ValueError("{0} is not a time of day".format(text))
+    return hours * 60 + minutes
+
+
+def _days(text):
+    days = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        if first not in DAYS or (last and last not in DAYS):
+            raise ValueError("{0} is not a day or range of days (mon..sun)".format(part))
+        start = DAYS.index(first)
+        count = (DAYS.index(last) - start) % 7 + 1 if last else 1  # fri-mon wraps over the weekend
+        days.extend((start + offset) % 7 for offset in range(count))
+    return tuple(sorted(set(days)))
+
+
+def parse_rules(text):
+    """Parse weekly rules such as 'mon-fri 07:00-17:00; sat,sun 08:00-12:00' into (days, start, end)
+    tuples: weekday numbers (Monday is 0) and minutes since midnight, local time. A window that ends at or
+    before its start (22:00-06:00) runs past midnight into the following day. Raises ValueError."""
+    rules = []
+    for part in (text or '').lower().split(';'):
+        part = ' '.join(part.split())
+        if not part:
+            continue
+        match = RULE.match(part)
+        if match is None:
+            raise ValueError("Expected '<days> HH:MM-HH:MM', got '{0}'".format(part))
+        start, end = _minute(match.group('start')), _minute(match.group('end'), allow_end=True)
+        if start == end:
+            raise ValueError("'{0}' is an empty window".format(part))
+        rules.append((_days(match.group('days')), start, end))
+    if not rules:
+        raise ValueError("At least one rule is required")
+    return rules
+
+
+def parse_dates(text):
+    """The dates (YYYY-MM-DD, separated by commas or whitespace) excluded from a schedule, as a set of
+    ordinals. Raises ValueError."""
+    return frozenset(datetime.strptime(part, '%Y-%m-%d').date().toordinal()
+                     for part in re.split(r'[\s,]+', text or '') if part)
+
+
+def compile_week(rules):
+    """Bitmap of the minutes of the week (bit weekday * 1440 + minute, Monday 00:00 first) covered by
+    rules, BITMAP_BYTES bytes."""
+    bitmap = bytearray(BITMAP_BYTES)
+    for days, start, end in rules:
+        length = (end - start) % DAY_MINUTES or DAY_MINUTES
+        for day in days:
+            first = day * DAY_MINUTES + start
+            for minute in range(first, first + length):
+                minute %= WEEK_MINUTES  # sunday night runs into monday morning
+                bitmap[minute >> 3] |= 1 << (minute & 7)
+    return bytes(bitmap)
+
+
+def validate_rules(value):
+    try:
+        parse_rules(value)
+    except ValueError as error:
+        raise ValidationError(str(error))
+
+
+def validate_dates(value):
+    try:
+        parse_dates(value)
+    except ValueError as error:
+        raise ValidationError(str(error))
+
+
+def validate_timezone(value):
+    if value not in pytz.all_timezones_set:
+        raise ValidationError("Unknown time zone {0}".format(value))
+
+
+class CompiledSchedule(object):
+    """An AccessSchedule ready for gate-open checks: the week bitmap, the time zone it is laid out in and
+    the excluded dates (whole local days, also cutting short windows that run into them). allows() is a
+    time zone conversion and a bit test."""
+    __slots__ = ('bitmap', 'timezone', 'excluded')
+
+    def __init__(self, bitmap, timezone, excluded_dates=''):
+        self.bitmap = bytes(bitmap)  # BinaryField values are memoryviews on some backends
+        self.timezone = pytz.timezone(timezone)
+        self.excluded = parse_dates(excluded_dates)
+
+    def allows(self, instant):
+        """True if the aware datetime instant falls within the schedule."""
+        local = instant.astimezone(self.timezone)
+        if local.toordinal() in self.excluded:
+            return False
+        minute = local.weekday() * DAY_MINUTES + local.hour * 60 + local.minute
+        return bool(self.bitmap[minute >> 3] & (1 << (minute & 7)))
@@ -0,0 +1,33 @@
+import re
+
+from .models import Guest, normalize_mobile, normalize_name
+
+MOBILE_QUERY = re.compile(r'^[\d\s+()-]+$')
+
+
+def prefix_range(queryset, field, prefix):
+    """Rows whose field starts with prefix, in field order. Written as a range (>= prefix, < the next
+    prefix) rather than LIKE, so it is an index range scan under any collation and database."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return queryset.filter(**{field + '__gte': prefix, field + '__lt': upper}).order_by(field, 'id')
+
+
+def search_guests(query, limit, queryset=None):
+    """Up to limit guests matching what has been typed so far, best first. A query of digits (and + ( ) -
+    or spaces) matches mobile numbers starting with it; anything else matches guests whose
+    "first_name surname" or surname starts with it, ignoring case and accents. Exact name matches come
+    first, then first name matches, then surname matches, each alphabetical. At most two LIMITed index
+    range scans on the Guest search keys."""
+    queryset = Guest.objects.alive() if queryset is None else queryset
+    if MOBILE_QUERY.match(query):
+        key = normalize_mobile(query)
+        return list(prefix_range(queryset, 'mobile_key', key)[:limit]) if key else []
+    key = normalize_name(query)
+    if not key:
+        return []
+    ranked = {}
+    for rank, field in ((1, 'name_key'), (2, 'surname_key')):
+        for guest in prefix_range(queryset, field, key)[:limit]:
+            exact = guest.name_key == key or guest.surname_key == key or guest.name_key.startswith(key + ' ')
+            ranked.setdefault(guest.pk, (0 if exact else rank, guest.name_key, guest.pk, guest))
+    return [entry[3] for entry in sorted(ranked.values(), key=lambda entry: entry[:3])][:limit]
@@ -1,7 +1,13 @@
+from collections import OrderedDict
+
 from rest_framework import serializers, exceptions
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.utils import timezone
-from .models import Guest, GateActivity, GuestPermission
+from .models import AccessSchedule, Gate, Guest, GateActivity, GuestPermission, Presence, PurgeJob, Site
+from .authentication import DeviceAuthentication, principal_cache
+from .journal import log_activity
+from .sites import registry
 
 
 class GuestPermissionSerializer(serializers.ModelSerializer):
@@ -11,10 +17,72 @@ class GuestPermissionSerializer(serializers.ModelSerializer):
         """Meta class to map serializer's fields to model fields."""
         model = GuestPermission
         # can exclude any fields below that shouldn't be displayed by API
-        fields = ('id', 'guest', 'token', 'granted_by', 'granted_on', 'expires_on', 'once_off', 'once_off_used')
+        fields = ('id', 'guest', 'token', 'granted_by', 'granted_on', 'expires_on', 'once_off', 'once_off_used', 'schedule', 'site')
         read_only_fields = ('created_on', 'created_by', 'token')
 
 
+class AccessScheduleSerializer(serializers.ModelSerializer):
+    """Rules, time zone and excluded dates are checked by the model field validators (api.schedules)."""
+    created_by = serializers.ReadOnlyField(source='created_by.username')
+
+    class Meta:
+        model = AccessSchedule
+        fields = ('id', 'name', 'rules', 'timezone', 'excluded_dates', 'created_by', 'updated_at')
+
+
+class GuestPermissionBatchSerializer(serializers.Serializer):
+    """Validates a batch grant: one window applied to many guests. Guest ids are checked with a single
+    IN query instead of a lookup per id."""
+    guests = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=5000)
+    starts_on = serializers.DateTimeField(required=False)
+    expires_on = serializers.DateTimeField()
+    once_off = serializers.BooleanField(required=False, default=False)
+    schedule = serializers.PrimaryKeyRelatedField(queryset=AccessSchedule.objects.all(), required=False, allow_null=True)
+    site = serializers.PrimaryKeyRelatedField(queryset=Site.objects.all(), required=False, allow_null=True)
+
+    def validate_guests(self, value):
+        guest_ids = list(OrderedDict.fromkeys(value))  # drop repeats, keep order
+        missing = set(guest_ids) - set(Guest.objects.alive().filter(pk__in=guest_ids).values_list('pk', flat=True))
+        if missing:
+            raise serializers.ValidationError("Unknown guest ids: {0}".format(sorted(missing)))
+        return guest_ids
+
+    def validate(self, data):
+        if data.get('starts_on') and data['starts_on'] >= data['expires_on']:
+            raise serializers.ValidationError("expires_on must be later than starts_on")
+        return data
+
+
+class SiteSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Site
+        fields = ('id', 'name', 'code', 'database')
+
+
+class GateSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Gate
+        fields = ('id', 'site', 'name')
+
+
+class PresenceSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Presence
+        fields = ('responsible_user', 'responsible_guest', 'inside', 'changed_on', 'seen_on')
+        read_only_fields = fields
+
+
+class PurgeJobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = PurgeJob
+        fields = ('id', 'kind', 'guest_id', 'cutoff', 'state', 'deleted', 'error', 'created_on', 'updated_on', 'finished_on')
+        read_only_fields = fields
+
+
 class GuestSerializer(serializers.ModelSerializer):
     """Serializer to map the Model instance to JSON format. The ModelSerializer class simply provides a
        shortcut compared to the normal Serializer implementation by automatically declaring fields that
@@ -33,6 +101,18 @@ class GuestSerializer(serializers.ModelSerializer):
         read_only_fields = ('created_on', 'created_by')
 
 
+class ActiveGuestSerializer(GuestSerializer):
+    """A guest allowed in at some instant, with the ids of the permissions admitting it, taken from the
+    {guest id: [permission ids]} map in the 'active' context entry (see api.active.active_at)."""
+    active_permissions = serializers.SerializerMethodField()
+
+    class Meta(GuestSerializer.Meta):
+        fields = GuestSerializer.Meta.fields + ('active_permissions',)
+
+    def get_active_permissions(self, guest):
+        return sorted(self.context['active'].get(guest.pk, ()))
+
+
 class GuestDetailSerializer(GuestSerializer):
     """Detail serializer for individual guest instances. Indicates extra information such as the guest's
        gate interactions and permissions. Inherits from GuestSerializer to avoid redefining created_by"""
@@ -71,32 +151,99 @@ class CreateUserSerializer(serializers.ModelSerializer):
         return user
 
 
-class UserGateActivitySerializer(serializers.ModelSerializer):
+class SiteActivitySerializer(serializers.ModelSerializer):
+    """Base of the gate activity serializers: the gate opened - given when logging an open, or else the
+    gate of the requesting device, if any - and its site, looked up in api.sites.registry rather than
+    the database."""
+    gate = serializers.IntegerField(source='gate_id', required=False, allow_null=True)
+    site = serializers.ReadOnlyField(source='site_id')
+
+    def validate_gate(self, value):
+        if value is not None and registry.site_of(value) is None:
+            raise serializers.ValidationError("Unknown gate {0}.".format(value))
+        return value
+
+    def locate(self, validated_data):
+        """Set the gate_id and site_id of validated_data. A device with a gate of its own only logs opens
+        of that gate: a different gate in the request is refused."""
+        request = self.context.get('request')
+        gate_id = validated_data.get('gate_id')
+        if request is not None and isinstance(request.successful_authenticator, DeviceAuthentication):
+            own = principal_cache.gate(request.auth)
+            if own is not None and gate_id not in (None, own):
+                raise exceptions.PermissionDenied(detail="This device only opens gate {0}".format(own))
+            gate_id = own if gate_id is None else gate_id
+        validated_data['gate_id'] = gate_id
+        validated_data['site_id'] = None if gate_id is None else registry.site_of(gate_id)
+        return validated_data
+
+
+class UserGateActivitySerializer(SiteActivitySerializer):
 
     responsible_user = serializers.ReadOnlyField(source='responsible_user.username')
 
     class Meta:
         model = GateActivity
-        fields = ('id', 'date', 'responsible_user', 'gate_status')
+        fields = ('id', 'date', 'responsible_user', 'gate', 'site', 'gate_status')
         read_only_fields = ('date', 'responsible_guest')
 
+    def create(self, validated_data):
+        return log_activity(**self.locate(validated_data))
 
-class GuestGateActivitySerializer(serializers.ModelSerializer):
+
+class GuestGateActivitySerializer(SiteActivitySerializer):
 
     class Meta:
         model = GateActivity
-        fields = ('id', 'date', 'responsible_guest', 'gate_status')
+        fields = ('id', 'date', 'responsible_guest', 'gate', 'site', 'gate_status')
         read_only_fields = ('date', 'responsible_guest')
 
-    def validate(self, data):
-        if timezone.now() > data['expires_on']:
-            raise exceptions.PermissionDenied(detail="Permission expired on {0}".format(data['expires_on']))
-        elif timezone.now() < data['starts_on']:
-            raise exceptions.PermissionDenied(detail="Permission not yet active. Activation begins {0}".format(data['starts_on']))
-        elif data['once_off'] and data['once_off_used']:
-            raise exceptions.PermissionDenied(detail="Once of permission has been used")
-        else:
-            return data
+    def check_window(self, permission, now):
+        """Raise PermissionDenied unless now falls within the permission's validity window [starts_on,
+        expires_on) and schedule - the same boundaries as GuestPermissionQuerySet.consume_once_off."""
+        if now >= permission.expires_on:
+            raise exceptions.PermissionDenied(detail="Permission expired on {0}".format(permission.expires_on))
+        elif now < permission.starts_on:
+            raise exceptions.PermissionDenied(detail="Permission not yet active. Activation begins {0}".format(permission.starts_on))
+        elif permission.schedule is not None and not permission.schedule.allows(now):
+            raise exceptions.PermissionDenied(detail="Permission is not valid at this time")
+
+    def check_site(self, permission, site_id):
+        """Raise PermissionDenied if the permission is limited to another site than that of the gate. Only
+        a device with a gate of its own vouches for where the open happens: for any other caller the site
+        is that of the gate named in the request, if any."""
+        if permission.site_id is not None and permission.site_id != site_id:
+            raise exceptions.PermissionDenied(detail="Permission is not valid at this site")
+
+    def create(self, validated_data):
+        """Redeem the permission passed in by the view and log the interaction. A once-off permission
+        is consumed by a conditional UPDATE in the same transaction as the INSERT, so either both
+        happen or neither does. Any other permission needs nothing but the INSERT. With write-behind
+        enabled the INSERT is replaced by a journal append."""
+        permission = validated_data.pop('permission')
+        validated_data.pop('token')  # resolved to permission by the view
+        now = timezone.now()
+        self.check_window(permission, now)
+        self.check_site(permission, self.locate(validated_data)['site_id'])
+        if not permission.once_off:
+            return log_activity(responsible_guest_id=permission.guest_id, **validated_data)
+        with transaction.atomic():
+            if not GuestPermission.objects.consume_once_off(permission.permission_id, now):
+                raise exceptions.PermissionDenied(detail="Once off permission has been used")
+            return log_activity(responsible_guest_id=permission.guest_id, **validated_data)
+
+
+class OfflineEventSerializer(serializers.Serializer):
+    """A gate interaction recorded by a controller while offline. permission is the permission id from
+    the bundle, or null for an open by the controller's own user."""
+    date = serializers.DateTimeField()
+    gate_status = serializers.ChoiceField(choices=((1, 'HIGH'), (0, 'LOW')))
+    permission = serializers.IntegerField(allow_null=True, required=False, default=None)
+
+
+class OfflineBatchSerializer(serializers.Serializer):
+    batch_id = serializers.CharField(max_length=64)
+    events = OfflineEventSerializer(many=True)
 
 
 class GateActivitySerializer(UserGateActivitySerializer):
@@ -104,5 +251,5 @@ class GateActivitySerializer(UserGateActivitySerializer):
     responsible_x fields will be set in each record."""
 
     class Meta(UserGateActivitySerializer.Meta):
-        fields = ('id', 'date', 'responsible_user', 'responsible_guest', 'gate_status')
+        fields = ('id', 'date', 'responsible_user', 'responsible_guest', 'gate', 'site', 'gate_status')
 
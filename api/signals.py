@@ -0,0 +1,119 @@
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.dispatch import receiver
+
+from django.contrib.auth.models import User
+from . import active, archive, presence, rollups, routers, sites, stream
+from .authentication import principal_cache
+from .cache import token_cache
+from .models import (ACTIVITY_DELETIONS, AccessSchedule, Device, Gate, Guest, GateActivity, GuestPermission, PermissionChange,
+                     PermissionSpan, Site, Watermark)
+
+
+@receiver(post_save, sender=GuestPermission)
+@receiver(post_delete, sender=GuestPermission)
+def invalidate_permission_token(sender, instance, **kwargs):
+    """Evict a permission's token from the token cache whenever it changes or is removed."""
+    token_cache.invalidate(instance.token)
+
+
+@receiver(post_save, sender=GuestPermission)
+@receiver(post_delete, sender=GuestPermission)
+def log_permission_change(sender, instance, raw=False, **kwargs):
+    """Append the write to the permission change log that offline gate controllers sync from."""
+    if not raw:
+        PermissionChange.objects.record([instance.pk])
+
+
+@receiver(post_save, sender=GuestPermission)
+def index_permission_window(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    """Keep the permission's spans in the active-permission index (api.active) in line with its window."""
+    if raw or update_fields and not {'guest', 'starts_on', 'expires_on'} & set(update_fields):
+        return
+    if not created:
+        PermissionSpan.objects.filter(permission_id=instance.pk).delete()
+    active.index([(instance.pk, instance.guest_id, instance.starts_on, instance.expires_on)])
+
+
+@receiver(post_save, sender=AccessSchedule)
+def reschedule_permissions(sender, instance, created, raw=False, **kwargs):
+    """A changed schedule changes every permission using it: evict their cached tokens and log them as
+    changed so that gate controllers re-fetch them with the new schedule."""
+    if created or raw:
+        return
+    permissions = list(instance.permissions.values_list('id', 'token'))
+    for _, token in permissions:
+        token_cache.invalidate(token)
+    PermissionChange.objects.record([pk for pk, _ in permissions])
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+@receiver(post_save, sender=Gate)
+@receiver(post_delete, sender=Gate)
+def reload_sites(sender, **kwargs):
+    """Have the site registry reload the sites and gates once one of them changes."""
+    sites.registry.clear()
+
+
+@receiver(post_save, sender=Guest)
+@receiver(post_delete, sender=Guest)
+def invalidate_guest_tokens(sender, instance, **kwargs):
+    """Evict all cached tokens of a guest whenever the guest changes or is removed."""
+    token_cache.invalidate_guest(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Guest)
+def hide_archived_activity(sender, instance, **kwargs):
+    """Stop reading the archived activity of a deleted user or guest back (see api.archive)."""
+    archive.people.forget(sender, instance.pk)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Guest)
+def count_cascaded_activity(sender, instance, **kwargs):
+    """A deleted user or guest takes its gate interactions with it: count that as an activity deletion."""
+    Watermark.advance(ACTIVITY_DELETIONS)
+
+
+@receiver(post_save, sender=GateActivity)
+def rollup_activity(sender, instance, created, raw=False, **kwargs):
+    """Count a new gate interaction into the activity rollups (unless they are maintained in batch)."""
+    if created and not raw and rollups.rollup_mode() == 'save':
+        rollups.apply([instance])
+
+
+@receiver(post_save, sender=GateActivity)
+def track_presence(sender, instance, created, raw=False, **kwargs):
+    """Move the user or guest of a new gate interaction inside or outside (see api.presence)."""
+    if created and not raw:
+        presence.apply([instance])
+
+
+@receiver(post_save, sender=GateActivity)
+def wake_activity_stream(sender, instance, created, raw=False, **kwargs):
+    """Have live activity streams pick up a new gate interaction as soon as it is committed."""
+    if created and not raw:
+        transaction.on_commit(stream.notify)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidate_device(sender, instance, **kwargs):
+    """Drop a device's cached principal whenever it changes (e.g. is deactivated) or is removed."""
+    principal_cache.invalidate(instance.key_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_devices(sender, instance, **kwargs):
+    """Drop the cached principals of a user's devices whenever the user changes or is removed."""
+    principal_cache.invalidate_user(instance.pk)
+
+
+@receiver(request_finished)
+def reset_database_routing(sender, **kwargs):
+    """Forget the replica routing of a finished request (streamed responses included)."""
+    routers.end_request()
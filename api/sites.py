@@ -0,0 +1,175 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+def site_databases():
+    """Aliases in DATABASES (besides 'default') holding the gate activity of sites (SITE_DATABASES)."""
+    return getattr(settings, 'SITE_DATABASES', ())
+
+
+def activity_databases():
+    """Every database that may hold gate activity: the default database first, then SITE_DATABASES."""
+    return [DEFAULT_DB_ALIAS] + [alias for alias in site_databases() if alias != DEFAULT_DB_ALIAS]
+
+
+def validate_database(value):
+    if value and value not in site_databases():
+        raise ValidationError("{0} is not one of the SITE_DATABASES".format(value))
+
+
+class SiteRegistry(object):
+    """Process-local copy of the (few, rarely changed) sites and gates: the site of every gate and the
+    database holding every site's activity. Loaded with two small queries and reloaded after `ttl`
+    seconds or once a Site or Gate is saved or deleted (signals), so routing a gate open needs no
+    query of its own."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._gates = {}  # gate id -> site id
+        self._databases = {}  # site id -> alias
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        from .models import Gate, Site
+
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._databases = {pk: database or DEFAULT_DB_ALIAS
+                                   for pk, database in Site.objects.values_list('id', 'database')}
+                self._gates = dict(Gate.objects.values_list('id', 'site_id'))
+                self._loaded_at = time.monotonic()
+            return self._gates, self._databases
+
+    def site_of(self, gate_id):
+        """Site id of gate_id, None for unknown gates."""
+        return self._current()[0].get(gate_id)
+
+    def database(self, site_id):
+        """Alias of the database holding site_id's activity: the default database for activity without a
+        site and for sites without a database of their own."""
+        if site_id is None:
+            return DEFAULT_DB_ALIAS
+        return self._current()[1].get(site_id, DEFAULT_DB_ALIAS)
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+registry = SiteRegistry(ttl=getattr(settings, 'SITE_REGISTRY', {}).get('TTL', 60))
+
+
+def bulk_create(activities, key):
+    """Insert the unsaved GateActivity rows activities, each into the database of its site, exactly once for
+    the batch key (bulk_create bypasses the routers). The caller works in a transaction on the default
+    database, skips the batch if key is recorded there (an IngestedBatch) and records it in the same
+    transaction once done with the rows; their rows for the default database are inserted in it too. Rows
+    for a site database are committed in a transaction of their own there, together with an IngestedBatch
+    for key - and skipped if that database has one already, left by an attempt whose default transaction
+    did not commit. So neither a retry nor a concurrent copy of the batch (which fails on the key) inserts
+    rows twice."""
+    from .models import GateActivity, IngestedBatch
+
+    groups = OrderedDict()
+    for activity in activities:
+        groups.setdefault(registry.database(activity.site_id), []).append(activity)
+    for alias, rows in groups.items():
+        if alias == DEFAULT_DB_ALIAS:
+            GateActivity.objects.bulk_create(rows)
+            continue
+        with transaction.atomic(using=alias):
+            if not IngestedBatch.objects.using(alias).filter(key=key).exists():
+                GateActivity.objects.using(alias).bulk_create(rows)
+                IngestedBatch.objects.using(alias).create(key=key, rows=len(rows))
+
+
+def forget_batch(key):
+    """Drop the IngestedBatch markers of key from every activity database."""
+    from .models import IngestedBatch
+
+    for alias in activity_databases():
+        IngestedBatch.objects.using(alias).filter(key=key).delete()
+
+
+def partitions(queryset, site=None):
+    """queryset once per activity database it has to be read from: the database of site if given (a site
+    id, possibly as a string from a query param), otherwise every activity database. Querysets on the
+    default database are left unpinned, so they still go through replica routing."""
+    if site not in (None, ''):
+        try:
+            aliases = [registry.database(int(site))]
+        except (TypeError, ValueError):
+            aliases = [DEFAULT_DB_ALIAS]  # rejected by the view's filter, which reads nothing
+    else:
+        aliases = activity_databases()
+    return [queryset if alias == DEFAULT_DB_ALIAS else queryset.using(alias) for alias in aliases]
+
+
+def fetch(queryset, limit=None):
+    """list(queryset[:limit]) for a GateActivity queryset on any activity database. The users, guests,
+    gates and sites activity refers to live in the default database only, so on a site database
+    select_related joins are turned into prefetches and related values_list columns (such as
+    responsible_user__username) are read from there, with one IN query per relation."""
+    if queryset.db not in site_databases():
+        return list(queryset[:limit])
+    fields = queryset._fields
+    if not fields:
+        related = queryset.query.select_related
+        if isinstance(related, dict) and related:
+            queryset = queryset.select_related(None).prefetch_related(*related)
+        return list(queryset[:limit])
+
+    columns = [local_column(queryset.model, name) for name in fields]
+    return resolve_related(queryset.model, fields, queryset.values_list(*columns)[:limit])
+
+
+def local_column(model, name):
+    """The column of model's own table standing in for values_list field name: the foreign key for a
+    related lookup such as responsible_user__username."""
+    relation, _, column = name.partition('__')
+    return model._meta.get_field(relation).attname if column else name
+
+
+def resolve_related(model, fields, rows):
+    """values_list tuples for fields from rows of local_column() values: the related lookups among fields
+    are read from the default database by the foreign keys in their place, one IN query per relation."""
+    rows = [list(row) for row in rows]
+    relations = {}
+    for index, name in enumerate(fields):
+        relation, _, column = name.partition('__')
+        if column:
+            relations.setdefault(model._meta.get_field(relation), []).append((index, column))
+    for field, targets in relations.items():
+        keys = [row[targets[0][0]] for row in rows]
+        ids = set(keys) - {None}
+        found = {}
+        if ids:
+            found = {row[0]: row[1:] for row in field.related_model._base_manager.filter(pk__in=ids)
+                     .values_list('pk', *[column for _, column in targets])}
+        for row, key in zip(rows, keys):
+            values = found.get(key)
+            for offset, (index, _) in enumerate(targets):
+                row[index] = values[offset] if values else None
+    return [tuple(row) for row in rows]
+
+
+def merge(iterables, key, reverse=False):
+    """Merge iterables each already sorted by key into one sorted iterator, reading them lazily."""
+    if len(iterables) == 1:
+        return iter(iterables[0])
+    return heapq.merge(*iterables, key=key, reverse=reverse)
+
+
+class SitePartitionMixin(object):
+    """For the activity views: reads filtered by ?site= go to that site's database only, all others are
+    fanned out to every activity database and their rows merged (see GateActivityCursorPagination)."""
+
+    def get_partitions(self, queryset):
+        return partitions(queryset, self.request.query_params.get('site'))
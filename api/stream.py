@@ -0,0 +1,263 @@
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection
+from django.db.models import Max
+from .export import ACTIVITY_COLUMNS, NDJSONRenderer, activity_row
+from .models import GateActivity
+from .sites import activity_databases, fetch, merge, partitions
+
+logger = logging.getLogger(__name__)
+
+
+class EventStreamRenderer(NDJSONRenderer):
+    """Only used for content negotiation (Accept: text/event-stream) - streams are written by the view."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+
+class Subscription(object):
+    """One stream's queue of published rows. A stream that falls more than max_size rows behind is marked
+    overflowed and dropped by the broker; it then ends and the client resumes from its Last-Event-ID.
+    positions maps activity databases to the id after which the broker publishes their rows to it, where
+    the broker knows."""
+
+    def __init__(self, max_size, positions=None):
+        self.max_size = max_size
+        self.positions = positions or {}
+        self.overflowed = False
+        self._rows = []
+        self._ready = threading.Condition()
+
+    def put(self, rows):
+        with self._ready:
+            if len(self._rows) + len(rows) > self.max_size:
+                self.overflowed = True
+            else:
+                self._rows.extend(rows)
+            self._ready.notify()
+        return not self.overflowed
+
+    def get(self, timeout):
+        """Every queued row, waiting up to timeout seconds for the first one. Empty on timeout."""
+        with self._ready:
+            if not self._rows and not self.overflowed:
+                self._ready.wait(timeout)
+            rows, self._rows = self._rows, []
+        return rows
+
+
+class ActivityBroker(object):
+    """In-process fan-out of new activity rows (dicts as built by export.activity_row, plus the alias of
+    their 'database') to every subscribed stream. Rows only come in through publish(), so on its own the
+    broker never touches the database."""
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def subscribe(self):
+        with self._lock:
+            subscription = Subscription(self.queue_size, self._starting_positions())
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def _starting_positions(self):
+        """Positions of a new subscription (see Subscription), taken under the lock. Unknown here."""
+        return {}
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, rows):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.put(rows):
+                self.unsubscribe(subscription)
+
+    def watchers(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def wake(self):
+        """Hint that new rows were committed. Nothing to do for a broker that is fed by publish()."""
+
+
+class TailingBroker(ActivityBroker):
+    """Broker fed by one background thread tailing the activity table of every activity database by id:
+    one query per database every poll_interval seconds (sooner after wake()) serves every stream of the
+    process, and picks up rows inserted by other processes, offline uploads and the write-behind journal
+    alike. positions holds the last id published per database. Nothing is queried while nobody is
+    watching; the first subscriber after such a spell starts from the newest rows, as the rows inserted
+    meanwhile are no longer live (a resuming client reads them from the databases). A row whose
+    transaction commits after one with a higher id in its database has been published is not streamed
+    live (it still shows in the listings and on resume)."""
+
+    def __init__(self, poll_interval=1.0, batch_size=500, queue_size=1000, start_tailer=True):
+        super(TailingBroker, self).__init__(queue_size)
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.start_tailer = start_tailer
+        self.positions = None
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self):
+        subscription = super(TailingBroker, self).subscribe()
+        with self._lock:
+            if self.start_tailer and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='activity-stream-tailer')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def _starting_positions(self):
+        if self.positions is None or not self._subscriptions:
+            self.positions = {alias: activity.aggregate(last=Max('id'))['last'] or 0
+                              for alias, activity in zip(activity_databases(), partitions(GateActivity.objects.all()))}
+        return dict(self.positions)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def poll(self):
+        """Publish the rows inserted since the last poll, up to batch_size per database, merged by date.
+        Returns the number published."""
+        positions, batches = dict(self.positions), []
+        for alias, activity in zip(activity_databases(), partitions(GateActivity.objects.all())):
+            rows = fetch(activity.filter(id__gt=positions.get(alias, 0)).order_by('id')
+                         .values_list(*ACTIVITY_COLUMNS), self.batch_size)
+            if rows:
+                positions[alias] = rows[-1][0]
+                batches.append([(alias, values) for values in rows])
+        rows = [dict(activity_row(values), database=alias) for alias, values in merge(batches, key=_date)]
+        self.positions = positions
+        if rows:
+            self.publish(rows)
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self.watchers():
+                continue
+            close_old_connections()
+            try:
+                while self.poll() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Tailing the activity table failed, will retry")
+
+
+def stream_options():
+    return getattr(settings, 'ACTIVITY_STREAM', {})
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The process-wide broker, created on first use."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            options = stream_options()
+            _broker = TailingBroker(poll_interval=options.get('POLL_INTERVAL', 1.0),
+                                    queue_size=options.get('QUEUE_SIZE', 1000))
+        return _broker
+
+
+def notify():
+    """Wake the process-wide broker (if any stream ever started) to publish freshly committed rows."""
+    if _broker is not None:
+        _broker.wake()
+
+
+def _date(item):
+    return item[1][1]
+
+
+def event_id(positions):
+    """Event id of a row: where the stream is in each activity database after it, as
+    '<alias>:<id>' pairs ('default:120,site_b:42'), so a client resuming from it misses nothing."""
+    return ','.join('{0}:{1}'.format(alias, pk) for alias, pk in sorted(positions.items()))
+
+
+def parse_event_id(value):
+    """The positions (alias -> id) of an event_id(). A bare id, as sent before activity was split over
+    databases, is a position in the default database. Raises ValueError for anything else."""
+    try:
+        return {DEFAULT_DB_ALIAS: int(value)}
+    except ValueError:
+        pass
+    positions = {}
+    for part in value.split(','):
+        alias, _, pk = part.rpartition(':')
+        if alias not in activity_databases():
+            raise ValueError("Unknown activity database {0!r}".format(alias))
+        positions[alias] = int(pk)
+    return positions
+
+
+def format_event(row, positions):
+    data = {key: value for key, value in row.items() if key != 'database'}
+    return 'id: {0}\nevent: activity\ndata: {1}\n\n'.format(event_id(positions), json.dumps(data))
+
+
+def _missed(activity, alias, last_id, chunk_size):
+    queryset = activity.order_by('id').values_list(*ACTIVITY_COLUMNS)
+    while True:
+        chunk = fetch(queryset.filter(id__gt=last_id), chunk_size)
+        for values in chunk:
+            yield alias, values
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def missed(positions, chunk_size):
+    """Yield the rows after positions (alias -> id; from the start for a database without one) of every
+    activity database, each database's in id order and read in keyset chunks of chunk_size, merged by
+    date."""
+    rows = [_missed(activity, alias, positions.get(alias, 0), chunk_size)
+            for alias, activity in zip(activity_databases(), partitions(GateActivity.objects.all()))]
+    for alias, values in merge(rows, key=_date):
+        yield dict(activity_row(values), database=alias)
+
+
+def event_stream(broker, positions=None, heartbeat=15, retry=3000, chunk_size=500):
+    """Yield Server-Sent Events for the rows broker publishes, after replaying those after positions (if
+    given, see parse_event_id) from the databases. Rows are subscribed to before the replay and
+    deduplicated by id per database, so none fall in between. A comment line is sent every heartbeat
+    seconds without rows to keep proxies from closing an idle stream. Ends when the subscription
+    overflows."""
+    subscription = broker.subscribe()
+    try:
+        yield 'retry: {0}\n\n'.format(retry)
+        if positions is None:
+            positions = dict(subscription.positions)
+        else:
+            positions = dict(positions)
+            for row in missed(positions, chunk_size):
+                positions[row['database']] = row['id']
+                yield format_event(row, positions)
+            if not connection.in_atomic_block:
+                connection.close()  # don't hold a connection for the lifetime of the stream
+        while True:
+            rows = [row for row in subscription.get(heartbeat) if row['id'] > positions.get(row['database'], 0)]
+            for row in rows:
+                positions[row['database']] = row['id']
+                yield format_event(row, positions)
+            if subscription.overflowed:
+                return
+            if not rows:
+                yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,158 @@
+import hashlib
+import hmac
+import json
+from calendar import timegm
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from . import presence, rollups, sites
+from .models import AccessSchedule, GateActivity, GuestPermission, IngestedBatch, PermissionChange, Watermark
+
+# layout of each permission in bundles and deltas, and of the schedules they refer to
+PERMISSION_FIELDS = ('id', 'token_hash', 'guest', 'starts_on', 'expires_on', 'once_off', 'schedule', 'site')
+SCHEDULE_FIELDS = ('timezone', 'week', 'excluded_dates')
+PRUNED_WATERMARK = 'permission_changes_pruned'
+
+
+def token_hash(token):
+    """What controllers store and compare instead of the token: the first 128 bits of its SHA-256, hex."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+
+def sign(secret, payload):
+    """Sign payload with the device secret: HMAC-SHA256 over its canonical (sorted, compact) JSON."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), canonical, hashlib.sha256).hexdigest()
+
+
+def signed(secret, payload):
+    return {'payload': payload, 'signature': sign(secret, payload)}
+
+
+def stable_version(settle=timedelta(seconds=30)):
+    """Highest change id that can be handed out as a sync version. Changes younger than settle are held
+    back, so that a change whose transaction commits after one with a higher id is never skipped - it
+    is re-sent on the next sync instead, which is harmless as applying a delta is idempotent."""
+    unsettled = PermissionChange.objects.filter(changed_on__gte=timezone.now() - settle).aggregate(first=Min('id'))['first']
+    if unsettled:
+        return unsettled - 1
+    return PermissionChange.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def _valid(queryset, now):
+    return queryset.filter(expires_on__gt=now).exclude(once_off=True, once_off_used=True)
+
+
+def _rows(queryset):
+    return [[pk, token_hash(token), guest, timegm(starts_on.utctimetuple()), timegm(expires_on.utctimetuple()), once_off, schedule, site]
+            for pk, token, guest, starts_on, expires_on, once_off, schedule, site in
+            queryset.order_by('id').values_list('id', 'token', 'guest_id', 'starts_on', 'expires_on', 'once_off', 'schedule_id',
+                                                'site_id')]
+
+
+def _schedules(rows):
+    """The schedules used by rows, by id: time zone, week bitmap (hex, bit weekday * 1440 + minute) and
+    excluded dates, for controllers to apply exactly as api.schedules.CompiledSchedule does."""
+    ids = {row[6] for row in rows if row[6] is not None}
+    if not ids:
+        return {}
+    return {str(pk): [timezone_name, bytes(week).hex(), excluded_dates] for pk, timezone_name, week, excluded_dates in
+            AccessSchedule.objects.filter(id__in=ids).values_list('id', *SCHEDULE_FIELDS)}
+
+
+def bundle():
+    """Every permission a controller may currently need to honour (not expired, not used up), with windows
+    as unix times, the schedules they refer to and the version to request deltas from."""
+    now = timezone.now()
+    version = stable_version()
+    rows = _rows(_valid(GuestPermission.objects.all(), now))
+    return {
+        'version': version,
+        'generated_on': timegm(now.utctimetuple()),
+        'fields': PERMISSION_FIELDS,
+        'permissions': rows,
+        'schedule_fields': SCHEDULE_FIELDS,
+        'schedules': _schedules(rows),
+    }
+
+
+def delta(since):
+    """Permissions written after version since: rows that are (still) valid to upsert, and ids to drop
+    because they were deleted, used up or expired. Returns None if the change log no longer reaches back
+    to since, in which case the controller has to fetch a full bundle."""
+    if since < Watermark.get(PRUNED_WATERMARK).position:
+        return None
+    now = timezone.now()
+    version = stable_version()
+    changed = set(PermissionChange.objects.filter(id__gt=since).values_list('permission_id', flat=True))
+    upserts = _rows(_valid(GuestPermission.objects.filter(id__in=changed), now))
+    return {
+        'version': max(version, since),
+        'generated_on': timegm(now.utctimetuple()),
+        'fields': PERMISSION_FIELDS,
+        'permissions': upserts,
+        'schedule_fields': SCHEDULE_FIELDS,
+        'schedules': _schedules(upserts),
+        'revoked': sorted(changed - {row[0] for row in upserts}),
+    }
+
+
+def prune_changes(before):
+    """Drop change log entries older than before. Controllers synced to an older version get a full bundle."""
+    with transaction.atomic():
+        last = (PermissionChange.objects.filter(changed_on__lt=before).aggregate(last=Max('id'))['last'])
+        if last:
+            PermissionChange.objects.filter(id__lte=last).delete()
+            Watermark.objects.update_or_create(name=PRUNED_WATERMARK, defaults={'position': last})
+    return last or 0
+
+
+def prune_batches(before):
+    """Forget the offline batches received before before: a controller retrying one of them after that
+    has it ingested again. Returns the number of markers dropped (in every activity database)."""
+    return sum(IngestedBatch.objects.using(alias).filter(received_on__lt=before).delete()[0]
+               for alias in sites.activity_databases())
+
+
+def ingest_offline(events, user, batch_key, gate_id=None):
+    """Log gate interactions a controller recorded while offline at gate_id (the controller's gate, if it
+    has one). events are dicts with date, gate_status and permission (the permission id from the bundle,
+    or None for an open by the controller's own user). Events of permissions deleted in the meantime are
+    skipped and once-off permissions they used are marked used. The batch is recorded under batch_key (an
+    IngestedBatch, see prune_batches) along with its rows (see api.sites.bulk_create), so an upload retried
+    after a lost response, or sent twice at once, is not ingested twice. Returns (created, skipped), or
+    None for a repeated batch."""
+    marker = 'offline:' + hashlib.sha1(batch_key.encode('utf-8')).hexdigest()
+    permission_ids = {event['permission'] for event in events if event['permission'] is not None}
+    try:
+        with transaction.atomic():
+            if IngestedBatch.objects.filter(key=marker).exists():
+                return None
+            permissions = dict(GuestPermission.objects.filter(id__in=permission_ids).values_list('id', 'guest_id'))
+            location = {'gate_id': gate_id, 'site_id': None if gate_id is None else sites.registry.site_of(gate_id)}
+            activities = []
+            for event in events:
+                if event['permission'] is None:
+                    activities.append(GateActivity(date=event['date'], responsible_user=user,
+                                                   gate_status=event['gate_status'], **location))
+                elif event['permission'] in permissions:
+                    activities.append(GateActivity(date=event['date'],
+                                                   responsible_guest_id=permissions[event['permission']],
+                                                   gate_status=event['gate_status'], **location))
+            sites.bulk_create(activities, marker)
+            if rollups.rollup_mode() == 'save':
+                rollups.apply(activities)
+            presence.apply(activities)
+            used = list(GuestPermission.objects.filter(id__in=list(permissions), once_off=True, once_off_used=False)
+                        .values_list('id', flat=True))
+            if used:
+                GuestPermission.objects.filter(id__in=used).update(once_off_used=True, updated_at=timezone.now())
+                PermissionChange.objects.record(used)
+            IngestedBatch.objects.create(key=marker, rows=len(activities))
+    except IntegrityError:
+        if any(IngestedBatch.objects.using(alias).filter(key=marker).exists() for alias in sites.activity_databases()):
+            return None  # a concurrent copy of the batch got in first
+        raise
+    return len(activities), len(events) - len(activities)
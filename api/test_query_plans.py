@@ -0,0 +1,121 @@
+import re
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .cache import token_cache
+from .models import Gate, Guest, GateActivity, GuestPermission, Site
+from .sites import registry
+
+
+def explain(sql):
+    """Return the query plan for sql as a list of strings, in the current backend's EXPLAIN dialect."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + sql)
+        columns = [col[0] for col in cursor.description]
+        return [str(dict(zip(columns, row))) for row in cursor.fetchall()]
+
+
+def full_scans(plan):
+    """Return the plan lines that read a whole table without the help of an index."""
+    if connection.vendor == 'sqlite':
+        return [line for line in plan if re.match(r'^SCAN (TABLE )?\w+$', line)]
+    if connection.vendor == 'mysql':
+        return [line for line in plan if "'type': 'ALL'" in line]
+    return [line for line in plan if 'Seq Scan' in line]
+
+
+class QueryPlanTestCase(TestCase):
+    """Runs every query issued by the api views against a seeded database through EXPLAIN and fails
+    on any full table scan. Add new endpoints/filters to `requests` below."""
+
+    users = 20
+    guests = 200
+    activities = 2000
+    # small configuration tables read whole on purpose (api.sites.SiteRegistry caches them per process)
+    whole_tables = ('api_site', 'api_gate')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username="admin", is_superuser=True)
+        User.objects.bulk_create([User(username="user{0}".format(i)) for i in range(cls.users)])
+        users = list(User.objects.all())
+        Guest.objects.bulk_create([Guest(first_name="Guest", surname=str(i), mobile="08{0:08d}".format(i),
+                                         created_by=users[i % len(users)]) for i in range(cls.guests)])
+        guests = list(Guest.objects.all())
+        now = timezone.now()
+        GuestPermission.objects.bulk_create([
+            GuestPermission(token="token{0}".format(i), guest=guests[i % len(guests)], granted_by=users[i % len(users)],
+                            expires_on=now + timedelta(days=i % 7 - 3))
+            for i in range(cls.guests * 3)])
+        sites = [Site.objects.create(name="Site {0}".format(i), code="site{0}".format(i)) for i in range(4)]
+        gates = [Gate.objects.create(site=site, name="Main") for site in sites]
+        GateActivity.objects.bulk_create([
+            GateActivity(responsible_user=users[i % len(users)] if i % 2 else None,
+                         responsible_guest=None if i % 2 else guests[i % len(guests)], gate_status=i % 2,
+                         gate=gates[i % len(gates)], site=sites[i % len(sites)])
+            for i in range(cls.activities)])
+        cls.user, cls.guest, cls.site, cls.gate = users[1], guests[1], sites[1], gates[1]
+        cls.permission = GuestPermission.objects.filter(guest=cls.guest).first()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        token_cache.clear()
+        registry.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def requests(self):
+        since = (timezone.now() - timedelta(hours=1)).isoformat().replace('+', '%2B')
+        return [
+            ('get', '/api/interactions/', None),
+            ('get', '/api/interactions/?since={0}'.format(since), None),
+            ('get', '/api/interactions/?responsible_user={0}'.format(self.user.pk), None),
+            ('get', '/api/interactions/?responsible_guest={0}'.format(self.guest.pk), None),
+            ('get', '/api/interactions/?site={0}'.format(self.site.pk), None),
+            ('get', '/api/interactions/user/', None),
+            ('get', '/api/interactions/guest/', None),
+            ('get', '/api/guests/{0}/'.format(self.guest.pk), None),
+            ('get', '/api/guests/active/', None),
+            ('get', '/api/presence/?inside=true', None),
+            ('get', '/api/guests/search/?q=gues', None),
+            ('get', '/api/guests/search/?q=1', None),
+            ('get', '/api/guests/search/?q=0800', None),
+            ('get', '/api/users/{0}/'.format(self.user.pk), None),
+            ('get', '/api/guests/permissions/?guest={0}'.format(self.guest.pk), None),
+            ('get', '/api/guests/permissions/?guest={0}&expires_on__gte={1}'.format(self.guest.pk, since), None),
+            ('get', '/api/guests/permissions/{0}/'.format(self.permission.pk), None),
+            ('post', '/api/interactions/guest/', {'token': self.permission.token, 'gate_status': 1}),
+            ('post', '/api/interactions/guest/', {'token': self.permission.token, 'gate_status': 1, 'gate': self.gate.pk}),
+        ]
+
+    def test_no_full_table_scans(self):
+        for method, url, data in self.requests():
+            with CaptureQueriesContext(connection) as context:
+                response = getattr(self.client, method)(url, data)
+            self.assertLess(response.status_code, 500, url)
+            for query in context.captured_queries:
+                if not query['sql'].lstrip().upper().startswith('SELECT'):
+                    continue
+                if re.search(r'FROM [`"]?({0})[`"]?\s*$'.format('|'.join(self.whole_tables)), query['sql']):
+                    continue
+                plan = explain(query['sql'])
+                self.assertEqual(full_scans(plan), [], "{0} {1}\n{2}\n{3}".format(method.upper(), url, query['sql'], plan))
+
+    def test_index_keeps_paging_flat(self):
+        """The next-page query of the activity listing must seek rather than scan."""
+        response = self.client.get('/api/interactions/')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(response.data['next'])
+        page_query = next(q['sql'] for q in context.captured_queries
+                          if 'FROM "api_gateactivity"' in q['sql'].replace('`', '"') and 'ORDER BY' in q['sql'])
+        plan = explain(page_query)
+        self.assertTrue(any('INDEX' in line.upper() or 'key' in line for line in plan), plan)
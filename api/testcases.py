@@ -0,0 +1,21 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin(object):
+    """TestCase mixin asserting that an endpoint stays within a fixed number of queries. Seed more
+    rows than a page holds before calling it, so an N+1 regression in a serializer blows the budget."""
+
+    def assertQueryBudget(self, endpoint, max_queries, method='get', data=None, status=None):
+        """Request endpoint through self.client and fail if it issued more than max_queries queries
+        (or, if given, answered with anything but status). Returns the response."""
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(endpoint, data)
+        if status is not None:
+            self.assertEqual(response.status_code, status, endpoint)
+        executed = len(context.captured_queries)
+        if executed > max_queries:
+            self.fail("{0} {1} issued {2} queries, budget is {3}:\n{4}".format(
+                method.upper(), endpoint, executed, max_queries,
+                '\n'.join(query['sql'] for query in context.captured_queries)))
+        return response
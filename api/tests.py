@@ -1,17 +1,1842 @@
-from django.test import TestCase
-from .models import Guests
+import base64
+import csv
+import importlib
+import json
+import random
+import os
+import shutil
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock
+from datetime import date, datetime, timedelta
+
+import pytz
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections, OperationalError
+from django.db.models import Count, Sum
+from django.db.models.signals import post_save
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from django.utils.http import urlencode
+from rest_framework import exceptions
+from rest_framework.test import APIClient
+from . import active, archive, journal, metrics, presence, purge, rollups, routers, schedules, sites, stream, sync
+from .authentication import device_token, principal_cache
+from .journal import ActivityJournal
+from .cache import GuestTokenCache, TokenEntry, token_cache, lookup_token
+from .models import (normalize_mobile, normalize_name, AccessSchedule, ActivityRollup, Device, Gate, Guest, GateActivity,
+                     GuestPermission, IngestedBatch, PermissionChange, PermissionSpan, Presence, PurgeJob, Site, Watermark)
+from .serializers import GuestGateActivitySerializer
+from .testcases import QueryBudgetMixin
+
 
 class ModelTestCase(TestCase):
-    """This class defines the test suite for the bucketlist model."""
+    """This class defines the test suite for the guest model."""
 
     def setUp(self):
         """Define the test client and other test variables."""
-        self.bucketlist_name = "Write world class code"
-        self.bucketlist = Bucketlist(name=self.bucketlist_name)
-
-    def test_model_can_create_a_bucketlist(self):
-        """Test the bucketlist model can create a bucketlist."""
-        old_count = Bucketlist.objects.count()
-        self.bucketlist.save()
-        new_count = Bucketlist.objects.count()
-        self.assertNotEqual(old_count, new_count)
\ No newline at end of file
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+
+    def test_model_can_create_a_guest(self):
+        """Test the guest model can create a guest."""
+        old_count = Guest.objects.count()
+        self.guest.save()
+        new_count = Guest.objects.count()
+        self.assertNotEqual(old_count, new_count)
+
+
+class GuestTokenCacheTestCase(TestCase):
+    """Test suite for the in-process guest token cache."""
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.permission = GuestPermission.objects.create(token="abc", guest=self.guest, granted_by=self.user,
+                                                         expires_on=timezone.now() + timedelta(days=1))
+
+    def test_lookup_hits_database_once(self):
+        with self.assertNumQueries(1):
+            first = lookup_token("abc")
+            second = lookup_token("abc")
+        self.assertEqual(first, second)
+        self.assertEqual(first.guest_id, self.guest.id)
+        self.assertEqual(token_cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_unknown_token(self):
+        self.assertIsNone(lookup_token("nope"))
+
+    def test_permission_save_invalidates(self):
+        lookup_token("abc")
+        self.permission.once_off = True
+        self.permission.save()
+        self.assertTrue(lookup_token("abc").once_off)
+
+    def test_permission_delete_invalidates(self):
+        lookup_token("abc")
+        self.permission.delete()
+        self.assertIsNone(lookup_token("abc"))
+
+    def test_guest_delete_invalidates(self):
+        lookup_token("abc")
+        self.guest.delete()
+        self.assertEqual(token_cache.stats()['size'], 0)
+        self.assertIsNone(lookup_token("abc"))
+
+    def test_lru_eviction_and_ttl(self):
+        cache = GuestTokenCache(max_size=2, ttl=60)
+        for token in ("a", "b", "c"):
+            cache.set(token, TokenEntry(1, None, None, False))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        cache.ttl = 0
+        self.assertIsNone(cache.get("c"))
+
+
+class GuestRedemptionTestCase(TestCase):
+    """Test suite for guest gate opens through interactions/guest/."""
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+
+    def grant(self, token, **kwargs):
+        kwargs.setdefault('expires_on', timezone.now() + timedelta(days=1))
+        return GuestPermission.objects.create(token=token, guest=self.guest, granted_by=self.user, **kwargs)
+
+    def open_gate(self, token):
+        return self.client.post('/api/interactions/guest/', {'token': token, 'gate_status': 1})
+
+    def test_valid_token_logs_activity(self):
+        self.grant("abc")
+        response = self.open_gate("abc")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['responsible_guest'], self.guest.id)
+        self.assertEqual(GateActivity.objects.filter(responsible_guest=self.guest).count(), 1)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')  # no rollup UPDATEs on the open itself
+    def test_cached_open_is_single_insert(self):
+        self.grant("abc")
+        self.open_gate("abc")
+        with self.assertNumQueries(2):  # the INSERT and the presence UPDATE
+            self.open_gate("abc")
+
+    def test_expired_and_pending_tokens_denied(self):
+        self.grant("old", starts_on=timezone.now() - timedelta(days=2), expires_on=timezone.now() - timedelta(days=1))
+        self.grant("new", starts_on=timezone.now() + timedelta(days=1))
+        self.assertEqual(self.open_gate("old").status_code, 403)
+        self.assertEqual(self.open_gate("new").status_code, 403)
+        self.assertFalse(GateActivity.objects.exists())
+
+    def test_expiry_boundary(self):
+        expiry = timezone.now() + timedelta(hours=1)
+        self.grant("normal", expires_on=expiry)
+        self.grant("once", expires_on=expiry, once_off=True)
+        with mock.patch('api.serializers.timezone.now', return_value=expiry):
+            for token in ("normal", "once"):
+                response = self.open_gate(token)
+                self.assertEqual(response.status_code, 403)
+                self.assertIn("expired", response.data['detail'])
+        self.assertFalse(GateActivity.objects.exists())
+
+    def test_once_off_token_consumed(self):
+        permission = self.grant("once", once_off=True)
+        self.assertEqual(self.open_gate("once").status_code, 201)
+        self.assertEqual(self.open_gate("once").status_code, 403)
+        permission.refresh_from_db()
+        self.assertTrue(permission.once_off_used)
+        self.assertEqual(GateActivity.objects.count(), 1)
+        self.assertEqual(PermissionChange.objects.latest('id').permission_id, permission.id)
+
+    def test_missing_and_invalid_token(self):
+        self.assertEqual(self.client.post('/api/interactions/guest/', {'gate_status': 1}).status_code, 400)
+        self.assertEqual(self.open_gate("nope").status_code, 400)
+
+
+class ConcurrentRedemptionTestCase(TransactionTestCase):
+    """Parallel redemptions of the same once-off token must yield exactly one gate open."""
+
+    workers = 8
+
+    def setUp(self):
+        token_cache.clear()
+        user = User.objects.create(username="admin")
+        guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=user)
+        GuestPermission.objects.create(token="once", guest=guest, granted_by=user, once_off=True,
+                                       expires_on=timezone.now() + timedelta(days=1))
+
+    def redeem(self, barrier, results):
+        permission = lookup_token("once")
+        barrier.wait()
+        try:
+            while True:
+                serializer = GuestGateActivitySerializer(data={'gate_status': 1})
+                serializer.is_valid(raise_exception=True)
+                try:
+                    serializer.save(token="once", permission=permission)
+                    results.append(True)
+                    return
+                except OperationalError:
+                    continue  # writer lock contention (SQLite) - retry until we get a definitive answer
+                except exceptions.PermissionDenied:
+                    results.append(False)
+                    return
+        finally:
+            connection.close()
+
+    def test_parallel_redemptions_succeed_once(self):
+        barrier = threading.Barrier(self.workers)
+        results = []
+        threads = [threading.Thread(target=self.redeem, args=(barrier, results)) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), self.workers)
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(GateActivity.objects.count(), 1)
+        self.assertTrue(GuestPermission.objects.get(token="once").once_off_used)
+
+
+class GateActivityPaginationTestCase(TestCase):
+    """Test suite for keyset pagination of the activity listings."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        start = timezone.now() - timedelta(days=1)
+        for i in range(25):
+            activity = GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+            # pairs of rows share a timestamp so the id tie-breaker is exercised
+            GateActivity.objects.filter(pk=activity.pk).update(date=start + timedelta(minutes=i // 2))
+        self.expected = list(GateActivity.objects.order_by('-date', '-id').values_list('id', flat=True))
+
+    def walk(self, url, link):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            url = response.data[link]
+        return ids
+
+    def test_forward_walk_is_stable_and_complete(self):
+        self.assertEqual(self.walk('/api/interactions/?page_size=4', 'next'), self.expected)
+
+    def test_backward_walk_from_last_page(self):
+        url = '/api/interactions/?page_size=4'
+        while True:
+            response = self.client.get(url)
+            if not response.data['next']:
+                break
+            url = response.data['next']
+        ids = [row['id'] for row in response.data['results']]
+        previous = response.data['previous']
+        pages = []
+        while previous:
+            response = self.client.get(previous)
+            pages.insert(0, [row['id'] for row in response.data['results']])
+            previous = response.data['previous']
+        self.assertEqual(sum(pages, []) + ids, self.expected)
+
+    def test_date_window(self):
+        window = list(GateActivity.objects.order_by('-date', '-id').values_list('date', flat=True))
+        since, until = window[-1] + timedelta(minutes=2), window[0]
+        ids = self.walk('/api/interactions/?page_size=3&since={0}&until={1}'.format(
+            since.isoformat().replace('+', '%2B'), until.isoformat().replace('+', '%2B')), 'next')
+        expected = list(GateActivity.objects.filter(date__gte=since, date__lt=until)
+                        .order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertTrue(0 < len(ids) < 25)
+
+    def test_bad_params(self):
+        self.assertEqual(self.client.get('/api/interactions/?cursor=garbage').status_code, 404)
+        self.assertEqual(self.client.get('/api/interactions/?since=yesterday').status_code, 400)
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Every endpoint must serve a full page with a fixed number of queries, however many rows."""
+
+    rows = 15
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create(username="admin", is_superuser=True)
+        self.client.force_authenticate(self.admin)
+        now = timezone.now()
+        for i in range(self.rows):
+            user = User.objects.create(username="user{0}".format(i))
+            guest = Guest.objects.create(first_name="Guest", surname=str(i), mobile=str(i), created_by=user)
+            GuestPermission.objects.create(token=str(i), guest=guest, granted_by=user, expires_on=now)
+            GateActivity.objects.create(responsible_user=user, gate_status=1)
+            GateActivity.objects.create(responsible_guest=guest, gate_status=0)
+        self.guest, self.user = guest, user
+
+    # budgets include the ETag fingerprint queries (1 per list, 2 per activity listing, 3 per guest detail)
+    def test_list_endpoints(self):
+        self.assertQueryBudget('/api/users/', 4, status=200)  # count, users, 2 prefetches
+        self.assertQueryBudget('/api/guests/', 3, status=200)
+        self.assertQueryBudget('/api/guests/permissions/', 3, status=200)
+        self.assertQueryBudget('/api/interactions/', 3, status=200)
+        self.assertQueryBudget('/api/interactions/user/', 3, status=200)
+        self.assertQueryBudget('/api/interactions/guest/', 3, status=200)
+
+    def test_detail_endpoints(self):
+        self.assertQueryBudget('/api/users/{0}/'.format(self.user.pk), 3, status=200)
+        self.assertQueryBudget('/api/guests/{0}/'.format(self.guest.pk), 6, status=200)
+        permission = GuestPermission.objects.first()
+        self.assertQueryBudget('/api/guests/permissions/{0}/'.format(permission.pk), 2, status=200)
+
+    def test_budget_catches_n_plus_one(self):
+        with self.assertRaises(AssertionError):
+            self.assertQueryBudget('/api/guests/', 1)
+
+
+class GuestImportTestCase(QueryBudgetMixin, TestCase):
+    """Test suite for the bulk guest import endpoint."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        Guest.objects.create(first_name="Old", surname="Guest", mobile="0800000000", created_by=self.user)
+
+    def upload(self, name, content, batch_size=2, budget=None):
+        upload = SimpleUploadedFile(name, content.encode('utf-8'))
+        url = '/api/guests/import/?batch_size={0}'.format(batch_size)
+        if budget is None:
+            return self.client.post(url, {'file': upload})
+        return self.assertQueryBudget(url, budget, method='post', data={'file': upload})
+
+    def test_csv_import_reports_row_errors(self):
+        content = ("first_name,surname,email,mobile\n"
+                   "Ann,One,ann@example.com,0810000001\n"
+                   "Bob,Two,bob@example.com,0800000000\n"  # taken by an existing guest
+                   "Cat,Three,not-an-email,0810000003\n"
+                   "Dan,Four,dan@example.com,0810000001\n"  # repeats row 1 (next batch)
+                   "Eve,Five,eve@example.com,0810000005\n")
+        response = self.upload('guests.csv', content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(sorted(error['row'] for error in response.data['errors']), [2, 3, 4])
+        self.assertEqual(Guest.objects.filter(created_by=self.user).count(), 3)
+
+    @override_settings(GUEST_IMPORT_MAX_BATCH_SIZE=3)
+    def test_batch_size_is_clamped(self):
+        with mock.patch('api.views.import_guests', return_value={'created': 0, 'errors': []}) as import_guests:
+            self.assertEqual(self.upload('guests.csv', "first_name,surname,email,mobile\n", batch_size=10 ** 7).status_code, 200)
+            self.assertEqual(import_guests.call_args[0][2], 3)
+            self.upload('guests.csv', "first_name,surname,email,mobile\n", batch_size=0)
+            self.assertEqual(import_guests.call_args[0][2], 1)
+
+    def test_ndjson_import(self):
+        content = '{"first_name": "Ann", "surname": "One", "email": "ann@example.com", "mobile": "0810000001"}\n' \
+                  'not json\n\n' \
+                  '{"first_name": "Bob", "surname": "Two", "email": "bob@example.com", "mobile": "0810000002"}\n'
+        response = self.upload('guests.ndjson', content)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([error['row'] for error in response.data['errors']], [2])
+
+    def test_queries_per_batch_not_per_row(self):
+        rows = ''.join("G,{0},g{0}@example.com,07{0:08d}\n".format(i) for i in range(100))
+        # per batch of 50: one IN query, one INSERT and its savepoint pair
+        response = self.upload('guests.csv', "first_name,surname,email,mobile\n" + rows, batch_size=50, budget=8)
+        self.assertEqual(response.data['created'], 100)
+
+    def test_rejects_unknown_format(self):
+        self.assertEqual(self.upload('guests.xls', 'x').status_code, 400)
+
+
+class GuestPermissionBatchTestCase(TestCase):
+    """Test suite for batch permission issuance."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guests = [Guest.objects.create(first_name="Guest", surname=str(i), mobile=str(i), created_by=self.user)
+                       for i in range(5)]
+        self.expires_on = timezone.now() + timedelta(days=1)
+
+    def grant(self, guest_ids, **extra):
+        data = dict(guests=guest_ids, expires_on=self.expires_on.isoformat(), **extra)
+        return self.client.post('/api/guests/permissions/batch/', data, format='json')
+
+    def test_batch_grant_returns_token_map(self):
+        ids = [guest.id for guest in self.guests]
+        # guest check, token check, savepoint, INSERT, ids of the new rows, change log INSERT, span INSERT, release
+        with self.assertNumQueries(8):
+            response = self.grant(ids + ids[:1], once_off=True)
+        self.assertEqual(response.status_code, 201)
+        tokens = response.data['tokens']
+        self.assertEqual(list(tokens), ids)
+        self.assertEqual(len(set(tokens.values())), len(ids))
+        for guest_id, token in tokens.items():
+            permission = GuestPermission.objects.get(token=token)
+            self.assertEqual(permission.guest_id, guest_id)
+            self.assertTrue(permission.once_off)
+
+    def test_unknown_guest_rejected(self):
+        response = self.grant([self.guests[0].id, 9999])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(GuestPermission.objects.exists())
+
+    def test_token_collisions_are_regenerated(self):
+        GuestPermission.objects.create(token="taken", guest=self.guests[0], granted_by=self.user, expires_on=self.expires_on)
+        generated = iter(["taken", "dup", "dup", "fresh1", "fresh2"])
+        with mock.patch('api.models.get_random_string', lambda length: next(generated)):
+            tokens = GuestPermission.objects.unused_tokens(3)
+        self.assertEqual(sorted(tokens), ["dup", "fresh1", "fresh2"])
+
+
+@override_settings(ACTIVITY_EXPORT_CHUNK_SIZE=4)
+class GateActivityExportTestCase(TestCase):
+    """Test suite for the streaming gate log export."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        start = timezone.now() - timedelta(days=1)
+        for i in range(10):
+            activity = GateActivity.objects.create(responsible_user=self.user if i % 2 else None,
+                                                   responsible_guest=None if i % 2 else self.guest, gate_status=i % 2)
+            GateActivity.objects.filter(pk=activity.pk).update(date=start + timedelta(minutes=i // 3))
+        self.expected = list(GateActivity.objects.order_by('date', 'id').values_list('id', flat=True))
+
+    def export(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8'), response
+
+    def test_ndjson_export(self):
+        with self.assertNumQueries(3):  # ceil(10 / 4) keyset chunks
+            body, response = self.export('/api/interactions/export/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.expected)
+        self.assertEqual(rows[0]['responsible_guest'], "Jane Doe")
+        self.assertEqual(rows[1]['responsible_user'], "admin")
+
+    def test_csv_export_with_filters(self):
+        body, response = self.export('/api/interactions/export/?format=csv&responsible_user={0}'.format(self.user.pk))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(body.splitlines()))
+        self.assertEqual([int(row['id']) for row in rows], self.expected[1::2])
+        self.assertEqual({row['responsible_user'] for row in rows}, {"admin"})
+
+    def test_requires_authentication(self):
+        self.assertEqual(APIClient().get('/api/interactions/export/').status_code, 401)
+
+
+class ActivityRollupTestCase(TestCase):
+    """Rollup totals must always equal counts over the raw GateActivity rows."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.start = timezone.now() - timedelta(days=3)
+
+    def log(self, count):
+        for i in range(count):
+            activity = GateActivity.objects.create(responsible_user=self.user if i % 3 else None,
+                                                   responsible_guest=None if i % 3 else self.guest, gate_status=i % 2)
+            date = self.start + timedelta(minutes=97 * i)
+            GateActivity.objects.filter(pk=activity.pk).update(date=date)
+            activity.date = date
+            yield activity
+
+    def assertRollupsMatchRaw(self):
+        for period, trunc in rollups.PERIODS:
+            raw = {(row['bucket'], row['responsible_user'], row['responsible_guest'], row['gate_status']): row['n']
+                   for row in GateActivity.objects.annotate(bucket=trunc('date')).order_by()
+                   .values('bucket', 'responsible_user', 'responsible_guest', 'gate_status').annotate(n=Count('id'))}
+            rolled = {(row['bucket'], row['responsible_user'], row['responsible_guest'], row['gate_status']): row['n']
+                      for row in ActivityRollup.objects.filter(period=period).order_by()
+                      .values('bucket', 'responsible_user', 'responsible_guest', 'gate_status').annotate(n=Sum('count'))}
+            self.assertEqual(rolled, raw)
+        self.assertEqual(ActivityRollup.objects.filter(period=ActivityRollup.DAY).aggregate(n=Sum('count'))['n'],
+                         GateActivity.objects.count())
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_apply_matches_raw_counts(self):
+        rollups.apply(list(self.log(60)))
+        self.assertRollupsMatchRaw()
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='save')
+    def test_save_mode_counts_each_insert(self):
+        GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        self.assertRollupsMatchRaw()
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_catch_up_and_rebuild(self):
+        list(self.log(40))
+        self.assertEqual(rollups.catch_up(batch_size=7), 40)
+        self.assertRollupsMatchRaw()
+        self.assertEqual(rollups.catch_up(), 0)  # nothing past the watermark
+        self.assertEqual(Watermark.get(rollups.WATERMARK).position, GateActivity.objects.latest('id').id)
+        ActivityRollup.objects.update(count=0)
+        self.assertEqual(rollups.rebuild(), 40)
+        self.assertRollupsMatchRaw()
+        with mock.patch.object(ActivityRollup.objects, 'bulk_create', wraps=ActivityRollup.objects.bulk_create) as insert:
+            self.assertEqual(rollups.rebuild(batch_size=5), 40)
+        self.assertGreater(insert.call_count, 3)  # one window per day, in batches
+        self.assertLessEqual(max(len(call[0][0]) for call in insert.call_args_list), 5)
+        self.assertRollupsMatchRaw()
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_catch_up_leaves_unsettled_rows(self):
+        GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        self.assertEqual(rollups.catch_up(), 0)
+        self.assertEqual(rollups.catch_up(settle=timedelta(0)), 1)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_stats_endpoint_reads_rollups_only(self):
+        rollups.apply(list(self.log(30)))
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/interactions/stats/?period=day&by=guest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(row['count'] for row in response.data['results']), 30)
+        self.assertEqual(sum(row['count'] for row in response.data['results'] if row['responsible_guest']),
+                         GateActivity.objects.filter(responsible_guest=self.guest).count())
+        response = self.client.get('/api/interactions/stats/?period=hour&responsible_user={0}'.format(self.user.pk))
+        self.assertEqual(sum(row['count'] for row in response.data['results']), 20)
+        self.assertEqual(self.client.get('/api/interactions/stats/?period=week').status_code, 400)
+        for param in ('responsible_user=abc', 'responsible_guest=1.5', 'gate_status=x', 'site=north'):
+            self.assertEqual(self.client.get('/api/interactions/stats/?' + param).status_code, 400, param)
+
+
+class ActivityJournalTestCase(TestCase):
+    """Test suite for write-behind logging of gate interactions."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.user = User.objects.create(username="admin")
+        self.journal = ActivityJournal(self.directory, start_flusher=False)
+        self.addCleanup(self.journal.close)
+
+    def segments(self):
+        return [name for name in os.listdir(self.directory) if name.endswith('.journal')]
+
+    def test_record_then_flush(self):
+        opened = timezone.now() - timedelta(minutes=5)
+        self.journal.record(GateActivity(date=opened, responsible_user=self.user, gate_status=1))
+        self.assertFalse(GateActivity.objects.exists())
+        self.assertEqual(self.journal.pending(), 1)
+        self.assertEqual(self.journal.flush(), 1)
+        activity = GateActivity.objects.get()
+        self.assertEqual(activity.date, opened)  # the time of the open, not of the flush
+        self.assertEqual(ActivityRollup.objects.filter(period=ActivityRollup.DAY).get().count, 1)
+        self.assertEqual(len(self.segments()), 1)  # only the fresh current segment remains
+        self.assertFalse(IngestedBatch.objects.exists())
+
+    def test_replays_orphaned_segment(self):
+        orphan = os.path.join(self.directory, 'dead-process.journal')
+        with open(orphan, 'w') as segment:
+            segment.write(json.dumps({'date': timezone.now().isoformat(), 'responsible_user_id': self.user.id,
+                                      'responsible_guest_id': None, 'gate_status': 0}) + '\n')
+            segment.write('{"date": "torn wri')  # crashed mid-write
+        self.assertEqual(self.journal.replay(), 1)
+        self.assertEqual(GateActivity.objects.count(), 1)
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_replay_skips_committed_segment(self):
+        orphan = os.path.join(self.directory, 'committed.journal')
+        with open(orphan, 'w') as segment:
+            segment.write(json.dumps({'date': timezone.now().isoformat(), 'responsible_user_id': self.user.id,
+                                      'responsible_guest_id': None, 'gate_status': 0}) + '\n')
+        IngestedBatch.objects.create(key='journal:committed')  # crashed after commit, before cleanup
+        self.assertEqual(self.journal.replay(), 0)
+        self.assertFalse(GateActivity.objects.exists())
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_replay_leaves_live_segments(self):
+        other = ActivityJournal(self.directory, start_flusher=False)
+        other.record(GateActivity(responsible_user=self.user, gate_status=1))
+        self.assertEqual(self.journal.replay(), 0)
+        self.assertEqual(other.flush(), 1)
+
+    def test_write_behind_gate_open(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        options = {'ENABLED': True, 'DIR': self.directory}
+        with override_settings(ACTIVITY_WRITE_BEHIND=options), mock.patch('api.journal._journal', self.journal):
+            with self.assertNumQueries(0):
+                response = client.post('/api/interactions/user/', {'gate_status': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.data['id'])
+        self.assertEqual(response.data['responsible_user'], "admin")
+        self.journal.flush()
+        self.assertEqual(GateActivity.objects.filter(responsible_user=self.user).count(), 1)
+
+
+class DeviceAuthenticationTestCase(TestCase):
+    """Test suite for HMAC-signed device authentication."""
+
+    url = '/api/interactions/user/'
+    body = json.dumps({'gate_status': 1})
+
+    def setUp(self):
+        principal_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="gate")
+        self.device = Device.objects.create(name="Main gate", key_id="key1", secret="s3cret", user=self.user)
+
+    def open_gate(self, token, body=body):
+        return self.client.post(self.url, body, content_type='application/json', HTTP_AUTHORIZATION=token)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_signed_request_authenticates(self):
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body)).status_code, 201)
+        with self.assertNumQueries(2):  # principal cached: just the INSERT and the presence UPDATE
+            response = self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body))
+        self.assertEqual(response.data['responsible_user'], "gate")
+
+    def test_rejects_bad_tokens(self):
+        self.assertEqual(self.open_gate(device_token("key1", "wrong", 'POST', self.url, self.body)).status_code, 401)
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', '/api/guests/', self.body)).status_code, 401)
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body, lifetime=-1)).status_code, 401)
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body, lifetime=3600)).status_code, 401)
+        self.assertEqual(self.open_gate(device_token("nokey", "s3cret", 'POST', self.url, self.body)).status_code, 401)
+        self.assertEqual(self.open_gate("Device garbage").status_code, 401)
+        token = device_token("key1", "s3cret", 'POST', self.url, self.body)
+        self.assertEqual(self.open_gate(token, json.dumps({'gate_status': 0})).status_code, 401)
+        self.assertFalse(GateActivity.objects.exists())
+
+    def test_deactivation_invalidates_cache(self):
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body)).status_code, 201)
+        self.device.is_active = False
+        self.device.save()
+        self.assertEqual(self.open_gate(device_token("key1", "s3cret", 'POST', self.url, self.body)).status_code, 401)
+
+    def test_basic_authentication_still_works(self):
+        self.user.set_password("pw")
+        self.user.save()
+        credentials = base64.b64encode(b"gate:pw").decode('ascii')
+        self.assertEqual(self.open_gate('Basic ' + credentials).status_code, 201)
+        response = self.client.post(self.url, {'gate_status': 1})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response['WWW-Authenticate'].startswith('Basic'))
+
+
+class OfflineSyncTestCase(TestCase):
+    """Test suite for signed permission bundles, delta sync and offline activity upload."""
+
+    def setUp(self):
+        principal_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="gate")
+        Device.objects.create(name="Main gate", key_id="key1", secret="s3cret", user=self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.tomorrow = timezone.now() + timedelta(days=1)
+
+    def grant(self, token, **kwargs):
+        kwargs.setdefault('expires_on', self.tomorrow)
+        return GuestPermission.objects.create(token=token, guest=self.guest, granted_by=self.user, **kwargs)
+
+    def get(self, url):
+        return self.client.get(url, HTTP_AUTHORIZATION=device_token("key1", "s3cret", 'GET', url))
+
+    def verified(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['signature'], sync.sign("s3cret", json.loads(json.dumps(response.data['payload']))))
+        return response.data['payload']
+
+    def test_bundle_holds_valid_permissions_only(self):
+        valid = self.grant("valid")
+        self.grant("expired", starts_on=timezone.now() - timedelta(days=2), expires_on=timezone.now() - timedelta(days=1))
+        self.grant("used", once_off=True, once_off_used=True)
+        payload = self.verified(self.get('/api/guests/permissions/bundle/'))
+        self.assertEqual([row[:3] for row in payload['permissions']], [[valid.id, sync.token_hash("valid"), self.guest.id]])
+
+    def test_delta_returns_only_changes(self):
+        kept, revoked = self.grant("kept"), self.grant("revoked")
+        revoked_id = revoked.id
+        with mock.patch('api.sync.stable_version', lambda: PermissionChange.objects.latest('id').id):
+            version = self.verified(self.get('/api/guests/permissions/bundle/'))['version']
+            revoked.delete()
+            added = self.grant("added")
+            payload = self.verified(self.get('/api/guests/permissions/changes/?since={0}'.format(version)))
+        self.assertEqual([row[0] for row in payload['permissions']], [added.id])
+        self.assertEqual(payload['revoked'], [revoked_id])
+        self.assertGreater(payload['version'], version)
+        self.assertNotIn(kept.id, payload['revoked'])
+
+    def test_delta_after_prune_requires_bundle(self):
+        self.grant("old")
+        sync.prune_changes(timezone.now() + timedelta(seconds=1))
+        self.assertEqual(self.get('/api/guests/permissions/changes/?since=0').status_code, 410)
+
+    def test_device_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/guests/permissions/bundle/').status_code, 403)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_offline_upload_is_idempotent(self):
+        once = self.grant("once", once_off=True)
+        gone = self.grant("gone")
+        gone_id = gone.id
+        gone.delete()
+        earlier = (timezone.now() - timedelta(hours=2)).isoformat()
+        body = {'batch_id': "b1", 'events': [
+            {'date': earlier, 'gate_status': 1, 'permission': once.id},
+            {'date': earlier, 'gate_status': 1, 'permission': gone_id},
+            {'date': earlier, 'gate_status': 0, 'permission': None},
+        ]}
+        url, body = '/api/interactions/offline/', json.dumps(body)
+        post = lambda: self.client.post(url, body, content_type='application/json',
+                                        HTTP_AUTHORIZATION=device_token("key1", "s3cret", 'POST', url, body))
+        response = post()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['skipped']), (2, 1))
+        self.assertTrue(post().data['duplicate'])
+        self.assertEqual(GateActivity.objects.count(), 2)
+        self.assertFalse(Watermark.objects.filter(name__startswith='offline:').exists())
+        self.assertEqual(sync.prune_batches(timezone.now() - timedelta(minutes=1)), 0)
+        self.assertEqual(sync.prune_batches(timezone.now() + timedelta(seconds=1)), 1)
+        self.assertEqual(GateActivity.objects.get(responsible_guest=self.guest).date.isoformat(), earlier)
+        once.refresh_from_db()
+        self.assertTrue(once.once_off_used)
+
+
+class ConditionalGetTestCase(QueryBudgetMixin, TestCase):
+    """Test suite for ETag / If-None-Match support on polled endpoints."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.permission = GuestPermission.objects.create(token="abc", guest=self.guest, granted_by=self.user,
+                                                         expires_on=timezone.now() + timedelta(days=1))
+        GateActivity.objects.create(responsible_guest=self.guest, gate_status=1)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_list_answers_304_without_serializing(self):
+        for url, budget in (('/api/guests/', 1), ('/api/guests/permissions/', 1), ('/api/interactions/', 2),
+                            ('/api/guests/{0}/'.format(self.guest.pk), 3)):
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(budget):
+                response = self.revalidate(url, etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response['ETag'], etag)
+
+    def test_changes_invalidate_etag(self):
+        urls = ['/api/guests/', '/api/guests/permissions/', '/api/interactions/', '/api/guests/{0}/'.format(self.guest.pk),
+                '/api/guests/permissions/{0}/'.format(self.permission.pk)]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+        self.guest.surname = "Smith"
+        self.guest.save()
+        GateActivity.objects.create(responsible_guest=self.guest, gate_status=0)
+        self.permission.once_off = True
+        self.permission.save()
+        for url in urls:
+            self.assertEqual(self.revalidate(url, etags[url]).status_code, 200, url)
+
+    def test_activity_deletions_invalidate_etag(self):
+        other = Guest.objects.create(first_name="John", surname="Doe", mobile="0830000000", created_by=self.user)
+        GateActivity.objects.create(responsible_guest=other, gate_status=1)
+        GateActivity.objects.create(responsible_guest=self.guest, gate_status=0)  # keeps max(id)
+        etag = self.client.get('/api/interactions/')['ETag']
+        other.delete()
+        self.assertEqual(self.revalidate('/api/interactions/', etag).status_code, 200)
+
+    def test_etag_depends_on_query(self):
+        self.assertNotEqual(self.client.get('/api/guests/')['ETag'], self.client.get('/api/guests/?mobile=1')['ETag'])
+
+
+@override_settings(ACTIVITY_STREAM={'HEARTBEAT': 0.01})
+class GateActivityStreamTestCase(TestCase):
+    """Test suite for the live activity stream, fed by an in-memory broker instead of the tailing one."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.broker = stream.ActivityBroker(queue_size=5)
+        patcher = mock.patch.object(stream, 'get_broker', return_value=self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open(self, **extra):
+        response = self.client.get('/api/interactions/stream/', **extra)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.addCleanup(response.close)
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        return response, events
+
+    def event_ids(self, events, count):
+        ids = []
+        for _ in range(count):
+            lines = next(events).decode('utf-8').splitlines()
+            self.assertEqual(lines[1], 'event: activity')
+            ids.append(json.loads(lines[2][len('data: '):])['id'])
+            self.assertEqual(lines[0], 'id: default:{0}'.format(ids[-1]))
+        return ids
+
+    def row(self, pk):
+        return {'id': pk, 'date': None, 'gate_status': 1, 'responsible_user_id': None, 'responsible_user': None,
+                'responsible_guest_id': self.guest.pk, 'responsible_guest': "Jane Doe", 'gate_id': None, 'site_id': None,
+                'database': 'default'}
+
+    def test_fans_out_published_rows(self):
+        _, first = self.open()
+        _, second = self.open()
+        self.assertEqual(self.broker.watchers(), 2)
+        self.broker.publish([self.row(1), self.row(2)])
+        self.assertEqual(self.event_ids(first, 2), [1, 2])
+        self.assertEqual(self.event_ids(second, 2), [1, 2])
+        self.assertEqual(next(first), b': keepalive\n\n')
+
+    def test_resumes_from_last_event_id(self):
+        activities = [GateActivity.objects.create(responsible_guest=self.guest, gate_status=1) for _ in range(3)]
+        _, events = self.open(HTTP_LAST_EVENT_ID=str(activities[0].pk))
+        self.assertEqual(self.event_ids(events, 2), [activities[1].pk, activities[2].pk])
+        # a replayed row published again by the broker is not sent twice
+        self.broker.publish([self.row(activities[2].pk), self.row(activities[2].pk + 1)])
+        self.assertEqual(self.event_ids(events, 1), [activities[2].pk + 1])
+
+    def test_rejects_invalid_last_event_id(self):
+        response = self.client.get('/api/interactions/stream/', HTTP_LAST_EVENT_ID='abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_slow_stream_is_closed(self):
+        _, events = self.open()
+        self.broker.publish([self.row(pk) for pk in range(1, 5)])
+        self.broker.publish([self.row(pk) for pk in range(5, 9)])  # does not fit the queue of 5
+        self.assertEqual(self.broker.watchers(), 0)
+        self.assertEqual(self.event_ids(events, 4), [1, 2, 3, 4])
+        with self.assertRaises(StopIteration):
+            next(events)
+
+    def test_closing_unsubscribes(self):
+        response, _ = self.open()
+        response.close()
+        self.assertEqual(self.broker.watchers(), 0)
+
+    def test_tailing_broker_serves_all_watchers_with_one_query(self):
+        broker = stream.TailingBroker(start_tailer=False)
+        subscriptions = [broker.subscribe() for _ in range(3)]
+        activities = [GateActivity.objects.create(responsible_guest=self.guest, gate_status=1) for _ in range(2)]
+        with self.assertNumQueries(1):
+            self.assertEqual(broker.poll(), 2)
+        for subscription in subscriptions:
+            self.assertEqual([row['id'] for row in subscription.get(0)], [activity.pk for activity in activities])
+        self.assertEqual(broker.poll(), 0)
+
+    def test_tailer_skips_rows_inserted_while_idle(self):
+        broker = stream.TailingBroker(start_tailer=False)
+        broker.unsubscribe(broker.subscribe())
+        for _ in range(3):
+            GateActivity.objects.create(responsible_guest=self.guest, gate_status=1)
+        subscription = broker.subscribe()
+        self.assertEqual(broker.poll(), 0)
+        activity = GateActivity.objects.create(responsible_guest=self.guest, gate_status=1)
+        self.assertEqual(broker.poll(), 1)
+        self.assertEqual([row['id'] for row in subscription.get(0)], [activity.pk])
+
+
+class PerformanceMetricsTestCase(TestCase):
+    """Test suite for the timing middleware, its histograms and the Prometheus endpoint."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        metrics.registry.clear()
+
+    def test_histogram_percentiles_are_close(self):
+        rng = random.Random(7)
+        values = sorted(int(rng.expovariate(1 / 5000.0)) for _ in range(5000))
+        histogram = metrics.Histogram()
+        for value in values:
+            histogram.record(value)
+        self.assertEqual(histogram.count, len(values))
+        self.assertEqual(histogram.total, sum(values))
+        for pct in (1, 50, 90, 99, 100):
+            exact = values[max(0, -(-len(values) * pct // 100) - 1)]
+            self.assertGreaterEqual(histogram.percentile(pct), exact)
+            self.assertLessEqual(histogram.percentile(pct), exact * (1 + 1 / 16.0))
+        small = metrics.Histogram()
+        for value in range(32):
+            self.assertEqual(small.highest(small.index(value)), value)
+
+    def test_records_timings_per_view(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/guests/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.client.get('/api/guests/')
+        self.assertEqual(metrics.registry.histogram('db_queries', 'guests').percentile(100), 3)
+
+        body = self.client.get('/api/metrics/').content.decode('utf-8')
+        self.assertIn('# TYPE api_request_duration_seconds histogram', body)
+        self.assertIn('api_db_queries_bucket{view="guests",le="3"} 2', body)
+        self.assertIn('api_db_queries_bucket{view="guests",le="2"} 0', body)
+        self.assertIn('api_request_duration_seconds_count{view="guests"} 2', body)
+
+    @override_settings(PERFORMANCE_METRICS={'ENABLED': False})
+    def test_can_be_disabled(self):
+        response = self.client.get('/api/guests/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertIsNone(metrics.registry.histogram('request_duration_seconds', 'guests'))
+
+
+class LeanActivityListTestCase(TestCase):
+    """Test suite for the values_list read path of the activity listings."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="gatekeeper")
+        guest = Guest.objects.create(first_name="Zoë", surname="Doe", mobile="0820000000", created_by=self.user)
+        for index in range(15):
+            if index % 3:
+                GateActivity.objects.create(responsible_guest=guest, gate_status=index % 2)
+            else:
+                GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        self.client.force_authenticate(self.user)
+
+    def fetch(self, url, lean, **extra):
+        with override_settings(LEAN_ACTIVITY_LISTS=lean), CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200, url)
+        return response, len(context.captured_queries)
+
+    def test_output_is_identical(self):
+        for url in ('/api/interactions/', '/api/interactions/?page_size=4', '/api/interactions/user/',
+                    '/api/interactions/guest/?gate_status=1', '/api/interactions/guest/?page_size=1000'):
+            while url:
+                full, full_queries = self.fetch(url, False)
+                lean, lean_queries = self.fetch(url, True)
+                self.assertEqual(lean.content, full.content, url)
+                self.assertEqual(lean['ETag'], full['ETag'])
+                self.assertLessEqual(lean_queries, full_queries)
+                url = json.loads(lean.content.decode('utf-8'))['next']
+
+    def test_browsable_api_keeps_serializers(self):
+        with mock.patch('api.lean.LeanListMixin.get_lean_layout') as layout:
+            self.fetch('/api/interactions/', True, HTTP_ACCEPT='text/html')
+            self.assertFalse(layout.called)
+            self.fetch('/api/interactions/', True)
+            self.assertTrue(layout.called)
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """Test suite for the read replica router, with a second (unreplicated) SQLite database as replica -
+    rows written to the primary only are missing on it, which shows where a read went."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReplicaRoutingTestCase, cls).setUpClass()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('replica')
+        call_command('migrate', database='replica', verbosity=0, interactive=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections._connections.replica
+        super(ReplicaRoutingTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        replicas = override_settings(DATABASE_REPLICAS=['replica'], ACTIVITY_ROLLUP_MODE='batch')
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        self.user = User.objects.create(username="admin")
+        User.objects.using('replica').create(pk=self.user.pk, username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        User.objects.using('replica').all().delete()
+
+    def interactions(self, client):
+        response = client.get('/api/interactions/')
+        self.assertEqual(response.status_code, 200)
+        return len(response.data['results'])
+
+    def test_reads_go_to_replica(self):
+        GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        self.assertEqual(self.interactions(self.client), 0)
+        self.assertEqual(self.client.get('/api/guests/{0}/'.format(self.guest.pk)).status_code, 404)
+        # outside requests reads stay on the primary
+        self.assertEqual(GateActivity.objects.count(), 1)
+
+    def test_writer_is_pinned_to_primary(self):
+        response = self.client.post('/api/interactions/user/', {'gate_status': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(routers.ReplicaRoutingMiddleware.cookie_name, response.cookies)
+        self.assertEqual(self.interactions(self.client), 1)
+        other = APIClient()
+        other.force_authenticate(self.user)
+        self.assertEqual(self.interactions(other), 0)
+
+    def test_gate_open_authorises_on_primary(self):
+        GuestPermission.objects.create(token="abc", guest=self.guest, granted_by=self.user,
+                                       expires_on=timezone.now() + timedelta(days=1))
+        client = APIClient()
+        response = client.post('/api/interactions/guest/', {'token': "abc", 'gate_status': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(GateActivity.objects.using('replica').count(), 0)
+
+    def test_without_replicas_everything_is_primary(self):
+        GateActivity.objects.create(responsible_user=self.user, gate_status=1)
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.interactions(self.client), 1)
+
+
+class GuestSearchTestCase(TestCase):
+    """Test suite for the typeahead guest search."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        people = (("Zoë", "van der Merwe", "+27 82 111 2222"), ("Thabo", "Nkosi", "082 333 4444"),
+                  ("Anna", "Thabethe", "0825556666"), ("Thabiso", "Dlamini", "0027 83 777 8888"))
+        for first_name, surname, mobile in people:
+            Guest.objects.create(first_name=first_name, surname=surname, mobile=mobile, created_by=self.user)
+
+    def search(self, q, **params):
+        response = self.client.get('/api/guests/search/', dict(q=q, **params))
+        self.assertEqual(response.status_code, 200)
+        return ["{0} {1}".format(guest['first_name'], guest['surname']) for guest in response.data]
+
+    def test_normalization(self):
+        self.assertEqual(normalize_name("  Zoë   VAN der Merwe"), "zoe van der merwe")
+        self.assertEqual(normalize_mobile("+27 (82) 111-2222"), "0821112222")
+        self.assertEqual(normalize_mobile("0027821112222"), "0821112222")
+        self.assertEqual(normalize_mobile("27821112222"), "0821112222")
+        self.assertEqual(normalize_mobile("+27 82"), "082")
+        guest = Guest.objects.get(first_name="Zoë")
+        self.assertEqual((guest.name_key, guest.surname_key, guest.mobile_key),
+                         ("zoe van der merwe", "van der merwe", "0821112222"))
+
+    def test_keys_follow_updates_and_bulk_inserts(self):
+        guest = Guest.objects.get(first_name="Anna")
+        guest.surname = "Botha"
+        guest.save()
+        Guest.objects.bulk_create([Guest(first_name="Bongani", surname="Zulu", mobile="0841234567", created_by=self.user)])
+        self.assertEqual(self.search("bot"), ["Anna Botha"])
+        self.assertEqual(self.search("zul"), ["Bongani Zulu"])
+
+    def test_ranking(self):
+        self.assertEqual(self.search("thab"), ["Thabiso Dlamini", "Thabo Nkosi", "Anna Thabethe"])
+        self.assertEqual(self.search("Thabo"), ["Thabo Nkosi"])
+        self.assertEqual(self.search("zoe van"), ["Zoë van der Merwe"])
+        self.assertEqual(self.search("van der m"), ["Zoë van der Merwe"])
+        self.assertEqual(self.search("thab", limit=1), ["Thabiso Dlamini"])
+
+    def test_mobile_prefix(self):
+        self.assertEqual(self.search("082"), ["Zoë van der Merwe", "Thabo Nkosi", "Anna Thabethe"])
+        self.assertEqual(self.search("+27 83"), ["Thabiso Dlamini"])
+
+    def test_requires_query(self):
+        self.assertEqual(self.client.get('/api/guests/search/').status_code, 400)
+
+
+class GuestPurgeTestCase(TestCase):
+    """Test suite for soft deletion of guests and the chunked background purges."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create(username="admin", is_superuser=True)
+        self.client.force_authenticate(self.admin)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.admin)
+        self.other = Guest.objects.create(first_name="John", surname="Roe", mobile="0821111111", created_by=self.admin)
+        now = timezone.now()
+        for guest in (self.guest, self.other):
+            for day in range(5):
+                GateActivity.objects.create(responsible_guest=guest, gate_status=1, date=now - timedelta(days=day))
+        self.valid = GuestPermission.objects.create(token="valid", guest=self.guest, granted_by=self.admin,
+                                                    expires_on=now + timedelta(days=1))
+        self.expired = GuestPermission.objects.create(token="expired", guest=self.other, granted_by=self.admin,
+                                                      starts_on=now - timedelta(days=10), expires_on=now - timedelta(days=9))
+        self.current = GuestPermission.objects.create(token="current", guest=self.other, granted_by=self.admin,
+                                                      expires_on=now + timedelta(days=1))
+
+    def test_delete_hides_guest_and_revokes_tokens(self):
+        lookup_token("valid")
+        response = self.client.delete('/api/guests/{0}/'.format(self.guest.id))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['state'], PurgeJob.PENDING)
+        self.assertTrue(response['Location'].endswith('/api/purges/{0}/'.format(response.data['id'])))
+        self.assertEqual(self.client.get('/api/guests/{0}/'.format(self.guest.id)).status_code, 404)
+        self.assertEqual([guest['id'] for guest in self.client.get('/api/guests/').data['results']], [self.other.id])
+        self.assertLessEqual(lookup_token("valid").expires_on, timezone.now())
+        self.assertTrue(PermissionChange.objects.filter(permission_id=self.valid.id).exists())
+        batch = self.client.post('/api/guests/permissions/batch/', {
+            'guests': [self.guest.id], 'expires_on': (timezone.now() + timedelta(days=1)).isoformat()}, format='json')
+        self.assertEqual(batch.status_code, 400)
+
+    def test_delete_requires_superuser(self):
+        self.client.force_authenticate(User.objects.create(username="staff"))
+        self.assertEqual(self.client.delete('/api/guests/{0}/'.format(self.guest.id)).status_code, 403)
+        self.assertIsNone(Guest.objects.get(pk=self.guest.id).deleted_on)
+
+    def test_guest_purge_runs_in_chunks(self):
+        job = purge.soft_delete_guest(self.guest)
+        rollups = ActivityRollup.objects.filter(responsible_guest=self.guest).count()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(purge.run_pending(chunk_size=2), 1)
+        job.refresh_from_db()
+        # activities, rollups, permission, presence, guest
+        self.assertEqual((job.state, job.deleted, job.finished_on is not None), (PurgeJob.DONE, 5 + rollups + 1 + 1 + 1, True))
+        self.assertFalse(Guest.objects.filter(pk=self.guest.id).exists())
+        self.assertFalse(GateActivity.objects.filter(responsible_guest_id=self.guest.id).exists())
+        self.assertFalse(GuestPermission.objects.filter(guest_id=self.guest.id).exists())
+        self.assertEqual(GateActivity.objects.filter(responsible_guest=self.other).count(), 5)
+        deletes = [query for query in context.captured_queries
+                   if query['sql'].startswith('DELETE FROM "api_gateactivity" WHERE "api_gateactivity"."id" IN')]
+        self.assertEqual(len(deletes), 3)  # 5 rows, 2 per chunk
+        self.assertEqual(self.client.get('/api/purges/{0}/'.format(job.id)).data['state'], PurgeJob.DONE)
+
+    def test_expired_purge_keeps_valid_permissions(self):
+        lookup_token("expired")
+        job = purge.purge_expired_permissions(timezone.now() - timedelta(days=1))
+        with mock.patch.object(purge, '_delete_permissions', wraps=purge._delete_permissions) as delete:
+            purge.run_job(job, chunk_size=1)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.deleted), (PurgeJob.DONE, 1))
+        self.assertGreaterEqual(job.position, self.expired.id)
+        self.assertEqual(delete.call_count, 1)
+        self.assertEqual(sorted(GuestPermission.objects.values_list('token', flat=True)), ["current", "valid"])
+        self.assertIsNone(lookup_token("expired"))
+
+    def test_failed_and_abandoned_jobs(self):
+        job = purge.soft_delete_guest(self.guest)
+        with mock.patch.dict(purge.CHUNKS, {PurgeJob.GUEST: mock.Mock(side_effect=OperationalError("lost connection"))}):
+            with self.assertRaises(OperationalError):
+                purge.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.state, PurgeJob.FAILED)
+        self.assertIn("lost connection", job.error)
+        self.assertEqual(purge.run_pending(), 0)
+
+        PurgeJob.objects.filter(pk=job.pk).update(state=PurgeJob.RUNNING)
+        self.assertFalse(purge.claim(job.pk, timedelta(minutes=5)))  # its worker may still be at it
+        PurgeJob.objects.filter(pk=job.pk).update(updated_on=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(purge.run_pending(stale_after=timedelta(minutes=5)), 1)
+        self.assertFalse(Guest.objects.filter(pk=self.guest.id).exists())
+
+    def test_command(self):
+        purge.soft_delete_guest(self.guest)
+        PurgeJob.objects.update(state=PurgeJob.FAILED)
+        call_command('purge', expired_days=1, retry_failed=True, stdout=open(os.devnull, 'w'))
+        self.assertEqual(set(PurgeJob.objects.values_list('state', flat=True)), {PurgeJob.DONE})
+        self.assertEqual(sorted(GuestPermission.objects.values_list('token', flat=True)), ["current"])
+
+
+def naive_allows(rules, tz, excluded, instant):
+    """Reference evaluator for AccessSchedule: checks instant against each rule in local time directly."""
+    local = instant.astimezone(pytz.timezone(tz))
+    if local.date() in excluded:
+        return False
+    day, minute = local.weekday(), local.hour * 60 + local.minute
+    for days, start, end in rules:
+        if start < end and day in days and start <= minute < end:
+            return True
+        if end <= start and ((day in days and minute >= start) or ((day - 1) % 7 in days and minute < end)):
+            return True
+    return False
+
+
+class AccessScheduleTestCase(TestCase):
+    """Test suite for recurring access schedules on guest permissions."""
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.schedule = AccessSchedule.objects.create(name="Cleaners", rules="mon-fri 07:00-17:00",
+                                                      excluded_dates="2026-10-14", created_by=self.user)
+        self.permission = GuestPermission.objects.create(
+            token="abc", guest=self.guest, granted_by=self.user, schedule=self.schedule,
+            starts_on=timezone.now() - timedelta(days=3650), expires_on=timezone.now() + timedelta(days=3650))
+
+    def local(self, *args):
+        return pytz.timezone('Africa/Johannesburg').localize(datetime(*args))
+
+    def open_gate_at(self, instant):
+        with mock.patch('api.serializers.timezone.now', return_value=instant):
+            return APIClient().post('/api/interactions/guest/', {'token': "abc", 'gate_status': 1}).status_code
+
+    def test_parse_rules(self):
+        self.assertEqual(schedules.parse_rules("Mon-Fri 07:00-17:00; sat,sun 22:00 - 06:00; fri-mon 00:00-24:00"),
+                         [((0, 1, 2, 3, 4), 420, 1020), ((5, 6), 1320, 360), ((0, 4, 5, 6), 0, 1440)])
+        for invalid in ("", "mon", "funday 07:00-08:00", "mon 07:00-07:00", "mon 25:00-26:00", "mon 24:00-01:00"):
+            with self.assertRaises(ValueError):
+                schedules.parse_rules(invalid)
+
+    def test_matches_naive_evaluator(self):
+        rng = random.Random(21)
+        origin = datetime(2025, 1, 1, tzinfo=pytz.utc)
+        for _ in range(40):
+            parts = []
+            for _ in range(rng.randint(1, 3)):
+                first, last = rng.choice(schedules.DAYS), rng.choice(schedules.DAYS)
+                days = first if rng.random() < 0.3 else '{0}-{1}'.format(first, last)
+                start, end = rng.randrange(0, 1440, 5), rng.randrange(1, 1441, 5)
+                if start != end:
+                    parts.append('{0} {1:02d}:{2:02d}-{3:02d}:{4:02d}'.format(days, *(divmod(start, 60) + divmod(end, 60))))
+            text = '; '.join(parts) or 'mon 08:00-09:00'
+            tz = rng.choice(('Africa/Johannesburg', 'Europe/London', 'America/New_York', 'UTC'))
+            excluded = {date(2025, 1, 1) + timedelta(days=rng.randrange(730)) for _ in range(rng.randint(0, 30))}
+            compiled = schedules.CompiledSchedule(schedules.compile_week(schedules.parse_rules(text)), tz,
+                                                  ','.join(day.isoformat() for day in excluded))
+            rules = schedules.parse_rules(text)
+            for _ in range(500):
+                instant = origin + timedelta(minutes=rng.randrange(730 * 1440))
+                self.assertEqual(compiled.allows(instant), naive_allows(rules, tz, excluded, instant),
+                                 "{0} in {1} at {2}".format(text, tz, instant))
+
+    def test_gate_open_follows_schedule(self):
+        self.assertEqual(self.open_gate_at(self.local(2026, 10, 15, 16, 59)), 201)  # thursday
+        self.assertEqual(self.open_gate_at(self.local(2026, 10, 15, 17, 0)), 403)
+        self.assertEqual(self.open_gate_at(self.local(2026, 10, 17, 10, 0)), 403)  # saturday
+        self.assertEqual(self.open_gate_at(self.local(2026, 10, 14, 10, 0)), 403)  # excluded wednesday
+        self.assertEqual(GateActivity.objects.count(), 1)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_scheduled_open_needs_no_extra_query(self):
+        Presence.objects.create(responsible_guest=self.guest, inside=False, changed_on=self.local(2026, 10, 1, 9, 0),
+                                seen_on=self.local(2026, 10, 1, 9, 0))
+        with self.assertNumQueries(3):  # token lookup (joined to the schedule), INSERT, presence UPDATE
+            self.open_gate_at(self.local(2026, 10, 15, 9, 0))
+        self.assertIsNotNone(lookup_token("abc").schedule)
+
+    def test_schedule_change_applies_to_permissions(self):
+        GuestPermission.objects.create(token="other", guest=self.guest, granted_by=self.user,
+                                       expires_on=timezone.now() + timedelta(days=1))
+        lookup_token("abc")
+        lookup_token("other")
+        before = PermissionChange.objects.count()
+        response = self.client.patch('/api/schedules/{0}/'.format(self.schedule.id), {'rules': "sat 08:00-12:00"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PermissionChange.objects.count(), before + 1)
+        self.assertEqual(token_cache.stats(), {'hits': 0, 'misses': 2, 'size': 1})  # only the schedule's tokens evicted
+        self.assertTrue(lookup_token("abc").schedule.allows(self.local(2026, 10, 17, 10, 0)))
+        self.assertEqual(self.open_gate_at(self.local(2026, 10, 15, 9, 0)), 403)
+
+    def test_api_validates_and_protects(self):
+        response = self.client.post('/api/schedules/', {'name': "Night", 'rules': "mon 18:00", 'timezone': "Mars/Base"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'rules', 'timezone'})
+        response = self.client.post('/api/schedules/', {'name': "Night", 'rules': "mon-thu 18:00-06:00"})
+        self.assertEqual((response.status_code, response.data['timezone']), (201, 'Africa/Johannesburg'))
+        self.assertEqual(self.client.delete('/api/schedules/{0}/'.format(self.schedule.id)).status_code, 400)
+        self.assertEqual(self.client.delete('/api/schedules/{0}/'.format(response.data['id'])).status_code, 204)
+
+    def test_bundle_carries_schedules(self):
+        payload = sync.bundle()
+        self.assertEqual(payload['permissions'][0][sync.PERMISSION_FIELDS.index('schedule')], self.schedule.id)
+        timezone_name, week, excluded = payload['schedules'][str(self.schedule.id)]
+        compiled = schedules.CompiledSchedule(bytes.fromhex(week), timezone_name, excluded)
+        self.assertTrue(compiled.allows(self.local(2026, 10, 16, 8, 0)))
+        self.assertFalse(compiled.allows(self.local(2026, 10, 14, 8, 0)))
+
+
+class ActiveGuestTestCase(TestCase):
+    """Test suite for the active-permission index and guests/active/."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guests = [Guest.objects.create(first_name="Guest", surname=str(i), mobile=str(i), created_by=self.user)
+                       for i in range(4)]
+        self.now = timezone.now()
+
+    def grant(self, guest, starts_on, expires_on, **kwargs):
+        return GuestPermission.objects.create(token=get_random_string(16), guest=guest, granted_by=self.user,
+                                              starts_on=starts_on, expires_on=expires_on, **kwargs)
+
+    def active(self, at=None):
+        response = self.client.get('/api/guests/active/', {'at': at.isoformat()} if at else {})
+        self.assertEqual(response.status_code, 200)
+        return {guest['id']: guest['active_permissions'] for guest in response.data['results']}
+
+    def test_spans_cover_window_exactly(self):
+        rng = random.Random(22)
+        for _ in range(200):
+            first = rng.randrange(20000, 21000)
+            last = first + rng.choice((0, 1, rng.randrange(40), rng.randrange(4000)))
+            starts_on = active.EPOCH + timedelta(days=first, minutes=rng.randrange(1440))
+            expires_on = max(active.EPOCH + timedelta(days=last, minutes=rng.randrange(1, 1441)), starts_on + timedelta(minutes=1))
+            keys = active.spans(starts_on, expires_on)
+            covered = []
+            for key in keys:
+                level, bucket = key >> 24, key & ((1 << 24) - 1)
+                covered.extend(range(bucket << level, (bucket + 1) << level))
+            last_day = active.day_number(expires_on - timedelta(microseconds=1))
+            self.assertEqual(sorted(covered), list(range(active.day_number(starts_on), last_day + 1)))
+            self.assertLessEqual(len(keys), 2 * active.LEVELS)
+
+    def test_active_now_and_at(self):
+        current = self.grant(self.guests[0], self.now - timedelta(hours=1), self.now + timedelta(hours=1))
+        long = self.grant(self.guests[1], self.now - timedelta(days=400), self.now + timedelta(days=400))
+        self.grant(self.guests[2], self.now - timedelta(days=10), self.now - timedelta(days=9))
+        self.grant(self.guests[3], self.now + timedelta(days=1), self.now + timedelta(days=2))
+        self.grant(self.guests[3], self.now - timedelta(hours=1), self.now + timedelta(hours=1), once_off=True, once_off_used=True)
+        self.assertEqual(self.active(), {self.guests[0].id: [current.id], self.guests[1].id: [long.id]})
+        self.assertEqual(set(self.active(self.now - timedelta(days=9, hours=12))), {self.guests[1].id, self.guests[2].id})
+        self.assertEqual(set(self.active(self.now + timedelta(days=1, hours=1))), {self.guests[1].id, self.guests[3].id})
+        self.assertEqual(self.client.get('/api/guests/active/', {'at': 'soon'}).status_code, 400)
+
+    def test_index_follows_writes(self):
+        permission = self.grant(self.guests[0], self.now - timedelta(hours=1), self.now + timedelta(hours=1))
+        permission.expires_on = self.now - timedelta(minutes=1)
+        permission.save()
+        self.assertEqual(self.active(), {})
+        GuestPermission.objects.issue([guest.id for guest in self.guests[:2]], self.user, self.now + timedelta(days=3))
+        self.assertEqual(set(self.active()), {self.guests[0].id, self.guests[1].id})
+        purge.soft_delete_guest(self.guests[1])
+        self.assertEqual(set(self.active()), {self.guests[0].id})
+        purge.run_pending()
+        self.assertFalse(PermissionSpan.objects.filter(guest=self.guests[1]).exists())
+        PermissionSpan.objects.all().delete()
+        call_command('index_permissions', stdout=open(os.devnull, 'w'))
+        self.assertEqual(set(self.active()), {self.guests[0].id})
+
+    def test_migration_indexes_existing_permissions(self):
+        for guest in self.guests[:3]:
+            self.grant(guest, self.now - timedelta(days=400), self.now + timedelta(days=30))
+        spans = sorted(PermissionSpan.objects.values_list('permission_id', 'key'))
+        PermissionSpan.objects.all().delete()
+        migration = importlib.import_module('api.migrations.0017_permission_spans')
+        migration.index_permissions(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(sorted(PermissionSpan.objects.values_list('permission_id', 'key')), spans)
+
+    def test_fixture_loads_are_not_indexed(self):
+        permission = self.grant(self.guests[0], self.now - timedelta(hours=1), self.now + timedelta(hours=1))
+        PermissionSpan.objects.all().delete()
+        post_save.send(GuestPermission, instance=permission, created=False, raw=True)
+        self.assertFalse(PermissionSpan.objects.exists())
+
+    def test_schedules_apply(self):
+        schedule = AccessSchedule.objects.create(name="Never now", rules="mon-sun 00:00-24:00",
+                                                 excluded_dates=timezone.localtime(self.now).date().isoformat(),
+                                                 created_by=self.user)
+        self.grant(self.guests[0], self.now - timedelta(days=2), self.now + timedelta(days=2), schedule=schedule)
+        self.assertEqual(self.active(), {})
+        self.assertEqual(set(self.active(self.now + timedelta(days=1))), {self.guests[0].id})
+
+    def test_cost_ignores_expired_history(self):
+        GuestPermission.objects.issue([guest.id for guest in self.guests], self.user, self.now - timedelta(days=30),
+                                      starts_on=self.now - timedelta(days=31))
+        expired = PermissionSpan.objects.filter(expires_on__lte=self.now).count()
+        self.grant(self.guests[0], self.now - timedelta(hours=1), self.now + timedelta(hours=1))
+        day = active.day_number(self.now)
+        scanned = PermissionSpan.objects.filter(key__in=[active.bucket_key(level, day) for level in range(active.LEVELS)]).count()
+        self.assertGreater(expired, 0)
+        self.assertEqual(scanned, 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(active.active_at()), [self.guests[0].id])
+
+
+class PresenceTestCase(TestCase):
+    """Test suite for incremental presence tracking and api/presence/."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guests = [Guest.objects.create(first_name="Guest", surname=str(i), mobile=str(i), created_by=self.user)
+                       for i in range(3)]
+        self.start = timezone.now() - timedelta(days=1)
+
+    def log(self, minutes, status, guest=None, user=None):
+        return GateActivity.objects.create(date=self.start + timedelta(minutes=minutes), gate_status=status,
+                                           responsible_guest=guest, responsible_user=user)
+
+    def state(self, guest):
+        row = Presence.objects.get(responsible_guest=guest)
+        return row.inside, (row.changed_on - self.start) // timedelta(minutes=1), (row.seen_on - self.start) // timedelta(minutes=1)
+
+    def test_follows_interactions(self):
+        guest = self.guests[0]
+        self.log(1, 1, guest)
+        self.assertEqual(self.state(guest), (True, 1, 1))
+        self.log(2, 0, guest)
+        self.log(3, 1, guest)
+        self.log(4, 1, guest)
+        self.assertEqual(self.state(guest), (True, 3, 4))
+        self.log(0, 0, guest)  # a late offline upload does not override newer state
+        self.assertEqual(self.state(guest), (True, 3, 4))
+
+    def test_batches(self):
+        guest = self.guests[1]
+        self.log(1, 1, guest)
+        presence.apply([{'date': self.start + timedelta(minutes=minutes), 'responsible_user_id': None,
+                         'responsible_guest_id': guest.id, 'gate_status': status}
+                        for minutes, status in ((7, 0), (5, 1), (6, 0))])
+        self.assertEqual(self.state(guest), (False, 6, 7))
+        presence.apply([GateActivity(date=self.start + timedelta(minutes=9), responsible_guest=guest, gate_status=0)])
+        self.assertEqual(self.state(guest), (False, 6, 9))
+
+    def test_rebuild_matches_incremental(self):
+        rng = random.Random(23)
+        for minutes in range(300):
+            person = rng.choice(self.guests + [self.user])
+            if isinstance(person, User):
+                self.log(minutes, rng.choice((0, 1)), user=person)
+            else:
+                self.log(minutes, rng.choice((0, 1)), guest=person)
+        fields = ('responsible_user', 'responsible_guest', 'inside', 'changed_on', 'seen_on')
+        incremental = sorted(Presence.objects.values_list(*fields), key=repr)
+        Presence.objects.all().delete()
+        call_command('rebuild_presence', chunk_size=2, stdout=open(os.devnull, 'w'))
+        self.assertEqual(sorted(Presence.objects.values_list(*fields), key=repr), incremental)
+
+    def test_endpoint(self):
+        self.log(1, 1, self.guests[0])
+        self.log(2, 1, self.guests[1])
+        self.log(3, 0, self.guests[1])
+        self.log(4, 1, user=self.user)
+        response = self.client.get('/api/presence/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['headcount'], {'users': 1, 'guests': 1, 'total': 2})
+        self.assertEqual(response.data['count'], 3)
+        inside = self.client.get('/api/presence/', {'inside': 'true'}).data['results']
+        self.assertEqual({(row['responsible_user'], row['responsible_guest']) for row in inside},
+                         {(self.user.id, None), (None, self.guests[0].id)})
+        self.assertFalse(self.client.get('/api/presence/', {'responsible_guest': self.guests[1].id}).data['results'][0]['inside'])
+
+
+class SiteTestCase(TestCase):
+    """Test suite for sites and gates on a single database: where gate opens are logged and which
+    permissions open which gates."""
+
+    def setUp(self):
+        principal_cache.clear()
+        token_cache.clear()
+        sites.registry.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.north, self.south = Site.objects.create(name="North", code="north"), Site.objects.create(name="South", code="south")
+        self.north_gate = Gate.objects.create(site=self.north, name="Main")
+        self.south_gate = Gate.objects.create(site=self.south, name="Main")
+
+    def open_guest(self, token, gate=None):
+        data = {'token': token, 'gate_status': 1}
+        if gate is not None:
+            data['gate'] = gate.pk
+        return APIClient().post('/api/interactions/guest/', data)
+
+    def test_gate_open_records_gate_and_site(self):
+        response = self.client.post('/api/interactions/user/', {'gate_status': 1, 'gate': self.south_gate.pk})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['gate'], response.data['site']), (self.south_gate.pk, self.south.pk))
+        self.assertEqual(GateActivity.objects.get().site_id, self.south.pk)
+        self.assertEqual(self.client.post('/api/interactions/user/', {'gate_status': 1, 'gate': 999}).status_code, 400)
+        listed = self.client.get('/api/interactions/', {'site': self.north.pk}).data['results']
+        self.assertEqual(listed, [])
+
+    def test_permission_limited_to_site(self):
+        GuestPermission.objects.create(token="north", guest=self.guest, granted_by=self.user, site=self.north,
+                                       expires_on=timezone.now() + timedelta(days=1))
+        GuestPermission.objects.create(token="anywhere", guest=self.guest, granted_by=self.user,
+                                       expires_on=timezone.now() + timedelta(days=1))
+        self.assertEqual(self.open_guest("north", self.north_gate).status_code, 201)
+        self.assertEqual(self.open_guest("north", self.south_gate).status_code, 403)
+        self.assertEqual(self.open_guest("north").status_code, 403)
+        self.assertEqual(self.open_guest("anywhere", self.south_gate).status_code, 201)
+        self.assertEqual(self.open_guest("anywhere").status_code, 201)
+        row = sync.bundle()['permissions'][0]
+        self.assertEqual(row[sync.PERMISSION_FIELDS.index('site')], self.north.pk)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='batch')
+    def test_device_opens_its_own_gate(self):
+        Device.objects.create(name="North gate", key_id="key1", secret="s3cret", user=self.user, gate=self.north_gate)
+        url = '/api/interactions/user/'
+
+        def post(data):
+            body = json.dumps(data)
+            return APIClient().post(url, body, content_type='application/json',
+                                    HTTP_AUTHORIZATION=device_token("key1", "s3cret", 'POST', url, body))
+
+        post({'gate_status': 1})
+        with self.assertNumQueries(2):  # device and gates cached: the INSERT and the presence UPDATE
+            response = post({'gate_status': 1})
+        self.assertEqual((response.data['gate'], response.data['site']), (self.north_gate.pk, self.north.pk))
+        for gate, status in ((self.north_gate, 201), (self.south_gate, 403)):
+            self.assertEqual(post({'gate_status': 1, 'gate': gate.pk}).status_code, status)
+
+    def test_device_cannot_open_a_gate_of_another_site(self):
+        Device.objects.create(name="North gate", key_id="key1", secret="s3cret", user=self.user, gate=self.north_gate)
+        GuestPermission.objects.create(token="south", guest=self.guest, granted_by=self.user, site=self.south,
+                                       expires_on=timezone.now() + timedelta(days=1))
+        url = '/api/interactions/guest/'
+        for gate in (self.south_gate.pk, None):
+            data = {'token': "south", 'gate_status': 1}
+            if gate is not None:
+                data['gate'] = gate
+            body = urlencode(data)  # the guest view reads the token from form data
+            response = APIClient().post(url, body, content_type='application/x-www-form-urlencoded',
+                                        HTTP_AUTHORIZATION=device_token("key1", "s3cret", 'POST', url, body))
+            self.assertEqual(response.status_code, 403)
+        self.assertFalse(GateActivity.objects.exists())
+
+    def test_stats_by_site(self):
+        for gate in (self.north_gate, self.north_gate, self.south_gate, None):
+            GateActivity.objects.create(responsible_user=self.user, gate=gate, site=gate and gate.site, gate_status=1)
+        response = self.client.get('/api/interactions/stats/', {'by': 'site'})
+        self.assertEqual({row['site']: row['count'] for row in response.data['results']},
+                         {self.north.pk: 2, self.south.pk: 1, None: 1})
+        response = self.client.get('/api/interactions/stats/', {'site': self.south.pk})
+        self.assertEqual([row['count'] for row in response.data['results']], [1])
+
+    def test_only_superusers_add_sites_and_gates(self):
+        self.assertEqual(self.client.get('/api/gates/', {'site': self.north.pk}).data['count'], 1)
+        self.assertEqual(self.client.post('/api/sites/', {'name': "East", 'code': "east"}).status_code, 403)
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertEqual(self.client.post('/api/sites/', {'name': "East", 'code': "east", 'database': "nowhere"}).status_code, 400)
+        self.assertEqual(self.client.post('/api/sites/', {'name': "East", 'code': "east"}).status_code, 201)
+        response = self.client.post('/api/gates/', {'name': "Back", 'site': self.south.pk})
+        self.assertEqual(response.status_code, 201)
+        # the new gate is known to the registry at once
+        opened = self.client.post('/api/interactions/user/', {'gate_status': 1, 'gate': response.data['id']})
+        self.assertEqual(opened.data['site'], self.south.pk)
+
+
+class SitePartitionTestCase(TransactionTestCase):
+    """Test suite for partitioning gate activity by site, with a second SQLite database holding the
+    activity of one site."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(SitePartitionTestCase, cls).setUpClass()
+        connections.databases['site_b'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('site_b')
+        call_command('migrate', database='site_b', verbosity=0, interactive=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['site_b'].close()
+        del connections.databases['site_b']
+        del connections._connections.site_b
+        super(SitePartitionTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        databases = override_settings(SITE_DATABASES=['site_b'])
+        databases.enable()
+        self.addCleanup(databases.disable)
+        sites.registry.clear()
+        token_cache.clear()
+        self.user = User.objects.create(username="admin")
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.a = Site.objects.create(name="A", code="a")
+        self.b = Site.objects.create(name="B", code="b", database='site_b')
+        self.gate_a = Gate.objects.create(site=self.a, name="Main")
+        self.gate_b = Gate.objects.create(site=self.b, name="Main")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        GateActivity.objects.using('site_b').all().delete()
+        IngestedBatch.objects.using('site_b').all().delete()
+
+    def log(self, count):
+        """count interactions a minute apart, alternating between the sites and between user and guest."""
+        start = timezone.now() - timedelta(days=1)
+        for minute in range(count):
+            gate = (self.gate_a, self.gate_b)[minute % 2]
+            GateActivity.objects.create(date=start + timedelta(minutes=minute), gate=gate, site=gate.site, gate_status=1,
+                                        responsible_user=self.user if minute % 3 else None,
+                                        responsible_guest=None if minute % 3 else self.guest)
+
+    def walk(self, url, **params):
+        rows, response = [], self.client.get(url, dict(params, page_size=3))
+        while True:
+            self.assertEqual(response.status_code, 200)
+            rows.extend(response.data['results'])
+            if not response.data['next']:
+                return rows
+            response = self.client.get(response.data['next'])
+
+    def test_gate_opens_go_to_their_site_database(self):
+        self.assertEqual(self.client.post('/api/interactions/user/', {'gate_status': 1, 'gate': self.gate_b.pk}).status_code, 201)
+        self.assertEqual(self.client.post('/api/interactions/user/', {'gate_status': 1, 'gate': self.gate_a.pk}).status_code, 201)
+        self.assertEqual(list(GateActivity.objects.using('site_b').values_list('site', flat=True)), [self.b.pk])
+        self.assertEqual(list(GateActivity.objects.values_list('site', flat=True)), [self.a.pk])
+        self.assertEqual(Presence.objects.get(responsible_user=self.user).seen_on,
+                         GateActivity.objects.get().date)
+
+    def test_failed_update_rolls_back_gate_open(self):
+        with mock.patch('api.presence.apply', side_effect=OperationalError):
+            for gate in (self.gate_a, self.gate_b):
+                with self.assertRaises(OperationalError):
+                    journal.log_activity(gate=gate, site=gate.site, gate_status=1, responsible_user=self.user)
+        self.assertFalse(GateActivity.objects.exists())
+        self.assertFalse(GateActivity.objects.using('site_b').exists())
+        self.assertFalse(ActivityRollup.objects.exists())
+
+    def test_listings_fan_out_and_merge(self):
+        self.log(10)
+        rows = self.walk('/api/interactions/')
+        self.assertEqual([row['site'] for row in rows], [(self.a.pk, self.b.pk)[minute % 2] for minute in reversed(range(10))])
+        self.assertEqual({row['responsible_user'] for row in rows if row['responsible_guest'] is None}, {"admin"})
+        self.assertEqual({row['site'] for row in self.walk('/api/interactions/', site=self.b.pk)}, {self.b.pk})
+        self.assertEqual(len(self.walk('/api/interactions/guest/', responsible_guest=self.guest.pk)), 4)
+        with override_settings(LEAN_ACTIVITY_LISTS=True):
+            self.assertEqual(self.walk('/api/interactions/'), rows)
+
+    def test_guest_details_fan_out(self):
+        self.log(10)
+        url = '/api/guests/{0}/'.format(self.guest.pk)
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['gate_interactions']), 4)
+        GateActivity.objects.create(gate=self.gate_b, site=self.b, gate_status=0, responsible_guest=self.guest)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['gate_interactions']), 5)
+
+    def test_stream_tails_and_resumes_every_database(self):
+        broker = stream.TailingBroker(start_tailer=False)
+        subscription = broker.subscribe()
+        self.log(4)  # default, site_b, default, site_b
+        self.assertEqual(broker.poll(), 4)
+        self.assertEqual([row['database'] for row in subscription.get(0)], ['default', 'site_b'] * 2)
+        first, second = GateActivity.objects.order_by('id').values_list('id', flat=True)
+        b_first, b_second = GateActivity.objects.using('site_b').order_by('id').values_list('id', flat=True)
+        with mock.patch.object(stream, 'get_broker', return_value=stream.ActivityBroker()):
+            response = self.client.get('/api/interactions/stream/', HTTP_LAST_EVENT_ID='default:{0}'.format(first))
+            events = iter(response.streaming_content)
+            next(events)  # retry:
+            ids = [next(events).decode('utf-8').splitlines()[0] for _ in range(3)]
+            response.close()
+        self.assertEqual(ids, ['id: default:{0},site_b:{1}'.format(first, b_first),
+                               'id: default:{0},site_b:{1}'.format(second, b_first),
+                               'id: default:{0},site_b:{1}'.format(second, b_second)])
+
+    def test_export_merges_databases(self):
+        self.log(7)
+        response = self.client.get('/api/interactions/export/')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual([row['site_id'] for row in rows], [(self.a.pk, self.b.pk)[minute % 2] for minute in range(7)])
+        self.assertEqual(rows[0]['responsible_guest'], "Jane Doe")
+        self.assertEqual(rows[1]['responsible_user'], "admin")
+
+    def test_rebuilds_read_every_database(self):
+        self.log(9)
+        incremental = sorted(ActivityRollup.objects.values_list('period', 'bucket', 'site', 'responsible_user',
+                                                                'responsible_guest', 'gate_status', 'count'), key=repr)
+        self.assertEqual(rollups.rebuild(), 9)
+        self.assertEqual(sorted(ActivityRollup.objects.values_list('period', 'bucket', 'site', 'responsible_user',
+                                                                   'responsible_guest', 'gate_status', 'count'), key=repr),
+                         incremental)
+        fields = ('responsible_user', 'responsible_guest', 'inside', 'changed_on', 'seen_on')
+        incremental = sorted(Presence.objects.values_list(*fields), key=repr)
+        Presence.objects.all().delete()
+        self.assertEqual(presence.rebuild(), 9)
+        self.assertEqual(sorted(Presence.objects.values_list(*fields), key=repr), incremental)
+
+    @override_settings(ACTIVITY_ROLLUP_MODE='save')
+    def test_offline_upload_to_site_database_is_ingested_once(self):
+        events = [{'date': timezone.now(), 'gate_status': 1, 'permission': None}] * 2
+        with mock.patch('api.presence.apply', side_effect=RuntimeError("crashed")):
+            with self.assertRaises(RuntimeError):
+                sync.ingest_offline(events, self.user, 'batch', gate_id=self.gate_b.pk)
+        self.assertEqual(GateActivity.objects.using('site_b').count(), 2)  # committed before the crash
+        self.assertFalse(ActivityRollup.objects.exists())
+        self.assertEqual(sync.ingest_offline(events, self.user, 'batch', gate_id=self.gate_b.pk), (2, 0))
+        self.assertIsNone(sync.ingest_offline(events, self.user, 'batch', gate_id=self.gate_b.pk))
+        self.assertEqual(GateActivity.objects.using('site_b').count(), 2)
+        self.assertEqual(ActivityRollup.objects.get(period=ActivityRollup.DAY).count, 2)
+        self.assertEqual(sync.prune_batches(timezone.now() + timedelta(seconds=1)), 2)  # in both databases
+
+    def test_journal_replay_inserts_site_rows_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'crashed.journal')
+        with open(path, 'w') as segment:
+            segment.write(json.dumps({'date': timezone.now().isoformat(), 'responsible_user_id': self.user.id,
+                                      'responsible_guest_id': None, 'gate_id': self.gate_b.pk, 'site_id': self.b.pk,
+                                      'gate_status': 1}) + '\n')
+        with mock.patch('api.presence.apply', side_effect=RuntimeError("crashed")):
+            with self.assertRaises(RuntimeError):
+                journal.commit_segment(path, journal.read_segment(path))
+        self.assertEqual(journal.commit_segment(path, journal.read_segment(path)), 1)
+        self.assertEqual(GateActivity.objects.using('site_b').count(), 1)
+        self.assertFalse(IngestedBatch.objects.using('site_b').exists())
+
+    def test_offline_upload_and_purge_reach_site_database(self):
+        permission = GuestPermission.objects.create(token="abc", guest=self.guest, granted_by=self.user,
+                                                    expires_on=timezone.now() + timedelta(days=1))
+        events = [{'date': timezone.now(), 'gate_status': 1, 'permission': permission.pk},
+                  {'date': timezone.now(), 'gate_status': 0, 'permission': None}]
+        self.assertEqual(sync.ingest_offline(events, self.user, 'batch', gate_id=self.gate_b.pk), (2, 0))
+        self.assertEqual(GateActivity.objects.using('site_b').count(), 2)
+        with override_settings(PURGE={'IN_PROCESS': False}):
+            purge.soft_delete_guest(self.guest)
+            purge.run_pending()
+        self.assertFalse(Guest.objects.exists())
+        self.assertEqual(list(GateActivity.objects.using('site_b').values_list('responsible_user', flat=True)), [self.user.pk])
+
+
+class ActivityArchiveTestCase(TestCase):
+    """Test suite for moving old gate activity to the archive, and reading it back."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        options = override_settings(ACTIVITY_ARCHIVE={'DIR': self.directory, 'HORIZON_DAYS': 3, 'BATCH_SIZE': 7})
+        options.enable()
+        self.addCleanup(options.disable)
+        archive.people.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(self.user)
+        self.guest = Guest.objects.create(first_name="Jane", surname="Doe", mobile="0820000000", created_by=self.user)
+        self.gate = Gate.objects.create(site=Site.objects.create(name="A", code="a"), name="Main")
+        start = timezone.now() - timedelta(days=6)
+        for index in range(30):
+            # every ten hours over six days, pairs sharing a timestamp so the id tie-breaker is exercised
+            GateActivity.objects.create(date=start + timedelta(hours=10 * (index // 2)), gate_status=index % 2,
+                                        gate=self.gate if index % 4 else None, site=self.gate.site if index % 4 else None,
+                                        responsible_user=self.user if index % 3 else None,
+                                        responsible_guest=None if index % 3 else self.guest)
+        self.cutoff = timezone.now() - timedelta(days=3)
+
+    def archive(self):
+        out = StringIO()
+        call_command('archive_activity', stdout=out)
+        return out.getvalue()
+
+    def walk(self, url):
+        rows = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            rows.extend(response.data['results'])
+            url = response.data['next']
+        return rows
+
+    def export(self, url='/api/interactions/export/'):
+        return b''.join(self.client.get(url).streaming_content).decode('utf-8')
+
+    def listings(self):
+        window = '&since={0}&until={1}'.format((timezone.now() - timedelta(days=5)).isoformat().replace('+', '%2B'),
+                                               (timezone.now() - timedelta(days=1)).isoformat().replace('+', '%2B'))
+        return [self.walk(url) for url in (
+            '/api/interactions/?page_size=4', '/api/interactions/?page_size=1000',
+            '/api/interactions/?page_size=5' + window, '/api/interactions/?page_size=3&gate={0}'.format(self.gate.pk),
+            '/api/interactions/user/?page_size=4', '/api/interactions/guest/?page_size=2&gate_status=0',
+            '/api/interactions/?gate=x')]
+
+    def test_archive_changes_etag(self):
+        etag = self.client.get('/api/interactions/')['ETag']
+        self.archive()
+        self.assertEqual(self.client.get('/api/interactions/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_moves_old_rows_and_reads_them_back(self):
+        old = GateActivity.objects.filter(date__lt=self.cutoff).count()
+        listings, export = self.listings(), self.export()
+        with override_settings(LEAN_ACTIVITY_LISTS=True):
+            lean = self.listings()
+        self.assertIn("Archived {0} activity rows.".format(old), self.archive())
+        self.assertFalse(GateActivity.objects.filter(date__lt=self.cutoff).exists())
+        self.assertEqual(self.archive(), "Archived 0 activity rows.\n")
+        days = [name for name in os.listdir(self.directory) if not name.startswith('.')]
+        self.assertGreaterEqual(len(days), 3)
+        for day in days:
+            names = os.listdir(os.path.join(self.directory, day))
+            self.assertEqual(len([name for name in names if name.endswith(archive.SUFFIX)]),
+                             len([name for name in names if name.endswith(archive.INDEX_SUFFIX)]))
+        self.assertEqual(self.listings(), listings)
+        self.assertEqual(self.export(), export)
+        with override_settings(LEAN_ACTIVITY_LISTS=True):
+            self.assertEqual(self.listings(), lean)
+
+    def test_backward_walk_crosses_the_horizon(self):
+        expected = self.walk('/api/interactions/?page_size=4')
+        self.archive()
+        url = '/api/interactions/?page_size=4'
+        while True:
+            response = self.client.get(url)
+            if not response.data['next']:
+                break
+            url = response.data['next']
+        rows = list(response.data['results'])
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            rows[:0] = response.data['results']
+        self.assertEqual(rows, expected)
+
+    def test_recent_pages_do_not_read_the_archive(self):
+        self.archive()
+        with mock.patch('api.archive.iter_records') as records:
+            self.assertEqual(len(self.client.get('/api/interactions/?page_size=3').data['results']), 3)
+            self.assertFalse(records.called)
+
+    def test_reads_only_the_files_and_people_they_need(self):
+        self.archive()
+        archived = list(archive.iter_records())
+        with mock.patch('api.archive._iter_file', wraps=archive._iter_file) as opened:
+            older = list(archive.iter_records(position=(archived[1]['date'], archived[1]['id']), descending=True))
+        self.assertEqual(older, archived[:1])
+        self.assertEqual(opened.call_count, 1)  # the oldest file, found by its index
+        self.assertEqual(len(archive._living(archived)), len(archived))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(archive._living(archived)), len(archived))
+
+    def test_interrupted_runs_are_settled(self):
+        rows = list(GateActivity.objects.filter(date__lt=self.cutoff).order_by('date', 'id').values_list(*archive.FIELDS))
+        kept = archive._write_data(self.directory, archive._day(rows[0][1]), 'default', rows[:1])
+        moved = archive._write_data(self.directory, archive._day(rows[1][1]), 'default', rows[1:2])
+        GateActivity.objects.filter(pk=rows[1][0]).delete()  # as if the run died after its delete committed
+        archive.recover(self.directory)
+        self.assertFalse(os.path.exists(kept))
+        self.assertTrue(os.path.exists(moved[:-len(archive.SUFFIX)] + archive.INDEX_SUFFIX))
+        self.archive()
+        archived = list(archive.iter_records())
+        self.assertEqual([(record['date'], record['id']) for record in archived], [(row[1], row[0]) for row in rows])
+
+    def test_rebuilds_include_archived_rows(self):
+        fields = ('period', 'bucket', 'site', 'responsible_user', 'responsible_guest', 'gate_status', 'count')
+        incremental = sorted(ActivityRollup.objects.values_list(*fields), key=repr)
+        people = ('responsible_user', 'responsible_guest', 'inside', 'changed_on', 'seen_on')
+        present = sorted(Presence.objects.values_list(*people), key=repr)
+        self.archive()
+        self.assertEqual(rollups.rebuild(), 30)
+        self.assertEqual(sorted(ActivityRollup.objects.values_list(*fields), key=repr), incremental)
+        Presence.objects.all().delete()
+        self.assertEqual(presence.rebuild(), 30)
+        self.assertEqual(sorted(Presence.objects.values_list(*people), key=repr), present)
+
+    def test_purged_guest_is_hidden(self):
+        self.archive()
+        with override_settings(PURGE={'IN_PROCESS': False}):
+            purge.soft_delete_guest(self.guest)
+            purge.run_pending()
+        self.assertEqual({row['responsible_user'] for row in self.walk('/api/interactions/?page_size=4')}, {"admin"})
+        self.assertEqual(self.walk('/api/interactions/guest/'), [])
+        self.assertNotIn("Jane", self.export())
+        self.assertEqual(rollups.rebuild(), 20)
@@ -8,11 +8,28 @@ urlpatterns = [
     url(r'^users/create/$', views.CreateUserView.as_view(), name="create_user"),
     url(r'^guests/$', views.GuestView.as_view(), name="guests"),
     url(r'^guests/(?P<pk>[0-9]+)/$', views.GuestDetailView.as_view(), name="guest_details"),
+    url(r'^guests/active/$', views.ActiveGuestView.as_view(), name="active_guests"),
+    url(r'^guests/search/$', views.GuestSearchView.as_view(), name="guest_search"),
+    url(r'^guests/import/$', views.GuestImportView.as_view(), name="guest_import"),
     url(r'^guests/permissions/$', views.GuestPermissionView.as_view(), name="guest_permissions"),
+    url(r'^guests/permissions/bundle/$', views.PermissionBundleView.as_view(), name="guest_permission_bundle"),
+    url(r'^guests/permissions/changes/$', views.PermissionDeltaView.as_view(), name="guest_permission_changes"),
+    url(r'^guests/permissions/batch/$', views.GuestPermissionBatchView.as_view(), name="guest_permission_batch"),
     url(r'^guests/permissions/(?P<pk>[0-9]+)/$', views.GuestPermissionDetailView.as_view(), name="guest_permission_details"),
+    url(r'^schedules/$', views.AccessScheduleView.as_view(), name="access_schedules"),
+    url(r'^schedules/(?P<pk>[0-9]+)/$', views.AccessScheduleDetailView.as_view(), name="access_schedule_details"),
+    url(r'^sites/$', views.SiteView.as_view(), name="sites"),
+    url(r'^gates/$', views.GateView.as_view(), name="gates"),
     url(r'^interactions/$', views.GateInteractionView.as_view(), name="gate_interactions"),
+    url(r'^interactions/export/$', views.GateInteractionExportView.as_view(), name="gate_interaction_export"),
+    url(r'^interactions/stream/$', views.GateInteractionStreamView.as_view(), name="gate_interaction_stream"),
+    url(r'^interactions/stats/$', views.GateActivityStatsView.as_view(), name="gate_interaction_stats"),
+    url(r'^interactions/offline/$', views.OfflineActivityView.as_view(), name="offline_gate_interactions"),
     url(r'^interactions/user/$', views.UserGateInteractionView.as_view(), name="create_user_gate_interaction"),
     url(r'^interactions/guest/$', views.GuestGateInteractionView.as_view(), name="create_guest_gate_interaction"),
+    url(r'^presence/$', views.PresenceView.as_view(), name="presence"),
+    url(r'^purges/(?P<pk>[0-9]+)/$', views.PurgeJobDetailView.as_view(), name="purge_job_details"),
+    url(r'^metrics/$', views.MetricsView.as_view(), name="metrics"),
 ]
 
 # this allows us to specify data format (json, html) when using URLs. Appends format
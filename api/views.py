@@ -1,20 +1,54 @@
+from collections import OrderedDict
+
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import generics, permissions, exceptions
+from rest_framework import generics, permissions, exceptions, status
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.views import APIView
+from django.conf import settings
+from django.db.models import Count, Max, Prefetch, ProtectedError, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.crypto import get_random_string
 from .serializers import *
 from .models import *
-from .permissions import IsSuperUser
+from .permissions import IsDevice, IsSuperUser, IsSuperUserOrReadOnly
+from . import active, metrics, presence, purge, stream, sync
+from .authentication import principal_cache
+from .cache import lookup_token
+from .importers import detect_format, import_guests, iter_rows
+from .rollups import PERIODS
+from .export import ACTIVITY_COLUMNS, CSVRenderer, NDJSONRenderer, csv_lines, iter_activity, ndjson_lines
+from .filters import DateWindowFilter, parse_instant
+from .pagination import GateActivityCursorPagination
+from .conditional import ConditionalActivityMixin, ConditionalGetMixin
+from .lean import LeanListMixin
+from .routers import ReplicaReadMixin
+from .search import search_guests
+from .sites import SitePartitionMixin, partitions
+from .archive import ArchiveReadMixin
 
+# The PrimaryKeyRelatedField(many=True) fields of UserSerializer/GuestDetailSerializer only need ids, so
+# prefetch just the id (and the FK used to match rows back to their parent) of each related row. A guest's
+# gate_interactions can live in every activity database, which one Prefetch cannot read: see GuestDetailView.
+USER_RELATED = (
+    Prefetch('created_guests', queryset=Guest.objects.only('id', 'created_by')),
+    Prefetch('permissions_granted', queryset=GuestPermission.objects.only('id', 'granted_by')),
+)
+GUEST_RELATED = (
+    Prefetch('permissions', queryset=GuestPermission.objects.only('id', 'guest')),
+)
 
-class UserListView(generics.ListAPIView):
-    queryset = User.objects.all()
+
+class UserListView(ReplicaReadMixin, generics.ListAPIView):
+    queryset = User.objects.prefetch_related(*USER_RELATED)
     serializer_class = UserSerializer
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('first_name', 'username', 'last_name')
 
 
-class UserDetailView(generics.RetrieveAPIView):
-    queryset = User.objects.all()
+class UserDetailView(ReplicaReadMixin, generics.RetrieveAPIView):
+    queryset = User.objects.prefetch_related(*USER_RELATED)
     serializer_class = UserSerializer
 
 
@@ -24,10 +58,10 @@ class CreateUserView(generics.CreateAPIView):
     permission_classes = (permissions.IsAuthenticated, IsSuperUser)  # expects a set of classes
 
 
-class GuestView(generics.ListCreateAPIView):
+class GuestView(ReplicaReadMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     """Create (POST) and list (GET) all Guests on this URL. No need to create different endpoint
     for create since permission is same in this case (doesn't require super user)"""
-    queryset = Guest.objects.all()
+    queryset = Guest.objects.alive().select_related('created_by')
     serializer_class = GuestSerializer
 
     def perform_create(self, serializer):
@@ -37,79 +71,386 @@ class GuestView(generics.ListCreateAPIView):
         serializer.save(created_by=self.request.user)
 
 
-class GuestDetailView(generics.RetrieveUpdateDestroyAPIView):
+class GuestSearchView(ReplicaReadMixin, generics.GenericAPIView):
+    """Typeahead search (GET) for guests by first name, surname or mobile: ?q=<what was typed so far>,
+    optionally ?limit= (default GUEST_SEARCH_LIMIT, at most 50). Responds with a ranked list of guests,
+    see api.search.search_guests."""
+    queryset = Guest.objects.alive().select_related('created_by')
+    serializer_class = GuestSerializer
+    max_limit = 50
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise serializers.ValidationError(detail={'q': ["A search term is required."]})
+        try:
+            limit = int(request.query_params.get('limit', getattr(settings, 'GUEST_SEARCH_LIMIT', 10)))
+        except ValueError:
+            raise serializers.ValidationError(detail={'limit': ["Expected an integer."]})
+        guests = search_guests(query, max(1, min(limit, self.max_limit)), self.get_queryset())
+        return Response(self.get_serializer(guests, many=True).data)
+
+
+class ActiveGuestView(ReplicaReadMixin, generics.ListAPIView):
+    """Guests (GET) allowed in at ?at=<ISO 8601 instant> (default now): those with a permission whose window
+    and schedule cover that instant, see api.active.active_at. Each guest lists the ids of those
+    permissions as active_permissions."""
+    queryset = Guest.objects.alive().select_related('created_by')
+    serializer_class = ActiveGuestSerializer
+
+    def get_queryset(self):
+        at = self.request.query_params.get('at')
+        self.active = active.active_at(parse_instant(at, 'at') if at else None)
+        return super(ActiveGuestView, self).get_queryset().filter(id__in=list(self.active)).order_by('id')
+
+    def get_serializer_context(self):
+        context = super(ActiveGuestView, self).get_serializer_context()
+        context['active'] = getattr(self, 'active', {})
+        return context
+
+
+class GuestImportView(APIView):
+    """Bulk create Guests from a CSV (with a first_name,surname,email,mobile header) or NDJSON file
+    uploaded as multipart field `file` (POST). The file is parsed as a stream and inserted in batches of
+    GUEST_IMPORT_BATCH_SIZE rows (overridable with ?batch_size=, up to GUEST_IMPORT_MAX_BATCH_SIZE).
+    Responds with the number of guests created and the errors of every rejected row."""
+    parser_classes = (MultiPartParser,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        upload = request.data.get('file')
+        if upload is None or not hasattr(upload, 'read'):
+            raise serializers.ValidationError(detail={'file': ["No file uploaded."]})
+        fmt = detect_format(upload)
+        if fmt is None:
+            raise serializers.ValidationError(detail={'file': ["Expected a .csv or .ndjson file."]})
+        try:
+            batch_size = int(request.query_params.get('batch_size', getattr(settings, 'GUEST_IMPORT_BATCH_SIZE', 500)))
+        except ValueError:
+            raise serializers.ValidationError(detail={'batch_size': ["Expected an integer."]})
+        batch_size = max(1, min(batch_size, getattr(settings, 'GUEST_IMPORT_MAX_BATCH_SIZE', 5000)))
+        report = import_guests(iter_rows(upload, fmt), request.user, batch_size)
+        return Response(report)
+
+
+class GuestDetailView(ReplicaReadMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     """View extra details on each guest (GET). DELETE and PUT to delete and update record."""
-    queryset = Guest.objects.all()
+    queryset = Guest.objects.alive().select_related('created_by').prefetch_related(*GUEST_RELATED)
     serializer_class = GuestDetailSerializer
 
+    def get_fingerprint(self):
+        """The guest itself plus the interactions (in every activity database) and permissions listed with it."""
+        pk = self.kwargs['pk']
+        return (list(Guest.objects.alive().filter(pk=pk).values_list('updated_at', flat=True)),
+                [activity.aggregate(last=Max('id'))['last']
+                 for activity in partitions(GateActivity.objects.filter(responsible_guest=pk))],
+                GuestPermission.objects.filter(guest=pk).aggregate(changed=Max('updated_at'), count=Count('pk')))
+
+    def retrieve(self, request, *args, **kwargs):
+        guest = self.get_object()
+        # stands in for a prefetch of gate_interactions, read from every activity database
+        interactions = GateActivity.objects.filter(responsible_guest=guest.pk).only('id', 'responsible_guest')
+        guest._prefetched_objects_cache['gate_interactions'] = [
+            activity for partition in partitions(interactions) for activity in partition]
+        return Response(self.get_serializer(guest).data)
+
     def delete(self, request, *args, **kwargs):
-        """Override delete method to only allow superuser to delete guest records."""
+        """Override delete method to only allow superuser to delete guest records. The guest disappears
+        (and its tokens stop working) at once; its row and history are removed in the background by a
+        purge job, whose progress can be followed at the returned Location (202 Accepted)."""
         if request.user.is_superuser:
-            return self.destroy(request, *args, **kwargs)
+            job = purge.soft_delete_guest(self.get_object())
+            location = reverse('purge_job_details', kwargs={'pk': job.pk}, request=request)
+            return Response(PurgeJobSerializer(job).data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
         else:
             raise exceptions.PermissionDenied
 
 
-class GuestPermissionView(generics.ListCreateAPIView):
+class GuestPermissionView(ReplicaReadMixin, ConditionalGetMixin, generics.ListCreateAPIView):
     """Create (POST) and list (GET) all Guests on this URL. No need to create different endpoint
     for create since permission is same in this case (doesn't require super user)"""
-    queryset = GuestPermission.objects.all()
+    queryset = GuestPermission.objects.select_related('granted_by')
     serializer_class = GuestPermissionSerializer
+    filter_fields = {'guest': ['exact'], 'expires_on': ['gte', 'lt'], 'once_off': ['exact']}
 
     def perform_create(self, serializer):
         """Create new Guest on POST to linked URL. Owner must be passed
            in as a parameter since it was defined as a custom serializer attribute
            in serializers.py (permissions and interactions will be empty initially."""
-        serializer.save(granted_by=self.request.user, token=get_random_string(length=16))
+        serializer.save(granted_by=self.request.user, token=get_random_string(length=TOKEN_LENGTH))
+
+
+class AccessScheduleView(generics.ListCreateAPIView):
+    """Create (POST) and list (GET) recurring access schedules, which permissions can then refer to."""
+    queryset = AccessSchedule.objects.select_related('created_by')
+    serializer_class = AccessScheduleSerializer
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user)
+
+
+class AccessScheduleDetailView(generics.RetrieveUpdateDestroyAPIView):
+    """View (GET), change (PUT/PATCH) or delete (DELETE) an access schedule. Changes apply to every
+    permission using the schedule; a schedule still in use cannot be deleted."""
+    queryset = AccessSchedule.objects.select_related('created_by')
+    serializer_class = AccessScheduleSerializer
 
+    def perform_destroy(self, instance):
+        try:
+            instance.delete()
+        except ProtectedError:
+            raise serializers.ValidationError(detail="The schedule is still used by guest permissions.")
+
+
+class SiteView(generics.ListCreateAPIView):
+    """List (GET) the sites, or add one (POST, superusers only)."""
+    queryset = Site.objects.order_by('id')
+    serializer_class = SiteSerializer
+    permission_classes = (permissions.IsAuthenticated, IsSuperUserOrReadOnly)
+
+
+class GateView(generics.ListCreateAPIView):
+    """List (GET) the gates, filterable by ?site=, or add one (POST, superusers only)."""
+    queryset = Gate.objects.order_by('id')
+    serializer_class = GateSerializer
+    permission_classes = (permissions.IsAuthenticated, IsSuperUserOrReadOnly)
+    filter_fields = ('site',)
+
+
+class GuestPermissionBatchView(APIView):
+    """Grant the same window (starts_on, expires_on, once_off) to a list of guests in one POST. All
+    permissions are inserted in a single transaction; responds with a map of guest id to token."""
+    permission_classes = (permissions.IsAuthenticated,)
 
-class GuestPermissionDetailView(generics.RetrieveUpdateDestroyAPIView):
+    def post(self, request, *args, **kwargs):
+        serializer = GuestPermissionBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        issued = GuestPermission.objects.issue(data['guests'], request.user, data['expires_on'],
+                                               starts_on=data.get('starts_on'), once_off=data['once_off'],
+                                               schedule=data.get('schedule'), site=data.get('site'))
+        return Response({'tokens': OrderedDict((p.guest_id, p.token) for p in issued)}, status=status.HTTP_201_CREATED)
+
+
+class PermissionBundleView(APIView):
+    """Signed bundle (GET) of every currently valid guest permission - token hashes, windows and once-off
+    flags - for a gate controller to check guest opens locally while offline. Sync it afterwards with
+    guests/permissions/changes/?since=<version>. Signed with the requesting device's secret."""
+    permission_classes = (IsDevice,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(sync.signed(principal_cache.get(request.auth)[1], sync.bundle()))
+
+
+class PermissionDeltaView(APIView):
+    """Signed delta (GET) of the permissions created, changed or revoked since ?since=<version>. Answers
+    410 if the change log has been pruned past that version; the controller must then re-fetch the bundle."""
+    permission_classes = (IsDevice,)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params['since'])
+        except (KeyError, ValueError):
+            raise serializers.ValidationError(detail={'since': ["A version number is required."]})
+        payload = sync.delta(since)
+        if payload is None:
+            return Response({'detail': "Version {0} is too old, fetch a new bundle.".format(since)},
+                            status=status.HTTP_410_GONE)
+        return Response(sync.signed(principal_cache.get(request.auth)[1], payload))
+
+
+class PresenceView(ReplicaReadMixin, generics.ListAPIView):
+    """Who is on site (GET): the headcount of users and guests currently inside, and the inside/outside
+    state of every user and guest since their last change, filterable by ?inside=, ?responsible_user= and
+    ?responsible_guest=. Follows the gate_status of each person's latest interaction, see api.presence."""
+    queryset = Presence.objects.order_by('-changed_on', 'id')
+    serializer_class = PresenceSerializer
+    filter_fields = ('inside', 'responsible_user', 'responsible_guest')
+
+    def list(self, request, *args, **kwargs):
+        response = super(PresenceView, self).list(request, *args, **kwargs)
+        response.data['headcount'] = presence.headcount()
+        response.data.move_to_end('headcount', last=False)
+        return response
+
+
+class PurgeJobDetailView(generics.RetrieveAPIView):
+    """Progress (GET) of a background purge job: state, rows deleted so far and any error."""
+    queryset = PurgeJob.objects.all()
+    serializer_class = PurgeJobSerializer
+    permission_classes = (permissions.IsAuthenticated, IsSuperUser)
+
+
+class GuestPermissionDetailView(ReplicaReadMixin, ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     """View extra details on each guest (GET). DELETE and PUT to delete and update record."""
-    queryset = GuestPermission.objects.all()
+    queryset = GuestPermission.objects.select_related('granted_by')
     serializer_class = GuestPermissionSerializer
 
 
-class GateInteractionView(generics.ListAPIView):
-    """Allows GET to appropriate endpoint to list all gate interactions"""
-    queryset = GateActivity.objects.all()
+class GateInteractionView(ReplicaReadMixin, SitePartitionMixin, ArchiveReadMixin, ConditionalActivityMixin, LeanListMixin,
+                          generics.ListAPIView):
+    """Allows GET to appropriate endpoint to list all gate interactions. ?site= reads only that site's
+    activity (from its database); without it every activity database is read and merged, as is the
+    archive once a page reaches back past the rows still in the databases."""
+    queryset = GateActivity.objects.select_related('responsible_user')
     serializer_class = GateActivitySerializer
+    pagination_class = GateActivityCursorPagination
+    filter_backends = (DjangoFilterBackend, DateWindowFilter)
+    filter_fields = ('responsible_user', 'responsible_guest', 'gate', 'site', 'gate_status')
+
+
+class GateInteractionExportView(ReplicaReadMixin, SitePartitionMixin, ArchiveReadMixin, generics.GenericAPIView):
+    """Stream the complete gate log (GET), oldest first, as NDJSON (default) or CSV - chosen with the
+    Accept header, ?format=csv or an .ndjson/.csv suffix. Accepts the same since/until, responsible_x,
+    gate and site filters as the listing, and includes the archived activity."""
+    queryset = GateActivity.objects.all()
+    permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (NDJSONRenderer, CSVRenderer)
+    filter_backends = (DjangoFilterBackend, DateWindowFilter)
+    filter_fields = ('responsible_user', 'responsible_guest', 'gate', 'site', 'gate_status')
+
+    def get(self, request, *args, **kwargs):
+        rows = iter_activity(self.get_partitions(self.filter_queryset(self.get_queryset())),
+                             archived=self.iter_archive(GateActivity.objects.values_list(*ACTIVITY_COLUMNS)))
+        renderer = request.accepted_renderer
+        lines = csv_lines(rows) if renderer.format == 'csv' else ndjson_lines(rows)
+        response = StreamingHttpResponse(lines, content_type=renderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="gate-activity.{0}"'.format(renderer.format)
+        return response
+
+
+class GateInteractionStreamView(APIView):
+    """Live gate interactions (GET) from every activity database as Server-Sent Events: an `activity` event
+    per new row, with its export fields as JSON data and as event id the stream's position in each
+    database ('default:120,site_b:42', see api.stream.event_id). A reconnecting client sends Last-Event-ID
+    (or ?last_event_id=) and first gets the rows it missed. Every stream of a process is fed by the same
+    tailing queries (see api.stream), so watchers do not add database load."""
+    renderer_classes = (stream.EventStreamRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        positions = request.META.get('HTTP_LAST_EVENT_ID', request.query_params.get('last_event_id'))
+        if positions is not None:
+            try:
+                positions = stream.parse_event_id(positions)
+            except ValueError:
+                raise serializers.ValidationError(detail={'last_event_id': ["Expected an activity event id."]})
+        options = stream.stream_options()
+        events = stream.event_stream(stream.get_broker(), positions, heartbeat=options.get('HEARTBEAT', 15))
+        response = StreamingHttpResponse(events, content_type=stream.EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the stream
+        return response
+
+
+class GateActivityStatsView(ReplicaReadMixin, APIView):
+    """Gate interaction counts (GET) per hour or day bucket, read only from the activity rollups.
+    ?period=hour|day (default day), ?by=site|user|guest|status to split each bucket further, plus the
+    usual since/until window and site/responsible_user/responsible_guest/gate_status filters. The rollups
+    count the activity of every site database, so cross-site reports need no fan-out."""
+    groupings = OrderedDict([('site', 'site'), ('user', 'responsible_user'), ('guest', 'responsible_guest'),
+                             ('status', 'gate_status')])
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        period = params.get('period', ActivityRollup.DAY)
+        if period not in dict(PERIODS):
+            raise serializers.ValidationError(detail={'period': ["Expected one of: {0}.".format(', '.join(dict(PERIODS)))]})
+        keys = ['bucket']
+        for group in params.getlist('by'):
+            if group not in self.groupings:
+                raise serializers.ValidationError(detail={'by': ["Expected one of: {0}.".format(', '.join(self.groupings))]})
+            keys.append(self.groupings[group])
 
+        rollups = ActivityRollup.objects.filter(period=period)
+        if params.get('since'):
+            rollups = rollups.filter(bucket__gte=parse_instant(params['since'], 'since'))
+        if params.get('until'):
+            rollups = rollups.filter(bucket__lt=parse_instant(params['until'], 'until'))
+        for field in self.groupings.values():
+            if params.get(field):
+                try:
+                    rollups = rollups.filter(**{field: int(params[field])})
+                except ValueError:
+                    raise serializers.ValidationError(detail={field: ["Expected an integer."]})
 
-class UserGateInteractionView(generics.ListCreateAPIView):
+        rows = rollups.values(*keys).annotate(count=Sum('count')).order_by(*keys)
+        date_field = serializers.DateTimeField()
+        for row in rows:
+            row['bucket'] = date_field.to_representation(row['bucket'])
+        return Response({'period': period, 'results': list(rows)})
+
+
+class OfflineActivityView(APIView):
+    """Bulk upload (POST) of the gate interactions a controller logged while offline, as
+    {"batch_id": ..., "events": [{"date": ..., "gate_status": ..., "permission": <id or null>}]}. Uploading
+    the same batch_id again is a no-op, so controllers can safely retry."""
+    permission_classes = (IsDevice,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = OfflineBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        result = sync.ingest_offline(data['events'], request.user, '{0}:{1}'.format(request.auth, data['batch_id']),
+                                     gate_id=principal_cache.gate(request.auth))
+        if result is None:
+            return Response({'batch_id': data['batch_id'], 'duplicate': True})
+        created, skipped = result
+        return Response({'batch_id': data['batch_id'], 'created': created, 'skipped': skipped},
+                        status=status.HTTP_201_CREATED)
+
+
+class UserGateInteractionView(ReplicaReadMixin, SitePartitionMixin, ArchiveReadMixin, ConditionalActivityMixin,
+                              LeanListMixin, generics.ListCreateAPIView):
     """Only allows POST to appropriate endpoint with supplied token to create USER ('staff')
     gate interaction record (ie for staff user to operate gate). GET only returns
-    user (not guest) interactions."""
-    queryset = GateActivity.objects.filter(responsible_user__isnull=False)
+    user (not guest) interactions. POST may name the gate opened; it defaults to the device's gate."""
+    queryset = GateActivity.objects.filter(responsible_user__isnull=False).select_related('responsible_user')
     serializer_class = UserGateActivitySerializer
     permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = GateActivityCursorPagination
+    filter_backends = (DjangoFilterBackend, DateWindowFilter)
+    filter_fields = ('responsible_user', 'gate', 'site', 'gate_status')
+    archive_required = ('responsible_user_id',)
 
     def perform_create(self, serializer):
         serializer.save(responsible_user=self.request.user)
 
 
-class GuestGateInteractionView(generics.ListCreateAPIView):
+class GuestGateInteractionView(ReplicaReadMixin, SitePartitionMixin, ArchiveReadMixin, ConditionalActivityMixin,
+                               LeanListMixin, generics.ListCreateAPIView):
     """POST to appropriate endpoint with supplied token to create GUEST
     gate interaction record (ie for guest to operate gate). GET only returns
-    guest interactions."""
+    guest interactions. A permission limited to a site only opens the gates of that site - enforced for
+    opens by gate controllers authenticated as a device with a gate (see api.authentication); other
+    callers choose the gate themselves."""
     queryset = GateActivity.objects.filter(responsible_guest__isnull=False)  # only guest interactions
     serializer_class = GuestGateActivitySerializer
+    pagination_class = GateActivityCursorPagination
+    filter_backends = (DjangoFilterBackend, DateWindowFilter)
+    filter_fields = ('responsible_guest', 'gate', 'site', 'gate_status')
+    archive_required = ('responsible_guest_id',)
 
     def perform_create(self, serializer):
 
         try:
-            resp_guest = self.find_guest(self.request.POST['token'])
+            permission = self.find_guest(self.request.POST['token'])
         except KeyError:
             raise serializers.ValidationError(detail="No authentication token supplied.")
 
-        if resp_guest:
-            serializer.save(responsible_guest=resp_guest)
+        if permission:
+            serializer.save(token=self.request.POST['token'], permission=permission)
         else:
             raise serializers.ValidationError(detail="Invalid token supplied.")
 
     def find_guest(self, token):
-        try:
-            p = GuestPermission.objects.get(token=token)
-        except:
-            return None
-        return p.guest
+        """Return the (cached) permission entry for token - holding the guest id and validity
+        window - or None if the token is unknown."""
+        return lookup_token(token)
+
+
+class MetricsView(APIView):
+    """Per-view request timing histograms (GET) of this worker process in Prometheus text format, see
+    api.metrics.PerformanceMiddleware."""
 
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.registry.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')